@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Timing benchmarks for the code paths sesspy runs on every request.
+
+Each benchmark is run ``--repeat`` times for ``--number`` operations, in
+``--threads`` concurrent threads, and the best time per operation is reported.
+With ``--json``, results are written as JSON, which can be compared between
+revisions using ``--compare OLD.json NEW.json``.
+"""
+
+import os, os.path
+import sys
+import json
+import platform
+import threading
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sesspy import config, dec, local, openers, ref, registry, session, source
+from sesspy import sqlalchemy as sesspy_sqlalchemy
+
+_clock = timeit.default_timer
+
+def _session_factory(local_openers):
+    return session.SessionFactory(
+        source.InstanceSource(object()),
+        source.sessionless_source_adapter,
+        openers.CountingOpener if local_openers is not False else None,
+        local_openers=local_openers,
+    )
+
+def bench_noop():
+    return lambda: None
+
+def bench_open_session_local():
+    sf = _session_factory(session.LocalOpeners())
+    return sf.open_session
+
+def bench_open_session_nested():
+    sf = _session_factory(session.LocalOpeners())
+    outer = sf()
+    outer.open()
+    return sf.open_session
+
+def bench_open_session_nolocal():
+    sf = _session_factory(False)
+    return sf.open_session
+
+def bench_session_cycle():
+    sf = _session_factory(session.LocalOpeners())
+    def op():
+        with sf():
+            pass
+    return op
+
+def bench_injector_call():
+    sf = _session_factory(session.LocalOpeners())
+    @dec.with_component(sf, arg='db')
+    def func(db):
+        pass
+    return func
+
+def bench_injector_call_given():
+    @dec.with_component(_session_factory(False), arg='db')
+    def func(db):
+        pass
+    return lambda: func(db=None)
+
+def bench_compiled_call():
+    sf = _session_factory(session.LocalOpeners())
+    @dec.with_component(sf, arg='db', compiled=True)
+    def func(db):
+        pass
+    return func
+
+def bench_compiled_call_given():
+    @dec.with_component(_session_factory(False), arg='db', compiled=True)
+    def func(db):
+        pass
+    return lambda: func(db=None)
+
+def bench_injector_stacked_call():
+    local_openers = session.LocalOpeners()
+    @dec.with_component(_session_factory(local_openers), arg='db')
+    @dec.with_component(_session_factory(local_openers), arg='cache')
+    @dec.with_component(_session_factory(local_openers), arg='queue')
+    def func(db, cache, queue):
+        pass
+    return func
+
+def bench_multi_call():
+    local_openers = session.LocalOpeners()
+    @dec.with_components(db=_session_factory(local_openers),
+                         cache=_session_factory(local_openers),
+                         queue=_session_factory(local_openers))
+    def func(db, cache, queue):
+        pass
+    return func
+
+def bench_injector_get():
+    class Model(object):
+        @dec.with_component(_session_factory(False), arg='db')
+        def method(self, db):
+            pass
+    obj = Model()
+    return lambda: obj.method
+
+def bench_injector_method_call():
+    sf = _session_factory(session.LocalOpeners())
+    class Model(object):
+        @dec.with_component(sf, arg='db')
+        def method(self, db):
+            pass
+    obj = Model()
+    return lambda: obj.method()
+
+def bench_resolve_callable():
+    sf = _session_factory(False)
+    return lambda: ref.ComponentRef(sf).resolve()
+
+def bench_resolve_registry():
+    reg = registry.ComponentRegistry()
+    reg.register_component('db', _session_factory(False))
+    return lambda: reg.get('db').resolve()
+
+def bench_resolve_import():
+    return lambda: ref.ComponentRef('os.path.join').resolve()
+
+def bench_resolve_resolved():
+    cref = ref.ComponentRef('os.path.join')
+    cref.resolve()
+    return cref.resolve
+
+def bench_localdict_get():
+    d = local.LocalDict()
+    d['key'] = 1
+    return lambda: d['key']
+
+def bench_localdict_get_init():
+    d = local.LocalDict({'key': 1})
+    return lambda: d['key']
+
+def bench_localdict_get_contextvar():
+    d = local.LocalDict(scope=local.ContextVarScope())
+    d['key'] = 1
+    return lambda: d['key']
+
+def bench_localdict_set():
+    d = local.LocalDict()
+    def op():
+        d['key'] = 1
+    return op
+
+def bench_local_getattr():
+    l = local.Local()
+    l.key = 1
+    return lambda: l.key
+
+def bench_counting_opener():
+    opener = openers.CountingOpener(source.sessionless_source_adapter(object()))
+    def op():
+        opener.commit(opener.open())
+    return op
+
+def _config_reader():
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    parser = configparser.ConfigParser()
+    parser.add_section('general')
+    parser.set('general', 'pool_size', '10')
+    reader = config.LazyConfigReader(parser, [])
+    reader()
+    return reader
+
+def bench_config_option():
+    return config.ConfigOption(_config_reader(), 'general', 'pool_size', int)
+
+def bench_config_option_uncached():
+    reader = _config_reader()
+    return config.ConfigOption(lambda: reader(), 'general', 'pool_size', int)
+
+class _StubConnection(object):
+    # the methods of a connection, without the cost of running statements
+
+    def execute(self, statement):
+        return statement
+
+    exec_driver_sql = scalar = scalars = execute
+
+    def begin(self):
+        return None
+
+def bench_transaction_open():
+    connection = _StubConnection()
+    return lambda: sesspy_sqlalchemy.TransactionWrapper(connection, None)
+
+def bench_transaction_execute():
+    wrapper = sesspy_sqlalchemy.TransactionWrapper(_StubConnection(), None)
+    return lambda: wrapper.execute(None)
+
+def bench_transaction_execute_raw():
+    wrapper = sesspy_sqlalchemy.TransactionWrapper(_StubConnection(), None)
+    return lambda: wrapper.connection.execute(None)
+
+def bench_transaction_getattr():
+    wrapper = sesspy_sqlalchemy.TransactionWrapper(_StubConnection(), None)
+    return lambda: wrapper.begin
+
+def bench_sqlite_execute():
+    # ten statements per transaction on an in-memory database
+    from sqlalchemy import text
+    component = sesspy_sqlalchemy.transactional_db_connection(
+        'sqlite://', sticky_connections=True)
+    statement = text('select 1')
+    def op():
+        with component() as conn:
+            for _i in range(10):
+                conn.execute(statement)
+    return op
+
+BENCHMARKS = [
+    (name[len('bench_'):], func)
+    for name, func in sorted(globals().items())
+    if name.startswith('bench_')
+]
+
+def _time(op, number):
+    start = _clock()
+    for i in range(number):
+        op()
+    return _clock() - start
+
+def run_benchmark(make_op, number, repeat, threads):
+    """
+    Return the best time per operation in seconds, and the total operations
+    per second over all threads for that run.
+    """
+    best = None
+    for r in range(repeat):
+        if threads <= 1:
+            op = make_op()
+            op()
+            elapsed = _time(op, number)
+            per_op = elapsed / number
+            total_rate = number / elapsed
+        else:
+            barrier = threading.Barrier(threads + 1)
+            times = [None] * threads
+            def run(i):
+                # ops are created per thread, so thread-local state is warm
+                op = make_op()
+                op()
+                barrier.wait()
+                times[i] = _time(op, number)
+            workers = [threading.Thread(target=run, args=(i,))
+                       for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            barrier.wait()
+            start = _clock()
+            for worker in workers:
+                worker.join()
+            wall = _clock() - start
+            per_op = max(times) / number
+            total_rate = number * threads / wall
+        if best is None or per_op < best[0]:
+            best = (per_op, total_rate)
+    return best
+
+def _revision():
+    import subprocess
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).decode('ascii').strip()
+    except Exception:
+        return None
+
+def run(names, number, repeat, threads):
+    results = {}
+    for name, make_op in BENCHMARKS:
+        if names and name not in names:
+            continue
+        try:
+            per_op, rate = run_benchmark(make_op, number, repeat, threads)
+        except ImportError:
+            exc = sys.exc_info()[1]
+            sys.stderr.write("skipping %s: %s\n" % (name, exc))
+            continue
+        results[name] = dict(ns_per_op=per_op * 1e9, ops_per_sec=rate)
+    return dict(
+        revision=_revision(),
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        threads=threads,
+        number=number,
+        repeat=repeat,
+        results=results,
+    )
+
+def compare(old, new):
+    print("%-24s %12s %12s %8s" % ('benchmark', 'old ns/op', 'new ns/op',
+                                   'ratio'))
+    for name in sorted(set(old['results']) | set(new['results'])):
+        o = old['results'].get(name, {}).get('ns_per_op')
+        n = new['results'].get(name, {}).get('ns_per_op')
+        if o is None or n is None:
+            print("%-24s %12s %12s %8s" % (name, o and '%.1f' % o,
+                                           n and '%.1f' % n, '-'))
+        else:
+            print("%-24s %12.1f %12.1f %8.2f" % (name, o, n, n / o))
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog [options] [BENCHMARK...]\n"
+              "       %prog --compare OLD.json NEW.json")
+    parser.add_option('-n', '--number', type='int', default=100000,
+                      help="operations per run and thread")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help="runs per benchmark, the best is reported")
+    parser.add_option('-t', '--threads', type='int', default=1,
+                      help="number of concurrent threads")
+    parser.add_option('-j', '--json', metavar='FILE',
+                      help="write results as JSON to FILE ('-' for stdout)")
+    parser.add_option('-c', '--compare', action='store_true',
+                      help="compare two JSON result files")
+    parser.add_option('-l', '--list', action='store_true',
+                      help="list available benchmarks")
+    options, args = parser.parse_args(argv)
+
+    if options.list:
+        for name, make_op in BENCHMARKS:
+            print(name)
+        return
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare requires two files")
+        with open(args[0]) as old, open(args[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    result = run(args, options.number, options.repeat, options.threads)
+    if options.json == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(result, out, indent=2, sort_keys=True)
+    print("%-24s %12s %14s" % ('benchmark', 'ns/op', 'ops/s (total)'))
+    for name in sorted(result['results']):
+        res = result['results'][name]
+        print("%-24s %12.1f %14.0f" % (name, res['ns_per_op'],
+                                        res['ops_per_sec']))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
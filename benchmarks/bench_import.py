@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Import time benchmark for sesspy modules.
+
+Each module is imported in a fresh interpreter, ``--repeat`` times, and the
+best time is reported, together with the heavy optional dependencies (such
+as SQLAlchemy) that the import pulled in.
+"""
+
+import os, os.path
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'sesspy',
+    'sesspy.registry',
+    'sesspy.dec',
+    'sesspy.session',
+    'sesspy.openers',
+    'sesspy.config',
+    'sesspy.sqlalchemy',
+]
+
+HEAVY_MODULES = ['sqlalchemy', 'sesspy.six', 'asyncio', 'concurrent.futures']
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import %(module)s
+elapsed = time.perf_counter() - start
+print(repr((elapsed, [name for name in %(heavy)r if name in sys.modules])))
+"""
+
+def time_import(module, repeat):
+    best = None
+    heavy = None
+    script = _SCRIPT % dict(module=module, heavy=HEAVY_MODULES)
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=ROOT)
+        elapsed, heavy = eval(output.decode('ascii'))
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, heavy
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] [MODULE...]")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="imports per module, the best is reported")
+    parser.add_option('-j', '--json', metavar='FILE',
+                      help="write results as JSON to FILE ('-' for stdout)")
+    options, args = parser.parse_args(argv)
+
+    results = {}
+    for module in args or MODULES:
+        elapsed, heavy = time_import(module, options.repeat)
+        results[module] = dict(ms=elapsed * 1e3, heavy=heavy)
+
+    if options.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    print("%-24s %10s  %s" % ('module', 'ms', 'heavy imports'))
+    for module in args or MODULES:
+        res = results[module]
+        print("%-24s %10.2f  %s" % (module, res['ms'],
+                                    ', '.join(res['heavy']) or '-'))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Memory benchmark for the objects allocated by sesspy per session.
+
+For each scenario, a number of open/commit cycles are run while keeping the
+objects created in each cycle alive, and tracemalloc is used to report the
+bytes and memory blocks allocated per cycle, as well as the peak memory used by
+a single cycle.
+"""
+
+import os, os.path
+import sys
+import gc
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sesspy import dec, openers, registry, session, source
+
+def _session_factory(local_openers):
+    return session.SessionFactory(
+        source.InstanceSource(object()),
+        source.sessionless_source_adapter,
+        openers.CountingOpener if local_openers is not False else None,
+        local_openers=local_openers,
+    )
+
+def session_cycle():
+    sf = _session_factory(session.LocalOpeners())
+    def cycle():
+        s = sf()
+        s.open()
+        s.commit()
+        return s
+    return cycle
+
+def session_nolocal_cycle():
+    sf = _session_factory(False)
+    def cycle():
+        s = sf()
+        s.open()
+        s.commit()
+        return s
+    return cycle
+
+def injector_method_cycle():
+    sf = _session_factory(session.LocalOpeners())
+    class Model(object):
+        @dec.with_component(sf, arg='db')
+        def method(self, db):
+            return db
+    obj = Model()
+    def cycle():
+        method = obj.method
+        method()
+        return method
+    return cycle
+
+def registry_ref_cycle():
+    reg = registry.ComponentRegistry()
+    reg.register_component('db', _session_factory(session.LocalOpeners()))
+    def cycle():
+        cref = reg.get('db')
+        with cref():
+            pass
+        return cref
+    return cycle
+
+SCENARIOS = [
+    ('session', session_cycle),
+    ('session_nolocal', session_nolocal_cycle),
+    ('injector_method', injector_method_cycle),
+    ('registry_ref', registry_ref_cycle),
+]
+
+def measure(make_cycle, cycles):
+    cycle = make_cycle()
+    # warm up caches, lazily created openers etc.
+    cycle()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        cycle()
+        peak = tracemalloc.get_traced_memory()[1] - current
+
+        keep = [None] * cycles
+        before = tracemalloc.take_snapshot()
+        for i in range(cycles):
+            keep[i] = cycle()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    count = sum(stat.count_diff for stat in stats)
+    return float(size) / cycles, float(count) / cycles, peak
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [-n CYCLES] [SCENARIO...]")
+    parser.add_option('-n', '--cycles', type='int', default=10000)
+    options, names = parser.parse_args(argv)
+
+    print("%-20s %12s %12s %12s" % ('scenario', 'bytes/cycle',
+                                     'blocks/cycle', 'peak bytes'))
+    for name, make_cycle in SCENARIOS:
+        if names and name not in names:
+            continue
+        size, count, peak = measure(make_cycle, options.cycles)
+        print("%-20s %12.1f %12.2f %12d" % (name, size, count, peak))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,5 +16,15 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ["config", "dec", "local", "openers", "ref", "registry", "session",
-           "source", "sqlalchemy"]
+__all__ = ["aio", "config", "dec", "local", "metrics", "openers", "ref",
+           "registry", "retry", "session", "source", "sqlalchemy", "tenant"]
+
+def __getattr__(name):
+    # python 3.7+: import submodules on first access, e.g. sesspy.registry
+    if name in __all__:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
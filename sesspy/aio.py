@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import sys
+import asyncio
+import contextvars
+
+from .session import SessionFactory, SessionStateException, _INSTANCE_SENTINEL
+from .dec import ComponentInjector, _in_session
+from .metrics import _clock
+
+class AsyncSession(object):
+    """
+    Encapsulate a session for a resource with an awaitable opener.
+
+    This behaves like :class:`.Session`, except that ``open``, ``commit`` and
+    ``abort`` are coroutines, and the session can be used as a guard in an
+    ``async with`` statement.
+    """
+
+    __slots__ = 'instance_opener', 'instance'
+
+    def __init__(self, instance_opener):
+        self.instance_opener = instance_opener
+        self.instance = _INSTANCE_SENTINEL
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc, typ, tb):
+        if exc is None:
+            await self.commit()
+        else:
+            await self.abort()
+
+    async def open(self, raise_failure=True):
+        """
+        Begin a session and return the corresponding resource/connection.
+
+        If a session has already been opened, a :exc:`SessionStateException` is
+        raised, unless ``raise_failure`` is false, in which case ``None`` is
+        returned.
+        """
+        if self.instance is not _INSTANCE_SENTINEL:
+            if raise_failure:
+                raise SessionStateException(
+                    "called open on already open session object"
+                )
+            return
+        self.instance = await self.instance_opener.open()
+        return self.instance
+
+    async def commit(self, raise_failure=True):
+        """
+        End the started session, finalizing any changes.
+
+        See :meth:`.Session.commit`.
+        """
+        if self.instance is _INSTANCE_SENTINEL:
+            if raise_failure:
+                raise SessionStateException(
+                    "called commit on unopened session object"
+                )
+            return
+        instance = self.instance
+        self.instance = _INSTANCE_SENTINEL
+        await self.instance_opener.commit(instance)
+
+    async def abort(self, raise_failure=True):
+        """
+        End the started session, discarding any changes.
+
+        See :meth:`.Session.abort`.
+        """
+        if self.instance is _INSTANCE_SENTINEL:
+            if raise_failure:
+                raise SessionStateException(
+                    "called abort on unopened session object"
+                )
+            return
+        instance = self.instance
+        self.instance = _INSTANCE_SENTINEL
+        await self.instance_opener.abort(instance)
+
+class InstrumentedAsyncSession(AsyncSession):
+    """
+    An :class:`AsyncSession` recording the latency of its calls and the time
+    it was held open in a :class:`.ComponentMetrics`.
+    """
+
+    __slots__ = 'metrics', 'opened_at'
+
+    def __init__(self, instance_opener, metrics):
+        super(InstrumentedAsyncSession, self).__init__(instance_opener)
+        self.metrics = metrics
+        self.opened_at = None
+
+    async def open(self, raise_failure=True):
+        parent = super(InstrumentedAsyncSession, self)
+        if self.instance is not _INSTANCE_SENTINEL:
+            return await parent.open(raise_failure)
+        start = _clock()
+        try:
+            instance = await parent.open(raise_failure)
+        except Exception:
+            self.metrics.increment('open_failed')
+            raise
+        self.opened_at = _clock()
+        self.metrics.record('open', self.opened_at - start)
+        self.metrics.increment('opened')
+        return instance
+
+    async def _end(self, end, event, counter, raise_failure):
+        if self.instance is _INSTANCE_SENTINEL:
+            return await end(self, raise_failure)
+        start = _clock()
+        self.metrics.record('held', start - self.opened_at)
+        try:
+            await end(self, raise_failure)
+        except Exception:
+            self.metrics.increment(event + '_failed')
+            raise
+        else:
+            self.metrics.increment(counter)
+        finally:
+            self.metrics.record(event, _clock() - start)
+
+    async def commit(self, raise_failure=True):
+        await self._end(AsyncSession.commit, 'commit', 'committed',
+                        raise_failure)
+
+    async def abort(self, raise_failure=True):
+        await self._end(AsyncSession.abort, 'abort', 'aborted', raise_failure)
+
+class AsyncSessionFactory(SessionFactory):
+    """
+    A :class:`.SessionFactory` that creates :class:`AsyncSession` objects.
+
+    The ``adapter_factory`` (or ``opener_factory``, if given) must produce an
+    opener with awaitable methods, e.g. using
+    :func:`async_source_adapter_factory`. Since many tasks share a single
+    thread, no thread-local opener cache is used by default; pass e.g.
+    ``LocalOpeners(ContextVarScope())`` to reuse openers per task.
+    """
+
+    __slots__ = ()
+
+    session_class = AsyncSession
+    instrumented_session_class = InstrumentedAsyncSession
+
+    def __init__(self,
+                 source_factory, adapter_factory,
+                 opener_factory=None, local_openers=False,
+                 metrics=None):
+        super(AsyncSessionFactory, self).__init__(
+            source_factory, adapter_factory,
+            opener_factory, local_openers,
+            metrics,
+        )
+
+class AsyncSourceAdapter(object):
+    """
+    Like :class:`.SourceAdapter`, but ``open_fn``, ``commit_fn`` and
+    ``abort_fn`` are coroutine functions.
+    """
+
+    __slots__ = 'source', 'open_fn', 'commit_fn', 'abort_fn'
+
+    def __init__(self, source, open_fn,
+                 commit_fn=None, abort_fn=None):
+        self.source = source
+        self.open_fn = open_fn
+        self.commit_fn = commit_fn
+        self.abort_fn = abort_fn
+
+    async def open(self):
+        return await self.open_fn(self.source)
+
+    async def commit(self, instance):
+        if self.commit_fn is not None:
+            await self.commit_fn(self.source, instance)
+
+    async def abort(self, instance):
+        if self.abort_fn is not None:
+            await self.abort_fn(self.source, instance)
+
+def async_source_adapter_factory(open_fn, commit_fn=None, abort_fn=None):
+    def factory(source):
+        return AsyncSourceAdapter(source, open_fn, commit_fn, abort_fn)
+    return factory
+
+async def _return_source(source):
+    return source
+
+def async_sessionless_source_adapter(source):
+    return AsyncSourceAdapter(source, _return_source)
+
+class AsyncComponentInjector(ComponentInjector):
+    """
+    Coroutine function decorator that injects a session into the call
+    arguments.
+
+    The component must produce an :class:`AsyncSession`, which is opened and
+    closed around awaiting the wrapped coroutine function.
+    """
+
+    __slots__ = ()
+
+    async def _call_injected(self, *args, **kwargs):
+        async with self.ref() as instance:
+            kwargs[self.arg_kw] = instance
+            return await self.func(*args, **kwargs)
+
+    async def __call__(self, *args, **kwargs):
+        if self.arg_kw not in kwargs:
+            if self.retry is not None and not _in_session(self.ref):
+                return await call_with_retry(
+                    self.retry, self._call_injected, *args, **kwargs
+                )
+            async with self.ref() as instance:
+                kwargs[self.arg_kw] = instance
+                return await self.func(*args, **kwargs)
+        else:
+            return await self.func(*args, **kwargs)
+
+_retry_depth = contextvars.ContextVar('sesspy.aio._retry_depth', default=0)
+
+async def call_with_retry(policy, func, *args, **kwargs):
+    """
+    Await ``func`` with the given arguments, retrying according to the
+    :class:`.RetryPolicy` ``policy``.
+
+    Like :meth:`.RetryPolicy.call`, only the outermost call (in each task) is
+    retried.
+    """
+    if _retry_depth.get():
+        return await func(*args, **kwargs)
+    start = _clock()
+    attempt = 0
+    token = _retry_depth.set(1)
+    try:
+        while True:
+            attempt += 1
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                exc = sys.exc_info()[1]
+                delay = policy.next_delay(attempt, exc, start)
+                if delay is None:
+                    raise
+                if policy.on_retry is not None:
+                    policy.on_retry(attempt, exc, delay)
+                await asyncio.sleep(delay)
+    finally:
+        _retry_depth.reset(token)
+
+def retrying_coroutine(session_factory, policy, func):
+    """
+    Asynchronous counterpart of :func:`.retrying`, wrapping the coroutine
+    function ``func``.
+    """
+    async def run_session(*args, **kwargs):
+        async with session_factory() as instance:
+            return await func(instance, *args, **kwargs)
+
+    async def wrapper(*args, **kwargs):
+        if _in_session(session_factory):
+            return await run_session(*args, **kwargs)
+        return await call_with_retry(policy, run_session, *args, **kwargs)
+    for attr in ('__name__', '__doc__', '__module__'):
+        if hasattr(func, attr):
+            setattr(wrapper, attr, getattr(func, attr))
+    return wrapper
@@ -18,10 +18,27 @@
 
 from __future__ import absolute_import, with_statement
 
+import os, os.path
 import sys
+import mmap
+import marshal
+import weakref
+import warnings
 import threading
 import codecs
-from .six.moves import configparser
+from contextlib import contextmanager
+try:
+    import configparser
+except ImportError:
+    # python 2
+    import ConfigParser as configparser
+from .local import _fork_aware
+
+try:
+    # python 3.3+
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
 
 class FeatureUnconfigured(Exception):
     pass
@@ -33,26 +50,75 @@ class LazyConfigReader(object):
     This class can be used as a "get_config" callable, lazily loading the
     specified paths on first call. This also allows the paths to be adjusted at
     load-time before the configuration is first read.
+
+    ``generation`` is incremented whenever the configuration is read, and by
+    :meth:`invalidate`, so that :class:`ConfigOption` and
+    :class:`ConfigSection` can cache their values until it changes.
+
+    If ``reload_interval`` is given, a background thread checks the files
+    every ``reload_interval`` seconds (by inode, modification time and size)
+    and calls :meth:`reload` when they changed. The sections and options read
+    from the files are then replaced with their new values.
+
+    If ``snapshot_path`` is given, the parsed files are saved to it, and later
+    reads (e.g. by other worker processes) load the snapshot instead of
+    parsing the files again, as long as none of the files changed (by inode,
+    modification time and size). The snapshot is only valid for configs with
+    the same ``optionxform``.
     """
 
     def __init__(self, config, paths,
                  expanduser=True, leaf=None,
-                 encoding=None):
+                 encoding=None, reload_interval=None, snapshot_path=None):
         self.config = config
         self.paths = paths
         self.expanduser = expanduser
         self.leaf = leaf
         self.encoding = encoding
+        self.reload_interval = reload_interval
+        self.snapshot_path = snapshot_path
         self.load_lock = threading.Lock()
         self.read_paths = None
+        self.generation = 0
+        # path -> stat key and parsed values, as of the last (re)load
+        self.file_states = {}
+        self.file_values = {}
+        # (section, option) and sections set from the files
+        self.applied = set()
+        self.applied_sections = set()
+        # objects with a config_changed(reader, changed) method
+        self.dependents = weakref.WeakSet()
+        self.watcher = None
+        if reload_interval is not None:
+            _fork_aware.add(self)
 
-    def read(self):
-        import os, os.path
+    def _after_fork(self):
+        # the watcher thread did not survive the fork
+        self.load_lock = threading.Lock()
+        self.watcher = None
+        if self.read_paths is not None:
+            self._start_watcher()
+
+    def _paths(self):
         paths = self.paths
         if self.leaf:
             paths = [os.path.join(p, self.leaf) for p in paths]
         if self.expanduser:
             paths = [os.path.expanduser(p) for p in paths]
+        return paths
+
+    def read(self):
+        paths = self._paths()
+        if self.snapshot_path is not None or self.reload_interval is not None:
+            if self.snapshot_path is None or not self._load_snapshot(paths):
+                if self._reload_files(paths, False) is not None and \
+                        self.snapshot_path is not None:
+                    self._save_snapshot(paths)
+            self.read_paths = [path for path in paths
+                               if self.file_values.get(path) is not None]
+            self.generation += 1
+            self._start_watcher()
+            return
         read_paths = self.read_paths or []
         if self.encoding:
             for path in paths:
@@ -66,6 +132,14 @@ class LazyConfigReader(object):
         else:
             read_paths.extend(self.config.read(paths))
         self.read_paths = read_paths
+        self.generation += 1
+
+    def invalidate(self):
+        """
+        Drop the values cached from this configuration, e.g. after modifying
+        it directly.
+        """
+        self.generation += 1
 
     def __call__(self):
         if self.read_paths is not None:
@@ -76,6 +150,279 @@ class LazyConfigReader(object):
             self.read()
             return self.config
 
+    def add_dependent(self, dependent):
+        """
+        Call ``dependent.config_changed(reader, changed)`` after a
+        :meth:`reload` changed options, with ``changed`` the set of
+        ``(section, option)`` pairs whose values changed. Only a weak
+        reference to ``dependent`` is kept.
+        """
+        self.dependents.add(dependent)
+
+    def reload(self):
+        """
+        Re-read the files that changed since they were last read, update the
+        configuration, and notify the dependents if options changed.
+
+        Returns the set of ``(section, option)`` pairs whose values changed.
+        Options of the ``DEFAULT`` section are reported for every section.
+        """
+        with self.load_lock:
+            paths = self._paths()
+            changed = self._reload_files(paths)
+            if changed is None:
+                return set()
+            self.read_paths = [path for path in paths
+                               if self.file_values.get(path) is not None]
+            if changed:
+                self.generation += 1
+            if self.snapshot_path is not None:
+                self._save_snapshot(paths)
+        for dependent in list(self.dependents):
+            try:
+                dependent.config_changed(self, changed)
+            except Exception:
+                exc = sys.exc_info()[1]
+                warnings.warn("An exception was raised while reloading "
+                              "after a configuration change: " + str(exc))
+        return changed
+
+    def _reload_files(self, paths, changes=True):
+        # re-parses the files that changed and applies all files to the
+        # config; returns None if no file changed
+        any_changed = False
+        for path in paths:
+            state = _file_state(path)
+            if path in self.file_states and self.file_states[path] == state:
+                continue
+            self.file_states[path] = state
+            any_changed = True
+            if state is None:
+                self.file_values[path] = None
+                continue
+            try:
+                self.file_values[path] = self._parse_file(path)
+            except (IOError, OSError, configparser.Error):
+                # keep the previous values, until the file changes again
+                exc = sys.exc_info()[1]
+                warnings.warn("Failed to read configuration file %s: %s"
+                              % (path, exc))
+        if not any_changed:
+            return None
+        return self._apply(paths, changes)
+
+    def _apply(self, paths, changes=True):
+        # applies the values of all files to the config, returning the set
+        # of (section, option) that changed if changes is true
+        config = self.config
+        if changes:
+            before = _effective_values(config)
+        merged = {}
+        # sections are kept even without options, as ConfigParser does
+        sections = set()
+        for path in paths:
+            for section, options in (self.file_values.get(path) or {}).items():
+                if section != configparser.DEFAULTSECT:
+                    sections.add(section)
+                for option, value in options.items():
+                    merged[(section, option)] = value
+        # set new values before removing stale ones, so that readers never
+        # see options missing that are still configured
+        for section in sections:
+            if not config.has_section(section):
+                config.add_section(section)
+        for (section, option), value in merged.items():
+            config.set(section, option, value)
+        for section, option in self.applied.difference(merged):
+            try:
+                config.remove_option(section, option)
+            except configparser.NoSectionError:
+                pass
+        for section in self.applied_sections.difference(sections):
+            config.remove_section(section)
+        self.applied = set(merged)
+        self.applied_sections = sections
+        if not changes:
+            return set()
+        after = _effective_values(config)
+        return set(key for key in set(before).union(after)
+                   if before.get(key) != after.get(key))
+
+    def _parse_file(self, path):
+        try:
+            # python 3.2+: read DEFAULT like any other section, so that each
+            # section only has the options the file sets in it, even those
+            # with the same value as in DEFAULT
+            parser = configparser.RawConfigParser(
+                default_section=_NO_DEFAULT_SECTION)
+        except TypeError:
+            parser = configparser.RawConfigParser()
+        parser.optionxform = self.config.optionxform
+        if self.encoding:
+            conffile = codecs.open(path, 'r', self.encoding)
+        else:
+            conffile = open(path)
+        # readfp was removed in python 3.12
+        read_file = getattr(parser, 'read_file', None) or parser.readfp
+        with conffile:
+            read_file(conffile)
+        values = {configparser.DEFAULTSECT: dict(parser.defaults())}
+        for section in parser.sections():
+            if parser.defaults():
+                # python 2, where items() includes the defaults
+                options = dict(parser._sections[section])
+                options.pop('__name__', None)
+            else:
+                options = dict(parser.items(section))
+            values[section] = options
+        return values
+
+    def _snapshot_key(self, paths):
+        return (_SNAPSHOT_FORMAT, self.encoding,
+                self.config.optionxform('Option'), list(paths))
+
+    def _load_snapshot(self, paths):
+        states = [_file_state(path) for path in paths]
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = mmap.mmap(snapshot.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+                try:
+                    key, snapshot_states, values = marshal.loads(data)
+                finally:
+                    data.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # missing, empty or corrupt
+            return False
+        if key != self._snapshot_key(paths) or snapshot_states != states:
+            return False
+        self.file_states = dict(zip(paths, states))
+        self.file_values = dict(zip(paths, values))
+        self._apply(paths, False)
+        return True
+
+    def _save_snapshot(self, paths):
+        import tempfile
+        if any(path not in self.file_values for path in paths):
+            # a file could not be parsed
+            return
+        states = [self.file_states.get(path) for path in paths]
+        values = [self.file_values[path] for path in paths]
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                            prefix='.sesspy-snapshot-')
+            try:
+                with os.fdopen(fd, 'wb') as snapshot:
+                    marshal.dump((self._snapshot_key(paths), states, values),
+                                 snapshot)
+                # atomic, so that concurrent readers never see half of it
+                _replace(tmp_path, self.snapshot_path)
+            except:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            exc = sys.exc_info()[1]
+            warnings.warn("Failed to save configuration snapshot %s: %s"
+                          % (self.snapshot_path, exc))
+
+    def _start_watcher(self):
+        if self.watcher is not None or self.reload_interval is None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=_watch,
+            args=(weakref.ref(self), stop, self.reload_interval),
+            name='sesspy-config-watcher',
+        )
+        thread.daemon = True
+        self.watcher = (thread, stop)
+        thread.start()
+
+    def stop(self):
+        """
+        Stop checking the files for changes.
+        """
+        watcher, self.watcher = self.watcher, None
+        if watcher is not None:
+            watcher[1].set()
+
+# bumped when the layout of snapshots changes
+_SNAPSHOT_FORMAT = 'sesspy-config-2'
+
+# see LazyConfigReader._parse_file
+_NO_DEFAULT_SECTION = '\0sesspy-no-default-section'
+
+# python 3.3+ can replace files atomically on all platforms
+_replace = getattr(os, 'replace', os.rename)
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime),
+            st.st_size)
+
+def _effective_values(config):
+    values = dict(((configparser.DEFAULTSECT, option), value)
+                  for option, value in config.defaults().items())
+    for section in config.sections():
+        for option, value in config.items(section, raw=True):
+            values[(section, option)] = value
+    return values
+
+def _watch(reader_ref, stop, interval):
+    # only holds the reader while reloading, so that it can be collected
+    while not stop.wait(interval):
+        reader = reader_ref()
+        if reader is None:
+            return
+        try:
+            reader.reload()
+        except Exception:
+            exc = sys.exc_info()[1]
+            warnings.warn("An exception was raised while reloading the "
+                          "configuration: " + str(exc))
+        del reader
+
+# thread ident -> set of (get_config, section, option) read while creating
+# a source, see _recording_options; option is None for a whole ConfigSection
+_recorders = {}
+
+@contextmanager
+def _recording_options():
+    ident = _get_ident()
+    previous = _recorders.get(ident)
+    options = _recorders[ident] = set()
+    try:
+        yield options
+    finally:
+        if previous is not None:
+            _recorders[ident] = previous
+        else:
+            del _recorders[ident]
+
+_BOOLEAN_STATES = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+def _to_bool(value):
+    try:
+        return _BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: %s" % (value,))
+
+def _to_list(value):
+    items = value.replace('\n', ',').split(',')
+    return [item.strip() for item in items if item.strip()]
+
+_CONVERTERS = {bool: _to_bool, list: _to_list}
+
+def _converter(convert):
+    return _CONVERTERS.get(convert, convert)
+
 class ConfigOption(object):
     """
     Configuration option helper.
@@ -83,15 +430,98 @@ class ConfigOption(object):
     When called it in turn calls the get_config callable and then attempts to
     retrieve the specified option. If the section or option does not exist,
     it raises a FeatureUnconfigured exception.
+
+    If ``convert`` is given, the value is converted with it: ``int`` and
+    ``float`` as usual, ``bool`` accepting the same values as
+    :meth:`ConfigParser.getboolean`, ``list`` splitting on commas and
+    newlines, or any other callable taking the string value.
+
+    If get_config has a ``generation`` (like :class:`LazyConfigReader`), the
+    value is cached until the generation changes.
     """
-    def __init__(self, get_config, section, option):
+    def __init__(self, get_config, section, option, convert=None):
         self.get_config = get_config
         self.section, self.option = section, option
+        self.convert = _converter(convert)
+        # (generation, value, error message)
+        self.cached = None
 
     def __call__(self):
+        if _recorders:
+            options = _recorders.get(_get_ident())
+            if options is not None:
+                options.add((self.get_config, self.section, self.option))
+        cached = self.cached
+        if cached is not None and \
+                cached[0] == getattr(self.get_config, 'generation', None):
+            if cached[2] is not None:
+                raise FeatureUnconfigured(cached[2])
+            return cached[1]
+
         config = self.get_config()
+        generation = getattr(self.get_config, 'generation', None)
         try:
-            return config.get(self.section, self.option)
+            value = config.get(self.section, self.option)
         except (configparser.NoSectionError,
                 configparser.NoOptionError):
+            message = str(sys.exc_info()[1])
+            if generation is not None:
+                self.cached = (generation, None, message)
+            raise FeatureUnconfigured(message)
+        if self.convert is not None:
+            value = self.convert(value)
+        if generation is not None:
+            self.cached = (generation, value, None)
+        return value
+
+class ConfigSection(object):
+    """
+    Snapshot of a whole configuration section.
+
+    When called it returns a dict of all options in the section, converted
+    as with :class:`ConfigOption` by the callables in ``converters`` (by
+    option name). Like :class:`ConfigOption`, the dict is cached until the
+    generation of get_config changes, and must not be modified.
+
+    If the section does not exist, it raises a FeatureUnconfigured exception.
+    """
+    def __init__(self, get_config, section, converters=None):
+        self.get_config = get_config
+        self.section = section
+        self.converters = dict((option, _converter(convert))
+                               for option, convert
+                               in (converters or {}).items())
+        self.cached = None
+
+    def __call__(self):
+        if _recorders:
+            options = _recorders.get(_get_ident())
+            if options is not None:
+                # None stands for all options of the section
+                options.add((self.get_config, self.section, None))
+        cached = self.cached
+        if cached is not None and \
+                cached[0] == getattr(self.get_config, 'generation', None):
+            return cached[1]
+
+        config = self.get_config()
+        generation = getattr(self.get_config, 'generation', None)
+        try:
+            items = config.items(self.section)
+        except configparser.NoSectionError:
             raise FeatureUnconfigured(str(sys.exc_info()[1]))
+        values = {}
+        for option, value in items:
+            convert = self.converters.get(option)
+            values[option] = convert(value) if convert is not None else value
+        if generation is not None:
+            self.cached = (generation, values)
+        return values
+
+    def option(self, option, convert=None):
+        """
+        Return a :class:`ConfigOption` for an option of this section.
+        """
+        if convert is None:
+            convert = self.converters.get(option)
+        return ConfigOption(self.get_config, self.section, option, convert)
@@ -18,10 +18,61 @@
 
 from __future__ import absolute_import, with_statement
 
-from .ref import ComponentRef
-from . import six
+from .ref import ComponentRef, _string_types
 
-class ComponentInjector(object):
+import sys
+import functools
+
+# inspect is slow to import, so it is only imported when decorating functions
+
+def _iscoroutinefunction(func):
+    try:
+        # python 3.5+
+        from inspect import iscoroutinefunction
+    except ImportError:
+        return False
+    return iscoroutinefunction(func)
+
+def _has_signature():
+    try:
+        # python 3.3+
+        from inspect import signature
+    except ImportError:
+        return False
+    return True
+
+class _FunctionAttribute(str):
+    # Class attribute that is looked up on the wrapped function when accessed
+    # on an instance. As a str, it can stand in for the class's own
+    # __module__ and __doc__.
+
+    def __new__(cls, name, value):
+        self = str.__new__(cls, value or '')
+        self.name = name
+        self.value = value
+        return self
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self.value
+        return getattr(obj.func, self.name, None)
+
+class _InjectorType(type):
+    # Injectors are slotted, so they cannot store the wrapped function's
+    # __name__, __doc__ and __module__. Instead, these are replaced in each
+    # injector class by attributes that forward to the wrapped function.
+
+    def __new__(mcs, name, bases, namespace):
+        for attr in ('__name__', '__doc__', '__module__'):
+            namespace[attr] = _FunctionAttribute(attr, namespace.get(attr))
+        return type.__new__(mcs, name, bases, namespace)
+
+_new_object = object.__new__
+
+# equivalent to six.with_metaclass, but without adding a __dict__
+_InjectorBase = _InjectorType('_InjectorBase', (object,), {'__slots__': ()})
+
+class ComponentInjector(_InjectorBase):
     """
     Function decorator that injects a session into the call arguments.
 
@@ -30,56 +81,428 @@ class ComponentInjector(object):
     specified component and inject it into the call arguments with the
     specified keyword. If the keyword argument is already present in the call,
     it is not overridden.
+
+    If ``retry`` is a :class:`.RetryPolicy`, the call (including opening and
+    closing the session) is repeated according to that policy when it fails
+    with a transient error. It is not repeated when the session would be
+    nested in one that is already open, as the enclosing transaction cannot
+    be retried from within; the error is passed on to the enclosing unit of
+    work instead.
+
+    When accessed as a method, a bound injector is built directly from the
+    slots, without going through :meth:`copy`. Nothing is stored on the
+    instance, so, like a bound method, it does not outlive its use.
     """
 
-    def __init__(self, ref, func, arg_kw):
-        for attr in ('__name__', '__doc__', '__module__'):
-            if hasattr(func, attr):
-                setattr(self, attr, getattr(func, attr))
-            self.__dict__.update(getattr(func, '__dict__', {}))
+    # __dict__ holds attributes set on the injector after decoration (e.g. by
+    # frameworks tagging handlers); it is only allocated once one is set
+    __slots__ = 'func', 'ref', 'arg_kw', 'retry', '__dict__'
+
+    def __init__(self, ref, func, arg_kw, retry=None):
         self.func = func
         if not callable(ref):
             ref = ComponentRef(ref)
         self.ref = ref
         self.arg_kw = arg_kw
-        self.__name__ = func.__name__
-        self.__doc__ = func.__doc__
-        self.__module__ = func.__module__
+        self.retry = retry
+
+    def __getattr__(self, name):
+        # expose attributes set on the wrapped function
+        try:
+            return object.__getattribute__(self, 'func').__dict__[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
 
     def copy(self, **kwargs):
         kwargs.setdefault('ref', self.ref)
         kwargs.setdefault('func', self.func)
         kwargs.setdefault('arg_kw', self.arg_kw)
-        return ComponentInjector(**kwargs)
+        kwargs.setdefault('retry', self.retry)
+        return type(self)(**kwargs)
 
     def __get__(self, obj, owner=None):
-        if hasattr(self.func, '__get__'):
-            # when accessing methods, return new instance with bound method
-            kwargs = dict(func=self.func.__get__(obj, owner))
-            if hasattr(self.ref, '__get__'):
-                kwargs['ref'] = self.ref.__get__(obj, owner)
-            return self.copy(**kwargs)
-        else:
+        func = self.func
+        if not hasattr(func, '__get__'):
             return self
+        # when accessing methods, return new instance with bound method
+        return self._bound(func.__get__(obj, owner), self._bind_ref(obj, owner))
+
+    def _bound(self, func, ref):
+        bound = _new_object(type(self))
+        bound.func = func
+        bound.ref = ref
+        bound.arg_kw = self.arg_kw
+        bound.retry = self.retry
+        return bound
+
+    def _bind_ref(self, obj, owner):
+        ref = self.ref
+        if hasattr(ref, '__get__'):
+            ref = ref.__get__(obj, owner)
+        return ref
+
+    def _call_injected(self, *args, **kwargs):
+        with self.ref() as instance:
+            kwargs[self.arg_kw] = instance
+            return self.func(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
         if self.arg_kw not in kwargs:
+            if self.retry is not None and not _in_session(self.ref):
+                return self.retry.call(self._call_injected, *args, **kwargs)
             with self.ref() as instance:
                 kwargs[self.arg_kw] = instance
                 return self.func(*args, **kwargs)
         else:
             return self.func(*args, **kwargs)
 
-def with_component(ref, arg=None, injector=ComponentInjector):
+class MultiComponentInjector(ComponentInjector):
+    """
+    Function decorator that injects sessions for several components into the
+    call arguments.
+
+    ``ref`` and ``arg_kw`` are sequences of the same length. Sessions are
+    opened in that order and committed or aborted in reverse order, as if
+    the function was wrapped in one :class:`ComponentInjector` per component,
+    but with a single wrapper frame. Components whose argument is already
+    present in the call are skipped.
+
+    If ``executor`` is a :class:`concurrent.futures.Executor`, the sessions
+    of distinct openers are opened concurrently on it. The sessions are still
+    created, and therefore bound to their openers, in the calling thread.
+    """
+
+    __slots__ = 'executor',
+
+    def __init__(self, ref, func, arg_kw, retry=None, executor=None):
+        ref = tuple(r if callable(r) else ComponentRef(r) for r in ref)
+        arg_kw = tuple(arg_kw)
+        if len(ref) != len(arg_kw):
+            raise ValueError("expected as many refs as arguments")
+        self.func = func
+        self.ref = ref
+        self.arg_kw = arg_kw
+        self.retry = retry
+        self.executor = executor
+
+    def copy(self, **kwargs):
+        kwargs.setdefault('executor', self.executor)
+        return super(MultiComponentInjector, self).copy(**kwargs)
+
+    def _bound(self, func, ref):
+        bound = super(MultiComponentInjector, self)._bound(func, ref)
+        bound.executor = self.executor
+        return bound
+
+    def _bind_ref(self, obj, owner):
+        return tuple(r.__get__(obj, owner) if hasattr(r, '__get__') else r
+                     for r in self.ref)
+
+    def _open_concurrently(self, sessions):
+        futures = [self.executor.submit(session.open)
+                   for session in sessions[1:]]
+        error = None
+        instances = []
+        opened = []
+        try:
+            instances.append(sessions[0].open())
+            opened.append(sessions[0])
+        except BaseException:
+            error = sys.exc_info()
+        for session, future in zip(sessions[1:], futures):
+            try:
+                instances.append(future.result())
+                opened.append(session)
+            except BaseException:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            _end_sessions(opened, error)
+            from . import six
+            six.reraise(*error)
+        return instances
+
+    def _call_injected(self, *args, **kwargs):
+        sessions = []
+        if self.executor is None:
+            try:
+                for arg_kw, ref in zip(self.arg_kw, self.ref):
+                    if arg_kw not in kwargs:
+                        session = ref()
+                        kwargs[arg_kw] = session.open()
+                        sessions.append(session)
+            except BaseException:
+                _end_sessions(sessions, sys.exc_info())
+                raise
+        else:
+            arg_kws = []
+            for arg_kw, ref in zip(self.arg_kw, self.ref):
+                if arg_kw not in kwargs:
+                    arg_kws.append(arg_kw)
+                    sessions.append(ref())
+            openers = set(id(getattr(session, 'instance_opener', session))
+                          for session in sessions)
+            if len(openers) == len(sessions) > 1:
+                instances = self._open_concurrently(sessions)
+            else:
+                # sessions sharing an opener must be opened in order
+                instances = []
+                try:
+                    for session in sessions:
+                        instances.append(session.open())
+                except BaseException:
+                    _end_sessions(sessions[:len(instances)], sys.exc_info())
+                    raise
+            kwargs.update(zip(arg_kws, instances))
+        try:
+            result = self.func(*args, **kwargs)
+        except BaseException:
+            _end_sessions(sessions, sys.exc_info())
+            raise
+        _end_sessions(sessions, None)
+        return result
+
+    def __call__(self, *args, **kwargs):
+        for arg_kw in self.arg_kw:
+            if arg_kw not in kwargs:
+                break
+        else:
+            return self.func(*args, **kwargs)
+        if self.retry is not None and \
+                not any(_in_session(ref) for ref in self.ref):
+            return self.retry.call(self._call_injected, *args, **kwargs)
+        return self._call_injected(*args, **kwargs)
+
+def _in_session(ref):
+    # true if a session of ref would be nested in one that is already open
+    # (see SessionFactory.in_session), whose transaction cannot be retried;
+    # looked up on the type, so that arbitrary callables never match
+    if isinstance(ref, ComponentRef):
+        ref = ref.resolve()
+    in_session = getattr(type(ref), 'in_session', None)
+    return in_session is not None and in_session(ref)
+
+def _end_sessions(sessions, exc_info):
+    # commit or abort sessions in reverse order, like nested with blocks: once
+    # a session fails to commit, the remaining sessions are aborted
+    error = None
+    for session in reversed(sessions):
+        try:
+            if exc_info is None and error is None:
+                session.commit()
+            else:
+                session.abort()
+        except BaseException:
+            error = sys.exc_info()
+    if error is not None:
+        from . import six
+        six.reraise(*error)
+
+_ABSENT = object()
+
+_COMPILED_TEMPLATE = """
+def _sesspy_make(_sesspy_func, _sesspy_ref, _sesspy_retry, _sesspy_absent,
+                 _sesspy_defaults, _sesspy_in_session):
+    %(unpack_defaults)s
+    def _sesspy_injected(%(params)s):
+        if %(given)s:
+            return _sesspy_func(%(call)s)
+        _sesspy_session = _sesspy_ref()
+        %(inject)s = _sesspy_session.open()
+        try:
+            _sesspy_result = _sesspy_func(%(call)s)
+        except:
+            _sesspy_session.abort()
+            raise
+        _sesspy_session.commit()
+        return _sesspy_result
+    def _sesspy_retried(%(params)s):
+        if %(given)s:
+            return _sesspy_func(%(call)s)
+        if _sesspy_in_session(_sesspy_ref):
+            return _sesspy_injected(%(call)s)
+        return _sesspy_retry.call(_sesspy_injected, %(call)s)
+    if _sesspy_retry is None:
+        return _sesspy_injected
+    return _sesspy_retried
+"""
+
+def compile_injector(ref, func, arg_kw, retry=None):
+    """
+    Build a wrapper function with the same signature as ``func`` that injects
+    a session for ``ref`` like :class:`ComponentInjector`.
+
+    The wrapper is generated and compiled once, so calls do not go through
+    ``*args``/``**kwargs`` packing or a context manager, and the wrapper
+    rejects arguments exactly like ``func`` does. ``arg_kw`` must name a
+    parameter of ``func``, or ``func`` must accept ``**kwargs``.
+
+    As the wrapper is a plain function, the ref is not rebound per instance
+    when it is used as a method.
+    """
+    from inspect import signature as _signature, Parameter as _Parameter
+    if not callable(ref):
+        ref = ComponentRef(ref)
+    params = list(_signature(func).parameters.values())
+    for param in params:
+        if param.name.startswith('_sesspy_'):
+            raise ValueError("parameter name %r is reserved" % param.name)
+
+    names = [param.name for param in params
+             if param.kind not in (_Parameter.VAR_POSITIONAL,
+                                   _Parameter.VAR_KEYWORD)]
+    varkw = [param.name for param in params
+             if param.kind == _Parameter.VAR_KEYWORD]
+    if arg_kw in names:
+        given = '%s is not _sesspy_absent' % arg_kw
+        inject = arg_kw
+    elif varkw:
+        given = '%r in %s' % (arg_kw, varkw[0])
+        inject = '%s[%r]' % (varkw[0], arg_kw)
+    else:
+        raise ValueError("%r does not accept the argument %r"
+                         % (func, arg_kw))
+
+    defaults = []
+    decl, call = [], []
+    kwonly_marker = posonly_marker = False
+    for param in params:
+        name = param.name
+        if param.kind == _Parameter.POSITIONAL_ONLY:
+            posonly_marker = True
+        elif posonly_marker:
+            decl.append('/')
+            posonly_marker = False
+        if param.kind == _Parameter.KEYWORD_ONLY and not kwonly_marker:
+            decl.append('*')
+            kwonly_marker = True
+
+        if param.kind == _Parameter.VAR_POSITIONAL:
+            decl.append('*' + name)
+            call.append('*' + name)
+            kwonly_marker = True
+            continue
+        elif param.kind == _Parameter.VAR_KEYWORD:
+            decl.append('**' + name)
+            call.append('**' + name)
+            continue
+
+        if name == arg_kw:
+            decl.append('%s=_sesspy_absent' % name)
+        elif param.default is not _Parameter.empty:
+            decl.append('%s=_sesspy_default_%d' % (name, len(defaults)))
+            defaults.append(param.default)
+        elif param.kind != _Parameter.KEYWORD_ONLY and (
+                arg_kw in names[:names.index(name)]):
+            raise ValueError("%r must be a keyword-only argument or be"
+                             " followed by arguments with defaults" % arg_kw)
+        else:
+            decl.append(name)
+
+        if param.kind == _Parameter.KEYWORD_ONLY:
+            call.append('%s=%s' % (name, name))
+        else:
+            call.append(name)
+    if posonly_marker:
+        decl.append('/')
+
+    unpack = ''.join('_sesspy_default_%d = _sesspy_defaults[%d]\n    ' % (i, i)
+                     for i in range(len(defaults)))
+    source = _COMPILED_TEMPLATE % dict(
+        unpack_defaults=unpack,
+        params=', '.join(decl),
+        call=', '.join(call),
+        given=given,
+        inject=inject,
+    )
+    namespace = {}
+    filename = '<sesspy injector for %s>' % getattr(
+        func, '__qualname__', getattr(func, '__name__', '?'))
+    exec(compile(source, filename, 'exec'), namespace)
+    wrapper = namespace['_sesspy_make'](func, ref, retry, _ABSENT, defaults,
+                                        _in_session)
+    return functools.update_wrapper(wrapper, func)
+
+def with_component(ref, arg=None, injector=None, retry=None, compiled=False):
     """
     Helper to wrap a function in a ComponentInjector.
+
+    If ``retry`` is not ``None``, it is passed on to the injector as a retry
+    policy.
+
+    If ``compiled`` is true and no injector is given, plain functions are
+    wrapped with :func:`compile_injector` instead.
+
+    If no injector is given, coroutine functions are wrapped in an
+    :class:`.AsyncComponentInjector` instead, so that the session is opened and
+    closed without blocking the event loop.
     """
     if arg is None:
-        if isinstance(ref, six.string_types) and '.' not in ref:
+        if isinstance(ref, _string_types) and '.' not in ref:
             arg = ref
         else:
             raise ValueError("arg must not be None unless ref"
                              " is a registry reference")
+    kwargs = {}
+    if retry is not None:
+        kwargs['retry'] = retry
+    def decorator(func):
+        if injector is not None:
+            return injector(ref, func, arg, **kwargs)
+        elif _iscoroutinefunction(func):
+            from .aio import AsyncComponentInjector
+            return AsyncComponentInjector(ref, func, arg, **kwargs)
+        elif compiled and _has_signature():
+            return compile_injector(ref, func, arg, **kwargs)
+        else:
+            return ComponentInjector(ref, func, arg, **kwargs)
+    return decorator
+
+def with_components(*mapping, **refs):
+    """
+    with_components([mapping], retry=None, executor=None, **refs)
+
+    Helper to wrap a function in a :class:`MultiComponentInjector`, injecting
+    a session for each keyword argument, e.g.
+    ``with_components(db='example_db', cache='cache')``.
+
+    The components may also be given as a mapping of argument names to
+    references, e.g. to inject arguments named ``retry`` or ``executor``,
+    which are otherwise taken as options:
+    ``with_components({'db': 'example_db', 'executor': 'jobs'}, retry=policy)``.
+
+    Sessions are opened in order (the mapping's, then keyword order) and ended
+    in reverse order. If ``executor`` is given, sessions are opened
+    concurrently on it. For coroutine functions, one
+    :class:`.AsyncComponentInjector` is stacked per component instead.
+    """
+    retry = refs.pop('retry', None)
+    executor = refs.pop('executor', None)
+    if len(mapping) > 1:
+        raise TypeError("with_components() takes at most one mapping of "
+                        "components (%d given)" % len(mapping))
+    if mapping:
+        arg_kws = list(mapping[0])
+        for arg_kw in refs:
+            if arg_kw in mapping[0]:
+                raise TypeError("component %r given twice" % (arg_kw,))
+        arg_kws.extend(refs)
+        refs.update(mapping[0])
+    else:
+        arg_kws = list(refs)
+    if not refs:
+        raise ValueError("no components given")
     def decorator(func):
-        return injector(ref, func, arg)
+        if _iscoroutinefunction(func):
+            from .aio import AsyncComponentInjector
+            for arg_kw in reversed(arg_kws):
+                func = AsyncComponentInjector(
+                    refs[arg_kw], func, arg_kw,
+                    retry=retry if arg_kw == arg_kws[0] else None,
+                )
+            return func
+        return MultiComponentInjector(
+            [refs[arg_kw] for arg_kw in arg_kws], func, arg_kws,
+            retry=retry, executor=executor,
+        )
     return decorator
@@ -18,42 +18,279 @@
 
 from __future__ import absolute_import, with_statement
 
+import os
+import sys
+import weakref
+import warnings
+from contextlib import contextmanager
+from threading import local as _thread_local
+
 try:
-    # python 2.6+
-    from threading import current_thread
+    # python 3.3+
+    from threading import get_ident as _get_ident
 except ImportError:
-    # python 2.5
-    from threading import currentThread as current_thread
+    from thread import get_ident as _get_ident
 
 try:
-    # python 2.6+
-    from collections import MutableMapping as _dict_base
+    # python 3.3+
+    from collections.abc import MutableMapping as _dict_base
 except ImportError:
-    # python 2.5
-    from UserDict import DictMixin as _dict_base
+    from collections import MutableMapping as _dict_base
+
+class ThreadScope(object):
+    """
+    Scope provider storing values per thread.
+
+    This is the default scope for :class:`Local` and :class:`LocalDict`,
+    which store their values directly in a :class:`threading.local` when
+    using it.
+    """
+
+    copy_on_write = False
+
+    def __init__(self):
+        self.storage = _thread_local()
+
+    def get(self, key):
+        return self.storage.__dict__.get(key)
+
+    def set(self, key, value):
+        self.storage.__dict__[key] = value
+
+def _current_owner():
+    # the running asyncio task, or else the current thread
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is not None:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            # no running event loop
+            task = None
+        if task is not None:
+            return task
+    return _get_ident()
+
+class ContextVarScope(object):
+    """
+    Scope provider storing values in a :class:`contextvars.ContextVar`, e.g.
+    per asyncio task.
+
+    Following the semantics of context variables, values set before a task is
+    created are visible in that task, but values set within a task are not
+    visible outside of it.
+
+    If ``inherit`` is false, values are only visible to the task (or, outside
+    of tasks, the thread) that set them, so that each task starts out empty.
+    """
+
+    copy_on_write = True
+
+    def __init__(self, name=None, inherit=True):
+        import contextvars
+        self.var = contextvars.ContextVar(
+            name or '%s.%s<%s>' % (__name__, type(self).__name__, id(self))
+        )
+        self.inherit = inherit
+
+    def _own_values(self):
+        # the values set by the current owner; the owner is kept as a weak
+        # reference if it is a task, which the values must not keep alive
+        owner, values = self.var.get((None, {}))
+        current = _current_owner()
+        if isinstance(owner, weakref.ref):
+            owner = owner()
+        if owner == current:
+            return values
+        return {}
+
+    def get(self, key):
+        if self.inherit:
+            return self.var.get({}).get(key)
+        return self._own_values().get(key)
+
+    def set(self, key, value):
+        if self.inherit:
+            values = self.var.get({}).copy()
+            values[key] = value
+            self.var.set(values)
+            return
+        values = self._own_values().copy()
+        values[key] = value
+        owner = _current_owner()
+        if not isinstance(owner, int):
+            owner = weakref.ref(owner)
+        self.var.set((owner, values))
+
+class GreenletScope(object):
+    """
+    Scope provider storing values per greenlet, e.g. for gevent or eventlet.
+    """
+
+    copy_on_write = False
+
+    def __init__(self):
+        from greenlet import getcurrent
+        self.getcurrent = getcurrent
+
+    def get(self, key):
+        return self.getcurrent().__dict__.get(key)
+
+    def set(self, key, value):
+        self.getcurrent().__dict__[key] = value
+
+class RequestScope(object):
+    """
+    Scope provider for explicitly pushed scopes, e.g. one per request.
+
+    Scopes are pushed and popped using :meth:`push` and :meth:`pop`, or using
+    the :meth:`scope` context manager. The stack of pushed scopes is itself
+    kept in the ``parent`` scope (by default, per thread). If no scope has been
+    pushed, values are stored in the parent scope.
+    """
 
-# explicit object inheritence as DictMixin is an old-style class
-class LocalDict(_dict_base, object):
-    __slots__ = '_local__key', '_local__init'
+    copy_on_write = False
+
+    def __init__(self, parent=None):
+        if parent is None:
+            parent = default_scope
+        self.parent = parent
+        self.key = '%s.%s<%s>' % (__name__, type(self).__name__, id(self))
+
+    def _stack(self):
+        return self.parent.get(self.key) or ()
+
+    def push(self):
+        """
+        Push a new, empty scope and return its storage dict.
+        """
+        storage = {}
+        self.parent.set(self.key, self._stack() + (storage,))
+        return storage
+
+    def pop(self):
+        """
+        Pop the innermost scope and return its storage dict.
+        """
+        stack = self._stack()
+        if not stack:
+            raise IndexError("pop from empty scope stack")
+        self.parent.set(self.key, stack[:-1])
+        return stack[-1]
+
+    @contextmanager
+    def scope(self):
+        """
+        Context manager pushing a scope on entry and popping it on exit.
+        """
+        storage = self.push()
+        try:
+            yield storage
+        finally:
+            self.pop()
+
+    def get(self, key):
+        stack = self._stack()
+        if not stack:
+            return self.parent.get(key)
+        return stack[-1].get(key)
+
+    def set(self, key, value):
+        stack = self._stack()
+        if not stack:
+            self.parent.set(key, value)
+        else:
+            stack[-1][key] = value
+
+default_scope = ThreadScope()
+
+fork_generation = 0
+"""
+The number of times the current process has been forked from its original
+ancestor, i.e. incremented in the child after each fork.
+"""
+
+# objects with an _after_fork method, which is called in the child process
+_fork_aware = weakref.WeakSet()
+
+# objects inherited from the parent process that must neither be closed nor
+# garbage collected in the child, e.g. connections still used by the parent
+_inherited_from_parent = []
+
+def _after_fork_in_child():
+    global fork_generation
+    fork_generation += 1
+    for obj in list(_fork_aware):
+        try:
+            obj._after_fork()
+        except Exception:
+            exc = sys.exc_info()[1]
+            warnings.warn("An exception was raised while resetting %r after"
+                          " fork: %s" % (obj, exc))
+
+if hasattr(os, 'register_at_fork'):
+    # python 3.7+
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+class LocalDict(_dict_base):
+    """
+    A dict whose contents are local to the current scope.
+
+    The arguments are those of :class:`dict`, giving the initial contents.
+    Each scope starts out sharing them, and copies them on its first write.
+
+    :param scope: A scope provider, see :class:`Local`. Keyword only.
+    """
+
+    __slots__ = '_local__key', '_local__init', '_local__scope', '_local__thread'
 
     def __init__(self, *args, **kwargs):
+        # keyword-only, in a way python 2 understands
+        scope = kwargs.pop('scope', None)
         self._local__key = '%s.%s<%s>' % (
             __name__, type(self).__name__, str(id(self))
         )
         self._local__init = dict(*args, **kwargs)
+        if scope is None:
+            scope = default_scope
+        self._local__scope = scope
+        # with a thread scope, keep the dict in a threading.local of our own,
+        # so accessing it is a single C-level attribute lookup
+        if type(scope) is ThreadScope:
+            self._local__thread = _thread_local()
+        else:
+            self._local__thread = None
 
     def _get_dict(self):
-        res = current_thread().__dict__.get(self._local__key)
+        thread = self._local__thread
+        if thread is not None:
+            try:
+                return thread.dict
+            except AttributeError:
+                # share init until the first write, see _getset_dict
+                res = thread.dict = self._local__init
+                return res
+        res = self._local__scope.get(self._local__key)
         return self._local__init if res is None else res
     def _getset_dict(self):
-        res = current_thread().__dict__.get(self._local__key)
-        if res is None:
-            res = self._local__init.copy()
-            current_thread().__dict__[self._local__key] = res
+        thread = self._local__thread
+        if thread is not None:
+            res = thread.__dict__.get('dict')
+            if res is None or res is self._local__init:
+                res = thread.dict = self._local__init.copy()
+            return res
+        scope = self._local__scope
+        res = scope.get(self._local__key)
+        if res is None or scope.copy_on_write:
+            res = (self._local__init if res is None else res).copy()
+            scope.set(self._local__key, res)
         return res
 
     def __getitem__(self, name):
-        return self._get_dict()[name]
+        try:
+            # fast path for thread scopes once a value has been set
+            return self._local__thread.dict[name]
+        except AttributeError:
+            return self._get_dict()[name]
     def __setitem__(self, name, value):
         self._getset_dict()[name] = value
     def __delitem__(self, name):
@@ -61,6 +298,11 @@ class LocalDict(_dict_base, object):
             del self._getset_dict()[name]
         else:
             del {}[name]
+    def get(self, name, default=None):
+        try:
+            return self._local__thread.dict.get(name, default)
+        except AttributeError:
+            return self._get_dict().get(name, default)
     def __len__(self):
         return len(self._get_dict())
     def __contains__(self, name):
@@ -73,20 +315,35 @@ class LocalDict(_dict_base, object):
         return self._get_dict().copy()
 
 class Local(object):
+    """
+    An object whose attributes are local to the current scope.
+
+    :param scope: A scope provider such as :class:`ThreadScope`,
+        :class:`ContextVarScope`, :class:`GreenletScope` or
+        :class:`RequestScope`. Defaults to :data:`default_scope`, i.e. per
+        thread.
+    """
+
     __slots__ = '_local__dict'
 
-    def __new__(cls):
+    def __new__(cls, scope=None):
         if cls != Local:
             raise TypeError("This class does not support inheritence")
 
         self = object.__new__(cls)
-        object.__setattr__(self, '_local__dict', LocalDict())
+        object.__setattr__(self, '_local__dict', LocalDict(scope=scope))
 
         return self
 
     def __getattribute__(self, name):
         attrdict = object.__getattribute__(self, '_local__dict')
 
+        try:
+            # fast path for thread scopes, see LocalDict.__getitem__
+            return attrdict._local__thread.dict[name]
+        except (AttributeError, KeyError):
+            pass
+
         try:
             # look up attribute
             return attrdict[name]
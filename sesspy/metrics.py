@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, with_statement
+
+import threading
+
+try:
+    # python 3.3+
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+class Histogram(object):
+    """
+    Histogram of durations with logarithmic buckets, in the style of HDR
+    histograms.
+
+    Durations are recorded in microseconds, keeping ``significant_bits``
+    significant bits (i.e. a relative error below
+    ``2 ** (1 - significant_bits)``, or about 1.6% for the default of 7
+    bits).
+    """
+
+    __slots__ = 'significant_bits', 'counts', 'count', 'total', 'min', 'max'
+
+    def __init__(self, significant_bits=7):
+        self.significant_bits = significant_bits
+        # bucket lower bound (in microseconds) -> count
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000)
+        shift = micros.bit_length() - self.significant_bits
+        bucket = (micros >> shift) << shift if shift > 0 else micros
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Return the (approximate) duration below which ``percent`` percent of
+        the recorded durations lie, or ``None`` if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return min(max(bucket / 1000000.0, self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+            mean=self.total / self.count if self.count else None,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            p999=self.percentile(99.9),
+        )
+
+class ComponentMetrics(object):
+    """
+    Latency histograms and counters for a single component.
+
+    Passed as ``metrics`` to :class:`.SessionFactory` and
+    :class:`.GuardedFactorySource`, the following durations are recorded:
+
+    - ``create_opener``: creating an opener (including the source)
+    - ``open``, ``commit``, ``abort``: the respective session calls
+    - ``held``: the time between opening and ending a session
+    - ``source_lock_wait``: waiting for a source's factory lock
+    - ``source_create``: creating a source's instance
+
+    Counters are kept for ``openers`` created, sessions ``opened``,
+    ``committed`` and ``aborted``, for failed calls (``open_failed``,
+    ``commit_failed``, ``abort_failed``), and for ``source_reloads``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, event, seconds):
+        with self.lock:
+            histogram = self.histograms.get(event)
+            if histogram is None:
+                histogram = self.histograms[event] = Histogram()
+            histogram.record(seconds)
+
+    def increment(self, counter, count=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                counters=dict(self.counters),
+                histograms=dict((event, histogram.snapshot())
+                                for event, histogram
+                                in self.histograms.items()),
+            )
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+class Metrics(object):
+    """
+    Collection of :class:`ComponentMetrics`, by component name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.components = {}
+
+    def component(self, name):
+        """
+        Return the :class:`ComponentMetrics` for ``name``, creating it if
+        needed.
+        """
+        with self.lock:
+            metrics = self.components.get(name)
+            if metrics is None:
+                metrics = self.components[name] = ComponentMetrics(name)
+            return metrics
+
+    def snapshot(self):
+        """
+        Return a dict mapping component names to a dict with the component's
+        ``counters`` and a summary of its ``histograms``.
+        """
+        with self.lock:
+            components = list(self.components.values())
+        return dict((metrics.name, metrics.snapshot())
+                    for metrics in components)
+
+    def reset(self):
+        with self.lock:
+            components = list(self.components.values())
+        for metrics in components:
+            metrics.reset()
+
+default_metrics = Metrics()
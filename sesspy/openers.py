@@ -16,21 +16,47 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
+import sys
+import threading
 import warnings
+from collections import deque, OrderedDict
+from .local import _fork_aware, _inherited_from_parent
+
+try:
+    # python 3.3+
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+try:
+    # python 3.3+
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
 
 class CountingOpenerBase(object):
-    def __init__(self, session_opener):
+    __slots__ = 'session_opener', 'count', 'session', 'savepoints'
+
+    def __init__(self, session_opener, savepoints=False):
         assert not issubclass(CountingOpenerBase, type(self)), \
                 "CountingOpenerBase is abstract"
         self.session_opener = session_opener
         self.count = 0
         self.session = None
+        if savepoints and hasattr(session_opener, 'savepoint'):
+            self.savepoints = []
+        else:
+            self.savepoints = None
 
     def open(self):
         if self.session is None:
             self.session = self.session_opener.open()
+        elif self.savepoints is not None and self.count > 0:
+            self.savepoints.append(
+                self.session_opener.savepoint(self.session)
+            )
         self.count += 1
         return self.session
 
@@ -42,6 +68,10 @@ class CountingOpenerBase(object):
             warnings.warn("Got commit for unrecognized session %r (expected %r)"
                           % (session, self.session))
         self.count -= 1
+        if self.savepoints and self.count > 0:
+            self.session_opener.release_savepoint(
+                self.session, self.savepoints.pop()
+            )
 
     def abort(self, session):
         if self.count <= 0:
@@ -51,13 +81,38 @@ class CountingOpenerBase(object):
             warnings.warn("Got abort for unrecognized session %r (expected %r)"
                           % (session, self.session))
         self.count -= 1
+        if self.savepoints and self.count > 0:
+            self.session_opener.rollback_savepoint(
+                self.session, self.savepoints.pop()
+            )
 
     def __nonzero__(self):
         return self.count > 0 or bool(self.session)
 
+    def _close_session_opener(self):
+        # only openers owned by this one, which opt in by setting
+        # close_with_opener on their class (e.g. StickyTransactionFactory,
+        # which keeps a connection between sessions); never shared ones such
+        # as a PoolingOpener, which other openers still use
+        opener_type = type(self.session_opener)
+        if getattr(opener_type, 'close_with_opener', False):
+            opener_type.close(self.session_opener)
+
 class CountingOpener(CountingOpenerBase):
-    def __init__(self, session_opener):
-        super(CountingOpener, self).__init__(session_opener)
+    """
+    Opener that shares a single session between nested opens, only
+    committing or aborting it when the outermost session ends.
+
+    If ``savepoints`` is true and the wrapped opener has ``savepoint``,
+    ``release_savepoint`` and ``rollback_savepoint`` methods, each nested open
+    creates a savepoint, which is released when the nested session is
+    committed and rolled back when it is aborted.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, session_opener, savepoints=False):
+        super(CountingOpener, self).__init__(session_opener, savepoints)
 
     def commit(self, session):
         super(CountingOpener, self).commit(session)
@@ -76,10 +131,15 @@ class CountingOpener(CountingOpenerBase):
             warnings.warn("Closing in-use session")
             self.session_opener.abort(self.session)
             self.session = None
+            if self.savepoints:
+                del self.savepoints[:]
+        self._close_session_opener()
 
 class LazyCountingOpener(CountingOpenerBase):
-    def __init__(self, session_opener):
-        super(LazyCountingOpener, self).__init__(session_opener)
+    __slots__ = ()
+
+    def __init__(self, session_opener, savepoints=False):
+        super(LazyCountingOpener, self).__init__(session_opener, savepoints)
 
     def abort(self, session):
         super(LazyCountingOpener, self).abort(session)
@@ -94,10 +154,427 @@ class LazyCountingOpener(CountingOpenerBase):
         elif self.session is not None:
             self.session_opener.commit(self.session)
         self.session = None
+        if self.savepoints:
+            del self.savepoints[:]
+        self._close_session_opener()
+
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled instance becomes available within the timeout.
+    """
+    pass
+
+_NEW_INSTANCE = object()
+
+class PoolingOpener(object):
+    """
+    Opener keeping a bounded pool of instances opened by ``session_opener``,
+    shared between threads.
+
+    Sessions are committed or aborted by the wrapped opener as usual, after
+    which the instance is returned to the pool. Instances of aborted sessions
+    are only returned if ``reset`` is given, and are discarded otherwise, as
+    they may be left in a failed state. Instances are discarded when the pool
+    is full or closed, or when found to be broken.
+
+    :param max_size: The number of idle instances kept in the pool.
+    :param max_overflow: The number of instances that may be in use in
+        addition to ``max_size``. A negative value means no limit.
+    :param timeout: Seconds to wait for an instance to be returned if
+        ``max_size + max_overflow`` instances are in use, before raising
+        :exc:`PoolTimeout`. ``None`` means waiting indefinitely.
+    :param lifo: If true, the most recently returned instance is reused first,
+        otherwise the least recently returned one.
+    :param pre_ping: If not ``None``, a callable that is passed an idle
+        instance before it is reused, and returns false (or raises) if the
+        instance is no longer usable.
+    :param reset: If not ``None``, a callable that is passed each instance as
+        it is returned to the pool, e.g. to discard uncommitted state.
+        Instances for which it raises are discarded.
+    :param close_instance: If not ``None``, a callable that is passed each
+        discarded instance, e.g. to close its connection.
+    """
+
+    __slots__ = (
+        'session_opener', 'max_size', 'max_overflow', 'timeout', 'lifo',
+        'pre_ping', 'reset', 'close_instance', 'idle', 'size', 'closed',
+        'cond',
+    )
+
+    def __init__(self, session_opener,
+                 max_size=5, max_overflow=10, timeout=30,
+                 lifo=True, pre_ping=None, reset=None, close_instance=None):
+        self.session_opener = session_opener
+        self.max_size = max_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.lifo = lifo
+        self.pre_ping = pre_ping
+        self.reset = reset
+        self.close_instance = close_instance
+        self.idle = deque()
+        # number of instances opened and not yet discarded
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def _checkout(self):
+        deadline = None
+        with self.cond:
+            while True:
+                if self.idle:
+                    if self.lifo:
+                        return self.idle.pop()
+                    return self.idle.popleft()
+                if (self.max_overflow < 0 or
+                        self.size < self.max_size + self.max_overflow):
+                    self.size += 1
+                    return _NEW_INSTANCE
+                if self.timeout is None:
+                    self.cond.wait()
+                    continue
+                if deadline is None:
+                    deadline = _clock() + self.timeout
+                remaining = deadline - _clock()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No instance available after %s seconds (pool size"
+                        " %d, overflow %d)"
+                        % (self.timeout, self.max_size, self.max_overflow)
+                    )
+                self.cond.wait(remaining)
+
+    def _release(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def _discard(self, instance):
+        try:
+            if self.close_instance is not None:
+                self.close_instance(instance)
+        finally:
+            self._release()
+
+    def _discard_quietly(self, instance):
+        try:
+            self._discard(instance)
+        except Exception:
+            exc = sys.exc_info()[1]
+            warnings.warn("An exception was raised while discarding a"
+                          " pooled instance: " + str(exc))
+
+    def _ping(self, instance):
+        try:
+            return self.pre_ping(instance)
+        except Exception:
+            return False
+
+    def open(self):
+        while True:
+            instance = self._checkout()
+            if instance is _NEW_INSTANCE:
+                try:
+                    return self.session_opener.open()
+                except:
+                    self._release()
+                    raise
+            if self.pre_ping is None or self._ping(instance):
+                return instance
+            self._discard_quietly(instance)
+
+    def _checkin(self, instance):
+        if self.reset is not None:
+            try:
+                self.reset(instance)
+            except Exception:
+                self._discard_quietly(instance)
+                return
+        with self.cond:
+            if not self.closed and len(self.idle) < self.max_size:
+                self.idle.append(instance)
+                self.cond.notify()
+                return
+        self._discard(instance)
+
+    def commit(self, instance):
+        try:
+            self.session_opener.commit(instance)
+        except:
+            self._discard_quietly(instance)
+            raise
+        self._checkin(instance)
+
+    def abort(self, instance):
+        try:
+            self.session_opener.abort(instance)
+        except:
+            self._discard_quietly(instance)
+            raise
+        if self.reset is None:
+            self._discard(instance)
+        else:
+            self._checkin(instance)
+
+    def close(self):
+        """
+        Discard all idle instances, and any instances returned from now on.
+        """
+        with self.cond:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+        for instance in idle:
+            self._discard_quietly(instance)
+
+def shared_opener(opener_factory):
+    """
+    Return an opener factory that applies ``opener_factory`` once, and returns
+    the resulting opener for all openers it is applied to.
+
+    This allows openers shared between threads to be used as a
+    :class:`.SessionFactory`'s ``opener_factory``. The shared opener is created
+    for the first opener passed to the factory, so all openers should share
+    the same source (e.g. by using a :class:`.GuardedFactorySource`).
+
+    After a fork, the child process creates its own shared opener. The one
+    inherited from the parent is kept alive but never used or closed.
+
+    When the source of a :class:`.SessionFactory` using the factory is
+    reloaded, it calls the factory's ``source_reloaded`` function, after which
+    a new shared opener is created for the new source. The previous one is
+    closed, if it has a ``close`` method, once it is replaced; sessions still
+    open on it end as usual.
+    """
+    locks = [threading.Lock()]
+    shared = []
+    def factory(session_opener):
+        if not shared:
+            with locks[0]:
+                if not shared:
+                    shared.append(opener_factory(session_opener))
+        return shared[0]
+    def source_reloaded():
+        with locks[0]:
+            previous = shared[:]
+            del shared[:]
+        for opener in previous:
+            close = getattr(opener, 'close', None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception:
+                exc = sys.exc_info()[1]
+                warnings.warn("An exception was raised while closing a "
+                              "shared opener: " + str(exc))
+    def after_fork():
+        locks[0] = threading.Lock()
+        _inherited_from_parent.extend(shared)
+        del shared[:]
+    factory.source_reloaded = source_reloaded
+    factory._after_fork = after_fork
+    _fork_aware.add(factory)
+    return factory
+
+def pooling_opener(**options):
+    """
+    Return a :func:`shared_opener` factory for a :class:`PoolingOpener` with
+    the given keyword arguments.
+    """
+    return shared_opener(lambda opener: PoolingOpener(opener, **options))
+
+class GroupCommitAborted(Exception):
+    """
+    Raised from a commit when another session in the same group was aborted.
+    """
+    pass
+
+class _CommitGroup(object):
+    __slots__ = (
+        'instance', 'active', 'pending', 'deadline', 'sealed', 'aborted',
+        'leader_elected', 'done', 'exception',
+    )
+
+    def __init__(self, instance):
+        self.instance = instance
+        # sessions opened and not yet committed or aborted
+        self.active = 0
+        # sessions waiting for their commit
+        self.pending = 0
+        self.deadline = None
+        self.sealed = False
+        self.aborted = False
+        self.leader_elected = False
+        self.done = False
+        self.exception = None
+
+class GroupCommitOpener(object):
+    """
+    Opener that coalesces the commits of concurrent sessions into a single
+    commit of the wrapped ``session_opener``.
+
+    Sessions opened concurrently join a group sharing one instance, which must
+    therefore be safe to use from several threads. A group stops accepting
+    new sessions once ``max_batch`` sessions have committed, or ``window``
+    seconds after the first session committed. Its instance is committed once
+    all of its sessions have ended, and each ``commit`` call blocks until then.
+
+    Aborting any session aborts the whole group, and the other sessions'
+    commits raise :exc:`GroupCommitAborted`.
+
+    A session committed while its thread still has other sessions open in the
+    same group (e.g. nested sessions) does not wait, as the group cannot end
+    before those do; like a nested session of a :class:`CountingOpener`, it
+    is committed along with the outermost one.
+    """
+
+    __slots__ = 'session_opener', 'max_batch', 'window', 'cond', 'group', \
+                'groups', 'threads'
+
+    def __init__(self, session_opener, max_batch=64, window=0.002):
+        self.session_opener = session_opener
+        self.max_batch = max_batch
+        self.window = window
+        self.cond = threading.Condition()
+        # the group accepting new sessions
+        self.group = None
+        # all unfinished groups, by id, oldest first
+        self.groups = OrderedDict()
+        # thread ident -> groups of the sessions the thread has open, in
+        # order; the instances alone cannot tell the groups apart, as the
+        # wrapped opener may return the same instance every time
+        self.threads = {}
+
+    def open(self):
+        with self.cond:
+            group = self.group
+            if group is None:
+                group = _CommitGroup(self.session_opener.open())
+                self.group = group
+                self.groups[id(group)] = group
+            group.active += 1
+            self.threads.setdefault(_get_ident(), []).append(group)
+            return group.instance
+
+    def _take(self, instance):
+        # called with the lock held; returns the group of the session being
+        # ended, and whether its thread has other sessions in that group
+        ident = _get_ident()
+        groups = self.threads.get(ident, ())
+        for i in range(len(groups) - 1, -1, -1):
+            # the innermost session of this thread with that instance
+            if groups[i].instance is instance:
+                group = groups.pop(i)
+                if not groups:
+                    del self.threads[ident]
+                return group, group in groups
+        # ended in another thread than the one that opened it
+        for group in self.groups.values():
+            if group.instance is instance and group.active > 0:
+                break
+        else:
+            raise KeyError("Unknown session instance %r" % (instance,))
+        for owner, groups in self.threads.items():
+            if group in groups:
+                groups.remove(group)
+                if not groups:
+                    del self.threads[owner]
+                break
+        return group, False
+
+    def _seal(self, group):
+        group.sealed = True
+        if self.group is group:
+            self.group = None
+
+    def _finish(self, group):
+        # called with the lock held; returns True if the caller must end the
+        # group by committing or aborting its instance
+        while not group.done:
+            if group.sealed and group.active == 0:
+                if not group.leader_elected:
+                    group.leader_elected = True
+                    return True
+                self.cond.wait()
+            elif group.sealed:
+                self.cond.wait()
+            else:
+                remaining = group.deadline - _clock()
+                if remaining <= 0:
+                    self._seal(group)
+                else:
+                    self.cond.wait(remaining)
+        return False
+
+    def _end(self, group):
+        try:
+            if group.aborted:
+                self.session_opener.abort(group.instance)
+            else:
+                self.session_opener.commit(group.instance)
+        except Exception:
+            group.exception = sys.exc_info()[1]
+        with self.cond:
+            group.done = True
+            del self.groups[id(group)]
+            self.cond.notify_all()
+
+    def commit(self, instance):
+        with self.cond:
+            group, nested = self._take(instance)
+            group.active -= 1
+            group.pending += 1
+            if group.deadline is None:
+                group.deadline = _clock() + self.window
+            if group.pending >= self.max_batch:
+                self._seal(group)
+            self.cond.notify_all()
+            if nested:
+                # waiting would deadlock on this thread's own sessions
+                return
+            leader = self._finish(group)
+        if leader:
+            self._end(group)
+        if group.exception is not None:
+            raise group.exception
+        if group.aborted:
+            raise GroupCommitAborted("Another session in the commit group"
+                                     " was aborted")
+
+    def abort(self, instance):
+        with self.cond:
+            group = self._take(instance)[0]
+            group.active -= 1
+            group.aborted = True
+            self._seal(group)
+            # the last session to end the group aborts it, but there is no
+            # need to wait for the others otherwise
+            leader = group.active == 0 and not group.leader_elected
+            group.leader_elected = group.leader_elected or leader
+            self.cond.notify_all()
+        if leader:
+            self._end(group)
+            if group.exception is not None:
+                raise group.exception
+
+def group_commit_opener(**options):
+    """
+    Return a :func:`shared_opener` factory for a :class:`GroupCommitOpener`
+    with the given keyword arguments.
+    """
+    return shared_opener(lambda opener: GroupCommitOpener(opener, **options))
 
 def combine_openers(*openers):
     def factory(start):
         for opener in openers:
             start = opener(start)
         return start
+    def source_reloaded():
+        # e.g. for shared openers
+        for opener in openers:
+            source_reloaded = getattr(opener, 'source_reloaded', None)
+            if source_reloaded is not None:
+                source_reloaded()
+    factory.source_reloaded = source_reloaded
     return factory
@@ -19,7 +19,18 @@
 from __future__ import absolute_import
 
 import sys
-from . import six
+
+try:
+    # python 3.3+
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+try:
+    _string_types = basestring
+except NameError:
+    # python 3
+    _string_types = str
 
 class ResolveError(LookupError):
     """
@@ -27,6 +38,62 @@ class ResolveError(LookupError):
     """
     pass
 
+class ResolutionCache(object):
+    """
+    Cache of resolved string refs, shared by all :class:`ComponentRef`
+    objects using the same registry.
+
+    Failed resolutions are cached for ``negative_ttl`` seconds. Cached
+    import-path refs are resolved again if the module they were found in is
+    replaced in ``sys.modules``, e.g. by a reload.
+    """
+
+    def __init__(self, negative_ttl=5.0):
+        self.negative_ttl = negative_ttl
+        # ref -> (resolved, error, expiry, module name, module)
+        self.entries = {}
+
+    def resolve(self, ref, resolver):
+        """
+        Return the cached resolution of ``ref``, or call ``resolver`` to
+        resolve it and cache the result.
+        """
+        entry = self.entries.get(ref)
+        if entry is not None:
+            resolved, error, expires, modname, module = entry
+            if modname is None or sys.modules.get(modname) is module:
+                if error is None:
+                    return resolved
+                elif expires > _clock():
+                    raise ResolveError(error)
+
+        modname = ref.rsplit('.', 1)[0] if '.' in ref else None
+        try:
+            resolved = resolver()
+        except ResolveError:
+            exc = sys.exc_info()[1]
+            self.entries[ref] = (
+                None, str(exc), _clock() + self.negative_ttl,
+                modname, modname and sys.modules.get(modname),
+            )
+            raise
+        self.entries[ref] = (
+            resolved, None, None,
+            modname, modname and sys.modules.get(modname),
+        )
+        return resolved
+
+    def clear(self):
+        self.entries.clear()
+
+_registry = []
+
+def _default_registry():
+    if not _registry:
+        from .registry import default_registry
+        _registry.append(default_registry)
+    return _registry[0]
+
 class ComponentRef(object):
     """
     Reference wrapper for lazy loading of components.
@@ -42,12 +109,13 @@ class ComponentRef(object):
     When a refernce cannot be resolved, a ResolveError is raised.
     """
 
+    __slots__ = 'ref', 'name', 'reg', 'obj'
+
     def __init__(self, ref, name=None, reg=None, obj=None):
         self.ref = ref
         self.name = name
         if reg is None:
-            from .registry import default_registry
-            reg = default_registry
+            reg = _default_registry()
         self.reg = reg
         self.obj = obj
 
@@ -109,13 +177,8 @@ class ComponentRef(object):
             # otherwise add to obj's __dict__
             obj.__dict__[self.dictkey] = ref
 
-    def resolve(self, obj=None):
-        if obj is not None and obj is not self.obj:
-            return self.__get__(obj).resolve()
-
-        if callable(self.ref):
-            resolved = self.ref
-        elif isinstance(self.ref, six.string_types) and '.' in self.ref:
+    def _resolve_string(self):
+        if '.' in self.ref:
             try:
                 _imp, _from = self.ref.rsplit('.', 1)
                 _temp = __import__(_imp, fromlist=[_from])
@@ -125,14 +188,16 @@ class ComponentRef(object):
                 exc = sys.exc_info()[1]
                 exc = ResolveError("Failed to import ref %r: %s"
                                    % (self.ref, exc))
+                from . import six
                 six.reraise(ResolveError, exc, sys.exc_info()[2])
-        elif isinstance(self.ref, six.string_types) and self.reg is not None:
+        elif self.reg is not None:
             try:
                 resolved = self.reg[self.ref]
             except KeyError:
                 exc = sys.exc_info()[1]
                 exc = ResolveError("Failed to lookup ref %r: %s"
                                  % (self.ref, exc))
+                from . import six
                 six.reraise(ResolveError, exc, sys.exc_info()[2])
             if hasattr(resolved, 'resolve'):
                 # in case of reference-to-reference, try "transitive" resolve
@@ -143,6 +208,23 @@ class ComponentRef(object):
         if not callable(resolved):
             raise ResolveError("Component ref %r does not resolve to"
                                " a session factory" % self.ref)
+        return resolved
+
+    def resolve(self, obj=None):
+        if obj is not None and obj is not self.obj:
+            return self.__get__(obj).resolve()
+
+        if callable(self.ref):
+            resolved = self.ref
+        elif isinstance(self.ref, _string_types):
+            cache = getattr(self.reg, 'resolution_cache', None)
+            if cache is None:
+                resolved = self._resolve_string()
+            else:
+                resolved = cache.resolve(self.ref, self._resolve_string)
+        else:
+            raise ResolveError("Component ref %r does not resolve to"
+                               " a session factory" % self.ref)
         self.ref = resolved
 
         return resolved
@@ -18,19 +18,51 @@
 
 from __future__ import absolute_import
 
-from .ref import ComponentRef
+import sys
+from .ref import ComponentRef, ResolutionCache, _string_types
+
+try:
+    # python 3.3+
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
 
 class DuplicateComponentError(Exception):
     pass
 
+class WarmupError(Exception):
+    """
+    Raised by :meth:`ComponentRegistry.warmup` if any component failed to warm
+    up.
+
+    ``errors`` maps the names of the failed components to their exceptions
+    (or, for components whose dependencies failed, to another
+    :exc:`WarmupError`), and ``timings`` holds the timings of the components
+    that were warmed up.
+    """
+
+    def __init__(self, errors, timings):
+        Exception.__init__(self, "Failed to warm up components: %s"
+                           % ", ".join(sorted(errors)))
+        self.errors = errors
+        self.timings = timings
+
 class ComponentRegistry(object):
     """
     Simple component registry. Retrieved components are wrapped in a
     ComponentRef for easier use.
+
+    The ComponentRef objects returned are cached and shared between callers,
+    as are the resolutions of string refs using this registry (see
+    :class:`.ResolutionCache`). Failed resolutions are cached for
+    ``negative_ttl`` seconds, or until another component is registered.
     """
 
-    def __init__(self):
+    def __init__(self, negative_ttl=5.0):
         self.components = {}
+        self.component_refs = {}
+        self.name_refs = {}
+        self.resolution_cache = ResolutionCache(negative_ttl)
 
     def register_component(self, name, component):
         if name in self.components:
@@ -38,12 +70,141 @@ class ComponentRegistry(object):
                 "Component with name %s already registered" % name
             )
         self.components[name] = component
+        self.resolution_cache.clear()
         return component
 
     def __getitem__(self, name):
-        return ComponentRef(self.components[name], reg=self)
+        try:
+            return self.component_refs[name]
+        except KeyError:
+            ref = ComponentRef(self.components[name], reg=self)
+            return self.component_refs.setdefault(name, ref)
 
     def get(self, name):
-        return ComponentRef(name, reg=self)
+        try:
+            return self.name_refs[name]
+        except KeyError:
+            return self.name_refs.setdefault(name, ComponentRef(name, reg=self))
+
+    def dependencies(self, name):
+        """
+        Return the set of names of the registered components that the
+        component registered as ``name`` refers to, through (possibly nested)
+        :class:`.ComponentRef` objects, registry keys, or the registered
+        components themselves.
+        """
+        names = dict((id(component), other)
+                     for other, component in self.components.items())
+        deps = set()
+        component = self.components[name]
+        while True:
+            if isinstance(component, ComponentRef):
+                component = component.ref
+            elif isinstance(component, _string_types):
+                if component in self.components:
+                    deps.add(component)
+                break
+            else:
+                if component is not self.components[name] and \
+                        id(component) in names:
+                    deps.add(names[id(component)])
+                break
+        deps.discard(name)
+        return deps
+
+    def _warmup_component(self, name, open_sessions):
+        start = _clock()
+        component = self[name].resolve()
+        warmup = getattr(component, 'warmup', None)
+        if warmup is not None:
+            warmup()
+        if open_sessions:
+            with component():
+                pass
+        return _clock() - start
+
+    def warmup(self, names=None, open_sessions=False, max_workers=None,
+               dependencies=None):
+        """
+        Eagerly initialize registered components on a thread pool, e.g. to
+        create engines and connection pools before serving requests.
+
+        Components are warmed up after the components they depend on (see
+        :meth:`dependencies`), and independent components in parallel. Each
+        component's ref is resolved and its ``warmup`` method is called if it
+        has one (see :meth:`.SessionFactory.warmup`). If ``open_sessions`` is
+        true, one session is also opened and committed to prime pools.
+
+        :param names: The names of the components to warm up, including their
+            dependencies. Defaults to all registered components.
+        :param max_workers: The size of the thread pool.
+        :param dependencies: A dict mapping component names to additional
+            names of components they depend on.
+        :returns: A dict mapping component names to the seconds taken to warm
+            them up.
+        :raises WarmupError: if any component failed to warm up. The other
+            components are still warmed up, except those depending on the
+            failed components.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+                FIRST_COMPLETED
+
+        graph = {}
+        pending = list(self.components if names is None else names)
+        while pending:
+            name = pending.pop()
+            if name in graph:
+                continue
+            deps = self.dependencies(name)
+            if dependencies is not None:
+                deps.update(dependencies.get(name, ()))
+            graph[name] = deps
+            pending.extend(deps)
+
+        # check for cycles before warming up anything
+        remaining = dict((name, set(deps)) for name, deps in graph.items())
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError("Dependency cycle between components %s"
+                                 % ", ".join(sorted(remaining)))
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+        timings = {}
+        errors = {}
+        remaining = dict((name, set(deps)) for name, deps in graph.items())
+        with ThreadPoolExecutor(max_workers) as executor:
+            running = {}
+            while remaining or running:
+                for name in sorted(remaining):
+                    deps = remaining[name]
+                    failed = [dep for dep in deps if dep in errors]
+                    if failed:
+                        del remaining[name]
+                        errors[name] = WarmupError(
+                            dict((dep, errors[dep]) for dep in failed), {}
+                        )
+                    elif not deps - set(timings):
+                        del remaining[name]
+                        future = executor.submit(self._warmup_component,
+                                                 name, open_sessions)
+                        running[future] = name
+                if not running:
+                    # all remaining components depend on failed ones
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        timings[name] = future.result()
+                    except Exception:
+                        errors[name] = sys.exc_info()[1]
+
+        if errors:
+            raise WarmupError(errors, timings)
+        return timings
 
 default_registry = ComponentRegistry()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, with_statement
+
+import sys
+import time
+import random
+import threading
+
+try:
+    # python 3.3+
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+class TransientError(Exception):
+    """
+    Base class for exceptions that are retried by default by
+    :class:`RetryPolicy`.
+    """
+    pass
+
+class _RetryState(threading.local):
+    depth = 0
+
+_state = _RetryState()
+
+class RetryPolicy(object):
+    """
+    Policy for re-running a unit of work that failed with a transient error,
+    e.g. a deadlock, serialization failure or disconnect.
+
+    Only the outermost call made with a retry policy (in each thread) is
+    retried; failures in nested calls are passed on to it, as they usually
+    invalidate the enclosing transaction.
+
+    :param retry_on: An exception type or tuple of types, or a callable that
+        takes an exception and returns true if it is transient. By default,
+        only :exc:`TransientError` is retried.
+    :param max_attempts: The maximum number of times the function is called.
+    :param base_delay: Seconds to wait before the first retry.
+    :param max_delay: Upper bound on the delay between attempts.
+    :param multiplier: Factor by which the delay grows after each attempt.
+    :param jitter: If true, each delay is drawn uniformly between zero and
+        the exponential backoff delay, to spread out competing retries.
+    :param deadline: If not ``None``, seconds since the first attempt after
+        which no retry is started.
+    :param on_retry: If not ``None``, a callable that is passed the attempt
+        number, exception and delay before each retry.
+    """
+
+    def __init__(self, retry_on=None,
+                 max_attempts=5, base_delay=0.01, max_delay=1.0,
+                 multiplier=2.0, jitter=True, deadline=None,
+                 on_retry=None, sleep=time.sleep):
+        if retry_on is None:
+            retry_on = TransientError
+        self.retry_on = retry_on
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.on_retry = on_retry
+        self.sleep = sleep
+
+    def is_transient(self, exc):
+        if isinstance(self.retry_on, (type, tuple)):
+            return isinstance(exc, self.retry_on)
+        return bool(self.retry_on(exc))
+
+    def next_delay(self, attempt, exc, start):
+        """
+        Return the seconds to wait before retrying after attempt number
+        ``attempt`` (starting at 1) failed with ``exc``, or ``None`` if it
+        should not be retried. ``start`` is the clock time of the first
+        attempt.
+        """
+        if attempt >= self.max_attempts or not self.is_transient(exc):
+            return None
+        delay = min(self.max_delay,
+                    self.base_delay * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if (self.deadline is not None and
+                _clock() + delay - start > self.deadline):
+            return None
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call ``func`` with the given arguments, retrying according to this
+        policy.
+        """
+        if _state.depth:
+            return func(*args, **kwargs)
+        start = _clock()
+        attempt = 0
+        _state.depth += 1
+        try:
+            while True:
+                attempt += 1
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    exc = sys.exc_info()[1]
+                    delay = self.next_delay(attempt, exc, start)
+                    if delay is None:
+                        raise
+                    if self.on_retry is not None:
+                        self.on_retry(attempt, exc, delay)
+                    self.sleep(delay)
+        finally:
+            _state.depth -= 1
+
+default_policy = RetryPolicy()
+
+def retrying(session_factory, policy=None):
+    """
+    Decorator running a function in a session of ``session_factory``, and
+    re-running it with a new session according to ``policy`` (by default,
+    :data:`default_policy`).
+
+    The session's instance is passed as the first argument. As with
+    :class:`.ComponentInjector`, ``session_factory`` may be any valid
+    :class:`.ComponentRef` reference. Coroutine functions are supported if the
+    session factory creates :class:`.AsyncSession` objects.
+    """
+    from .ref import ComponentRef
+    from .dec import _iscoroutinefunction, _in_session
+    if policy is None:
+        policy = default_policy
+    if not callable(session_factory):
+        session_factory = ComponentRef(session_factory)
+
+    def decorator(func):
+        if _iscoroutinefunction(func):
+            from .aio import retrying_coroutine
+            return retrying_coroutine(session_factory, policy, func)
+
+        def run_session(*args, **kwargs):
+            with session_factory() as instance:
+                return func(instance, *args, **kwargs)
+
+        def wrapper(*args, **kwargs):
+            if _in_session(session_factory):
+                # a retry cannot undo the enclosing session's work
+                return run_session(*args, **kwargs)
+            return policy.call(run_session, *args, **kwargs)
+        for attr in ('__name__', '__doc__', '__module__'):
+            if hasattr(func, attr):
+                setattr(wrapper, attr, getattr(func, attr))
+        return wrapper
+    return decorator
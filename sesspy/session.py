@@ -18,9 +18,13 @@
 
 from __future__ import absolute_import, with_statement
 
+import os
 import sys
+import weakref
 import warnings
-from . import six
+import threading
+from .metrics import ComponentMetrics, _clock
+from .local import _fork_aware, _inherited_from_parent
 
 _INSTANCE_SENTINEL = object()
 
@@ -35,6 +39,8 @@ class Session(object):
     Encapsulate a thread-local session for a particular resource.
     """
 
+    __slots__ = 'instance_opener', 'instance'
+
     def __init__(self, instance_opener):
         self.instance_opener = instance_opener
         self.instance = _INSTANCE_SENTINEL
@@ -109,33 +115,228 @@ class Session(object):
         self.instance = _INSTANCE_SENTINEL
         self.instance_opener.abort(instance)
 
-class LocalOpeners(object):
+class InstrumentedSession(Session):
+    """
+    A :class:`Session` recording the latency of its calls and the time it was
+    held open in a :class:`.ComponentMetrics`.
+    """
+
+    __slots__ = 'metrics', 'opened_at'
+
+    def __init__(self, instance_opener, metrics):
+        super(InstrumentedSession, self).__init__(instance_opener)
+        self.metrics = metrics
+        self.opened_at = None
+
+    def open(self, raise_failure=True):
+        if self.instance is not _INSTANCE_SENTINEL:
+            return super(InstrumentedSession, self).open(raise_failure)
+        start = _clock()
+        try:
+            instance = super(InstrumentedSession, self).open(raise_failure)
+        except Exception:
+            self.metrics.increment('open_failed')
+            raise
+        self.opened_at = _clock()
+        self.metrics.record('open', self.opened_at - start)
+        self.metrics.increment('opened')
+        return instance
+
+    def _end(self, end, event, counter, raise_failure):
+        if self.instance is _INSTANCE_SENTINEL:
+            return end(self, raise_failure)
+        start = _clock()
+        self.metrics.record('held', start - self.opened_at)
+        try:
+            end(self, raise_failure)
+        except Exception:
+            self.metrics.increment(event + '_failed')
+            raise
+        else:
+            self.metrics.increment(counter)
+        finally:
+            self.metrics.record(event, _clock() - start)
+
+    def commit(self, raise_failure=True):
+        self._end(Session.commit, 'commit', 'committed', raise_failure)
+
+    def abort(self, raise_failure=True):
+        self._end(Session.abort, 'abort', 'aborted', raise_failure)
+
+reclaimed_openers = ComponentMetrics('reclaimed_openers')
+"""
+A :class:`.ComponentMetrics` counting the openers closed by
+:class:`LocalOpeners` when their thread exited: ``reclaimed`` in total,
+``in_use`` for openers that still had an open session, ``close_failed``, and
+one counter per opener class.
+"""
+
+_is_finalizing = getattr(sys, 'is_finalizing', lambda: False)
+
+try:
+    # python 3.3+
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
+
+def _reclaim(config, opener):
+    if not hasattr(opener, 'close'):
+        return
+    reclaimed_openers.increment('reclaimed')
+    reclaimed_openers.increment(type(opener).__name__)
+    metrics = getattr(config, 'metrics', None)
+    if metrics is not None:
+        metrics.increment('openers_reclaimed')
+    if getattr(opener, 'count', 0) > 0:
+        reclaimed_openers.increment('in_use')
+    try:
+        opener.close()
+    except Exception:
+        reclaimed_openers.increment('close_failed')
+        exc = sys.exc_info()[1]
+        warnings.warn("An exception was raised while reclaiming openers: "
+                      + str(exc))
+
+class _ThreadReclaimer(object):
+    # Kept per thread in a threading.local. When the thread exits, the
+    # threading.local drops it, and the openers that the thread left behind
+    # are closed. It is also dropped when the LocalOpeners is, in which case
+    # openers of other threads are left alone, as they may still be in use.
+
+    __slots__ = 'openers', 'thread_ident', 'pid'
+
     def __init__(self):
-        from .local import Local
-        self.openers = Local()
+        self.openers = {}
+        self.thread_ident = _get_ident()
+        self.pid = os.getpid()
 
-    def __getitem__(self, config):
+    def __del__(self):
+        if self.pid != os.getpid():
+            # dropped in a forked child, e.g. for a thread that only existed
+            # in the parent: the openers are still in use by the parent
+            _inherited_from_parent.append(self.openers)
+            return
+        if _is_finalizing() or _get_ident() != self.thread_ident:
+            return
+        for config_ref, opener in list(self.openers.values()):
+            _reclaim(config_ref(), opener)
+
+class LocalOpeners(object):
+    """
+    A cache of openers local to the current scope.
+
+    With a thread scope, openers left behind by a thread are closed when the
+    thread exits (aborting any session that is still open), and counted in
+    :data:`reclaimed_openers`. This can be disabled with ``reclaim=False``.
+
+    After a fork, the child process starts out without openers. The openers
+    inherited from the parent are kept alive but never used or closed, as
+    their sessions may still be in use by the parent.
+
+    :param scope: A scope provider from :mod:`.local`, e.g.
+        :class:`.ContextVarScope` to keep openers per asyncio task. Defaults to
+        keeping openers per thread. Openers are never inherited by child
+        tasks, which would otherwise join the sessions of their parent: a
+        :class:`.ContextVarScope` is replaced by one with ``inherit=False``.
+    """
+
+    def __init__(self, scope=None, reclaim=True):
+        from .local import LocalDict, ThreadScope, ContextVarScope, \
+            default_scope
+        if isinstance(scope, ContextVarScope) and scope.inherit:
+            scope = ContextVarScope(inherit=False)
+        self.scope = scope
+        # maps id(config) to (weakref to config, opener); the weakref guards
+        # against the id being reused by a later config
+        self.openers = LocalDict(scope=scope)
+        if reclaim and type(scope or default_scope) is ThreadScope:
+            self.reclaimers = threading.local()
+        else:
+            self.reclaimers = None
+        _fork_aware.add(self)
+
+    def _after_fork(self):
+        from .local import LocalDict
+        # keep the openers of the forking thread (or of any scope inherited by
+        # the child) alive, and start over with an empty table
+        _inherited_from_parent.append(self.openers)
+        self.openers = LocalDict(scope=self.scope)
+        if self.reclaimers is not None:
+            _inherited_from_parent.append(self._reclaimer_openers())
+            self.reclaimers.reclaimer.openers = {}
+            self.reclaimers = threading.local()
+
+    def _reclaimer_openers(self):
         try:
-            return getattr(self.openers, str(id(config)))
+            return self.reclaimers.reclaimer.openers
         except AttributeError:
-            six.reraise(KeyError,
-                        KeyError(str(sys.exc_info()[1])),
-                        sys.exc_info()[2])
+            if self.reclaimers is None:
+                return {}
+            reclaimer = self.reclaimers.reclaimer = _ThreadReclaimer()
+            return reclaimer.openers
+
+    def get(self, config, default=None):
+        """
+        Return the opener for ``config`` in the current scope, or ``default``.
+        """
+        entry = self.openers.get(id(config))
+        if entry is not None and entry[0]() is config:
+            return entry[1]
+        return default
+
+    def __getitem__(self, config):
+        opener = self.get(config, _INSTANCE_SENTINEL)
+        if opener is _INSTANCE_SENTINEL:
+            raise KeyError(config)
+        return opener
 
     def __setitem__(self, config, opener):
-        setattr(self.openers, str(id(config)), opener)
+        self._purge()
+        try:
+            config_ref = weakref.ref(config)
+        except TypeError:
+            # keep configs that cannot be weakly referenced alive instead
+            config_ref = lambda: config
+        entry = self.openers[id(config)] = (config_ref, opener)
+        if self.reclaimers is not None:
+            self._reclaimer_openers()[id(config)] = entry
+
+    def _purge(self):
+        # drop the openers of configs that no longer exist (e.g. evicted
+        # tenant components) or are retired (e.g. factories whose source was
+        # reloaded), which would otherwise stay until the thread exits; this
+        # only runs when an opener is added, so the cost is spread over the
+        # openers created in the current scope
+        dead = [cid for cid, (config_ref, opener) in self.openers.items()
+                if _is_stale(config_ref(), opener)]
+        if dead:
+            reclaimer_openers = self._reclaimer_openers()
+            for cid in dead:
+                opener = self.openers.pop(cid)[1]
+                reclaimer_openers.pop(cid, None)
+                # openers still in use are left to their sessions
+                if getattr(opener, 'count', 0) == 0 and \
+                        hasattr(opener, 'close'):
+                    try:
+                        opener.close()
+                    except Exception:
+                        exc = sys.exc_info()[1]
+                        warnings.warn("An exception was raised while "
+                                      "closing openers: " + str(exc))
 
     def close_remaining(self):
         """
-        Close any remaining openers for the current thread, and remove them
+        Close any remaining openers for the current scope, and remove them
         from this :class:`LocalOpeners` instance.
 
         This is particularly useful in conjunction with
         :class:`.LazyCountingOpener`.
         """
 
-        for cid, opener in list(self.openers.__dict__.items()):
-            del self.openers.__dict__[cid]
+        reclaimer_openers = self._reclaimer_openers()
+        for cid, (config_ref, opener) in list(self.openers.items()):
+            del self.openers[cid]
+            reclaimer_openers.pop(cid, None)
             if not hasattr(opener, 'close'):
                 continue
             try:
@@ -146,10 +347,30 @@ class LocalOpeners(object):
                               + str(exc))
 
     def clear(self):
-        self.openers.__dict__.clear()
+        self.openers.clear()
+        self._reclaimer_openers().clear()
+
+def _is_stale(config, opener):
+    # retired configs keep the openers their sessions still use, so that
+    # sessions opened inside those sessions are nested in them
+    return config is None or (getattr(config, 'retired', False) and
+                              getattr(opener, 'count', 0) == 0)
 
 default_local_openers = LocalOpeners()
 
+class _OpenerKey(object):
+    # stands in for a SessionFactory in LocalOpeners after its source was
+    # reloaded; reclaiming looks up the metrics of the config, and
+    # SessionFactory looks up the openers of the previous keys, which are
+    # kept alive through the chain
+
+    __slots__ = 'metrics', 'previous', 'retired', '__weakref__'
+
+    def __init__(self, metrics, previous):
+        self.metrics = metrics
+        self.previous = previous
+        self.retired = False
+
 class SessionFactory(object):
     """
     A session factory helper that combines various common steps to build
@@ -164,11 +385,28 @@ class SessionFactory(object):
     :param local_openers: A cache for thread-local openers. This is required
         for e.g. counting openers, and may be ``None`` or ``True`` for the
         default opener cache. ``False`` implies no cache.
+    :param metrics: If not ``None``, a :class:`.ComponentMetrics` in which
+        the creation of openers and the latency of sessions are recorded.
+
+    When the source is reloaded (see :meth:`.GuardedFactorySource.reload`),
+    cached openers are no longer used for new outermost sessions, and new ones
+    are created for the new source instance. A session opened inside a session
+    that was already open during the reload is still nested in it. Shared
+    openers (see :func:`.shared_opener`) are rebuilt as well.
     """
 
+    __slots__ = (
+        'source_factory', 'adapter_factory', 'opener_factory', 'local_openers',
+        'metrics', 'opener_key', '__weakref__',
+    )
+
+    session_class = Session
+    instrumented_session_class = InstrumentedSession
+
     def __init__(self,
                  source_factory, adapter_factory,
-                 opener_factory=None, local_openers=None):
+                 opener_factory=None, local_openers=None,
+                 metrics=None):
         self.source_factory = source_factory
         self.adapter_factory = adapter_factory
         self.opener_factory = opener_factory
@@ -177,26 +415,99 @@ class SessionFactory(object):
         elif local_openers is False:
             local_openers = None
         self.local_openers = local_openers
+        self.metrics = metrics
+        # the key of the cached openers, replaced when the source is reloaded
+        self.opener_key = self
+        reload_listeners = getattr(source_factory, 'reload_listeners', None)
+        if reload_listeners is not None:
+            reload_listeners.append(self._source_reloaded)
+
+    def _source_reloaded(self):
+        # the openers cached under the old key are dropped once their
+        # scope adds another opener and they are no longer in use (see
+        # LocalOpeners._purge)
+        previous = self.opener_key
+        self.opener_key = _OpenerKey(self.metrics, previous)
+        if previous is not self:
+            previous.retired = True
+        source_reloaded = getattr(self.opener_factory, 'source_reloaded',
+                                  None)
+        if source_reloaded is not None:
+            source_reloaded()
+
+    @property
+    def retired(self):
+        # as a key in LocalOpeners, see _OpenerKey
+        return self.opener_key is not self
+
+    def _previous_opener(self):
+        # a session opened before the source was reloaded may still be open
+        # in this scope, in which case new sessions are nested in it
+        key = self.opener_key
+        while key is not self:
+            key = key.previous
+            opener = self.local_openers.get(key)
+            if getattr(opener, 'count', 0) > 0:
+                return opener
+        return None
 
     def create_opener(self):
+        if self.metrics is not None:
+            start = _clock()
         source = self.source_factory()
         opener = self.adapter_factory(source)
         if self.opener_factory is not None:
             opener = self.opener_factory(opener)
+        if self.metrics is not None:
+            self.metrics.record('create_opener', _clock() - start)
+            self.metrics.increment('openers')
         return opener
 
     def open_session(self):
         if self.local_openers is None:
             opener = self.create_opener()
         else:
-            opener = None
-            try:
-                opener = self.local_openers[self]
-            except KeyError:
-                pass
+            opener = self.local_openers.get(self.opener_key)
             if not opener:
-                opener = self.create_opener()
-                self.local_openers[self] = opener
-        return Session(opener)
+                opener = self._previous_opener()
+                if opener is None:
+                    opener = self.create_opener()
+                    self.local_openers[self.opener_key] = opener
+        if self.metrics is not None:
+            return self.instrumented_session_class(opener, self.metrics)
+        return self.session_class(opener)
 
     __call__ = open_session
+
+    def in_session(self):
+        """
+        Return true if a session of this factory is open in the current
+        scope, so that a new session would be nested in it (i.e. with an
+        opener cache and a counting opener).
+        """
+        if self.local_openers is None:
+            return False
+        opener = self.local_openers.get(self.opener_key)
+        if opener is None:
+            opener = self._previous_opener()
+        return getattr(opener, 'count', 0) > 0
+
+    def warmup(self):
+        """
+        Initialize the source now, if it supports this (see
+        :meth:`.GuardedFactorySource.warmup`), instead of on the first
+        session.
+        """
+        warmup = getattr(self.source_factory, 'warmup', None)
+        if warmup is not None:
+            warmup()
+
+    def dispose(self):
+        """
+        Release the source, if it supports this (see
+        :meth:`.GuardedFactorySource.dispose`). Openers still cached for this
+        factory keep using the old source.
+        """
+        dispose = getattr(self.source_factory, 'dispose', None)
+        if dispose is not None:
+            dispose()
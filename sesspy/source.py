@@ -20,6 +20,8 @@ from __future__ import absolute_import, with_statement
 
 import sys
 import threading
+from .metrics import _clock
+from .local import _fork_aware, _inherited_from_parent
 
 class InstanceSource(object):
 
@@ -44,32 +46,119 @@ class FactorySource(object):
         return self.factory(*args, **kwargs)
 
 class GuardedFactorySource(object):
+    """
+    Source creating its instance once, on first use, while holding a lock.
 
-    def __init__(self, factory, noretry_exceptions=None, args=None):
+    If ``noretry_exceptions`` is given, the first such exception raised by
+    the factory is re-raised on all later calls.
+
+    After a fork, the child process drops the inherited instance and lazily
+    creates its own. The inherited instance is passed to ``fork_dispose`` if
+    given, which should release it without closing resources still used by
+    the parent (e.g. ``engine.dispose(close=False)``). Otherwise, it is kept
+    alive but unused, so that it is never closed by the child.
+
+    :meth:`dispose` drops the instance, passing it to ``dispose_instance`` if
+    given (e.g. ``engine.dispose()``), and a new one is created on next use.
+
+    The :class:`.ConfigOption` and :class:`.ConfigSection` values read by
+    ``args`` are tracked. When a :class:`.LazyConfigReader` reloads and one
+    of them changed, the instance is replaced (see :meth:`reload`).
+    """
+
+    def __init__(self, factory, noretry_exceptions=None, args=None,
+                 metrics=None, fork_dispose=None, dispose_instance=None):
         self.factory = factory
         self.args = args
         self.noretry_exceptions = noretry_exceptions
+        self.metrics = metrics
+        self.fork_dispose = fork_dispose
+        self.dispose_instance = dispose_instance
         self.instance = None
         self.exception = None
         self.factory_lock = threading.Lock()
+        # incremented when the instance is replaced by reload()
+        self.generation = 0
+        self.reload_listeners = []
+        # (get_config, section, option) read by args
+        self.config_options = frozenset()
+        _fork_aware.add(self)
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent
+        self.factory_lock = threading.Lock()
+        instance, self.instance = self.instance, None
+        if instance is None:
+            return
+        if self.fork_dispose is not None:
+            self.fork_dispose(instance)
+        else:
+            _inherited_from_parent.append(instance)
 
     def create(self):
         assert self.instance is None
 
-        args, kwargs = (), {}
-        if callable(self.args):
-            args, kwargs = self.args()
-        elif self.args is not None:
-            args, kwargs = self.args
+        if self.metrics is not None:
+            start = _clock()
+            try:
+                return self._create()
+            finally:
+                self.metrics.record('source_create', _clock() - start)
+        return self._create()
 
+    def _create(self):
         if self.noretry_exceptions is not None:
             try:
-                self.instance = self.factory(*args, **kwargs)
+                self.instance = self._build()
             except self.noretry_exceptions:
                 self.exception = sys.exc_info()[1]
                 raise
         else:
-            self.instance = self.factory(*args, **kwargs)
+            self.instance = self._build()
+
+    def _build(self):
+        args, kwargs = (), {}
+        if callable(self.args):
+            config = sys.modules.get('sesspy.config')
+            if config is not None:
+                # without sesspy.config loaded, there are no options to track
+                with config._recording_options() as options:
+                    args, kwargs = self.args()
+                self._track_options(options)
+            else:
+                args, kwargs = self.args()
+        elif self.args is not None:
+            args, kwargs = self.args
+        return self.factory(*args, **kwargs)
+
+    def _track_options(self, options):
+        self.config_options = frozenset(options)
+        for get_config, _section, _option in options:
+            add_dependent = getattr(get_config, 'add_dependent', None)
+            if add_dependent is not None:
+                add_dependent(self)
+
+    def config_changed(self, reader, changed):
+        """
+        Called by a :class:`.LazyConfigReader` after it reloaded; reloads the
+        instance if an option or section read by ``args`` changed.
+        """
+        optionxform = reader.config.optionxform
+        changed_sections = None
+        for get_config, section, option in self.config_options:
+            if get_config is not reader:
+                continue
+            if option is None:
+                # a whole ConfigSection
+                if changed_sections is None:
+                    changed_sections = set(s for s, _o in changed)
+                if section in changed_sections:
+                    break
+            elif (section, optionxform(option)) in changed:
+                break
+        else:
+            return
+        self.reload()
 
     def get(self):
         if self.exception is not None:
@@ -77,7 +166,11 @@ class GuardedFactorySource(object):
         elif self.instance is not None:
             return self.instance
 
+        wait_start = _clock()
         with self.factory_lock:
+            if self.metrics is not None:
+                self.metrics.record('source_lock_wait',
+                                    _clock() - wait_start)
             if self.exception is not None:
                 raise self.exception
             elif self.instance is not None:
@@ -88,7 +181,52 @@ class GuardedFactorySource(object):
 
     __call__ = get
 
+    def warmup(self):
+        """
+        Create the instance now, if it has not been created yet.
+        """
+        self.get()
+
+    def reload(self):
+        """
+        Create a new instance and replace the current one with it, if it has
+        been created. Until then, :meth:`get` keeps returning the current
+        instance without waiting. The replaced instance is passed to
+        ``dispose_instance``, which should let it finish the work in progress
+        (like ``engine.dispose()``, which leaves checked out connections
+        alone).
+
+        The callables in ``reload_listeners`` are called after the instance
+        is replaced.
+        """
+        with self.factory_lock:
+            if self.instance is None:
+                return
+            start = _clock()
+            instance = self._build()
+            if self.metrics is not None:
+                self.metrics.record('source_create', _clock() - start)
+                self.metrics.increment('source_reloads')
+            previous, self.instance = self.instance, instance
+            self.generation += 1
+        for listener in list(self.reload_listeners):
+            listener()
+        if self.dispose_instance is not None:
+            self.dispose_instance(previous)
+
+    def dispose(self):
+        """
+        Drop the instance, if it has been created, and release it with
+        ``dispose_instance``.
+        """
+        with self.factory_lock:
+            instance, self.instance = self.instance, None
+        if instance is not None and self.dispose_instance is not None:
+            self.dispose_instance(instance)
+
 class SourceAdapter(object):
+    __slots__ = 'source', 'open_fn', 'commit_fn', 'abort_fn'
+
     def __init__(self, source, open_fn,
                  commit_fn=None, abort_fn=None):
         self.source = source
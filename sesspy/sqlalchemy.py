@@ -18,9 +18,22 @@
 
 from __future__ import absolute_import
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm.session import sessionmaker
+import sys
+import atexit
+import weakref
+import warnings
+import functools
+import threading
 from . import session, source, openers
+from .local import _fork_aware
+from .metrics import _clock
+
+# SQLAlchemy is only imported once a component is created, so that importing
+# this module (e.g. to register components) stays cheap
+
+def _create_engine(*args, **kwargs):
+    from sqlalchemy import create_engine
+    return create_engine(*args, **kwargs)
 
 def _make_callable_engine_args(db_uri, engine_args):
     if not callable(db_uri) and not callable(engine_args):
@@ -31,6 +44,53 @@ def _make_callable_engine_args(db_uri, engine_args):
         engine_args = (lambda _x: (lambda: _x))(engine_args or {})
     return lambda: ((db_uri(),), engine_args())
 
+# SQLSTATE codes for serialization failures and deadlocks
+_TRANSIENT_SQLSTATES = frozenset(['40001', '40P01'])
+# MySQL error codes for lock wait timeouts and deadlocks
+_TRANSIENT_MYSQL_ERRORS = frozenset([1205, 1213])
+# SQLite result codes for busy and locked databases
+_TRANSIENT_SQLITE_ERRORS = frozenset([5, 6])
+
+def is_transient_error(exc):
+    """
+    Return true if ``exc`` is a deadlock, serialization failure or disconnect
+    reported by SQLAlchemy. Suitable as ``retry_on`` for a
+    :class:`.RetryPolicy`.
+    """
+    exc_module = sys.modules.get('sqlalchemy.exc')
+    if exc_module is None or not isinstance(exc, exc_module.DBAPIError):
+        # without sqlalchemy.exc loaded, exc cannot be a DBAPIError
+        return False
+    if exc.connection_invalidated:
+        return True
+    orig = exc.orig
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate in _TRANSIENT_SQLSTATES:
+        return True
+    if getattr(orig, 'sqlite_errorcode', None) in _TRANSIENT_SQLITE_ERRORS:
+        return True
+    args = getattr(orig, 'args', None) or (None,)
+    return args[0] in _TRANSIENT_MYSQL_ERRORS
+
+def dispose_forked_engine(engine):
+    """
+    Release an engine inherited from the parent process after a fork, without
+    closing the pooled connections the parent is still using.
+
+    This is the default ``fork_dispose`` hook of the sources created by the
+    helpers in this module. With SQLAlchemy versions before 1.4.33, which do
+    not support ``dispose(close=False)``, the engine is kept alive unused
+    instead.
+    """
+    try:
+        engine.dispose(close=False)
+    except TypeError:
+        from .local import _inherited_from_parent
+        _inherited_from_parent.append(engine)
+
+def _dispose_engine(engine):
+    engine.dispose()
+
 def _maybe_register(component, name, registry):
     if name:
         if registry is None:
@@ -42,7 +102,8 @@ def db_connection(db_uri, engine_args=None,
                   name=None, registry=None,
                   noretry_exceptions=None,
                   opener=openers.CountingOpener,
-                  connection_factory=create_engine):
+                  connection_factory=_create_engine,
+                  metrics=None):
 
     args = _make_callable_engine_args(db_uri, engine_args)
 
@@ -50,11 +111,15 @@ def db_connection(db_uri, engine_args=None,
         source_factory=source.GuardedFactorySource(
             connection_factory,
             noretry_exceptions,
-            args
+            args,
+            metrics=metrics,
+            fork_dispose=dispose_forked_engine,
+            dispose_instance=_dispose_engine,
         ),
         adapter_factory=source.sessionless_source_adapter,
         opener_factory=opener,
         local_openers=False,
+        metrics=metrics,
     )
 
     _maybe_register(component, name, registry)
@@ -62,13 +127,44 @@ def db_connection(db_uri, engine_args=None,
     return component
 
 class TransactionWrapper(object):
+    """
+    Handle for a transaction opened by :class:`TransactionFactory`.
+
+    ``execute``, ``exec_driver_sql``, ``scalar`` and ``scalars`` are the
+    bound methods of the connection, stored on the handle so that calling
+    them costs no more than on the connection itself. The connection is
+    available as ``connection``; other attributes are looked up on it.
+    """
+
+    __slots__ = (
+        '_connection', '_transaction', 'connection',
+        'execute', 'exec_driver_sql', 'scalar', 'scalars',
+    )
 
     def __init__(self, connection, transaction):
-        self._connection = connection
+        self._connection = self.connection = connection
         self._transaction = transaction
+        try:
+            self.execute = connection.execute
+            self.exec_driver_sql = connection.exec_driver_sql
+            self.scalar = connection.scalar
+            self.scalars = connection.scalars
+        except AttributeError:
+            # e.g. no exec_driver_sql or scalars before SQLAlchemy 1.4; the
+            # missing ones are left unset, and fail in __getattr__
+            for name in _BOUND_METHODS:
+                method = getattr(connection, name, None)
+                if method is not None:
+                    setattr(self, name, method)
 
     def __getattr__(self, name):
-        return getattr(self.connection, name)
+        if name in _SLOTS:
+            # an unset slot, or the object is not fully initialized
+            raise AttributeError(name)
+        return getattr(self._connection, name)
+
+_BOUND_METHODS = ('execute', 'exec_driver_sql', 'scalar', 'scalars')
+_SLOTS = frozenset(TransactionWrapper.__slots__)
 
 class TransactionFactory(object):
 
@@ -88,22 +184,262 @@ class TransactionFactory(object):
         transaction_wrapper._transaction.rollback()
         transaction_wrapper._connection.close()
 
+    def savepoint(self, transaction_wrapper):
+        return transaction_wrapper._connection.begin_nested()
+
+    def release_savepoint(self, transaction_wrapper, savepoint):
+        savepoint.commit()
+
+    def rollback_savepoint(self, transaction_wrapper, savepoint):
+        savepoint.rollback()
+
+class _IdleReaper(object):
+    # closes the connections of StickyTransactionFactory instances that have
+    # been idle for longer than their idle_timeout, from a daemon thread, so
+    # that a thread that stops using its factory does not keep a connection
+    # checked out of the pool
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.factories = weakref.WeakSet()
+        self.thread = None
+        self.stopped = False
+
+    def watch(self, factory):
+        with self.cond:
+            self.factories.add(factory)
+            if self.thread is None and not self.stopped:
+                self.thread = threading.Thread(target=self._run,
+                                               name='sesspy-idle-reaper')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        with self.cond:
+            while not self.stopped:
+                now = _clock()
+                expired, deadline = self._expired(now)
+                if expired:
+                    # closing may block, e.g. on the pool's reset
+                    self.cond.release()
+                    try:
+                        for connection in expired:
+                            _close_quietly(connection)
+                    finally:
+                        self.cond.acquire()
+                    del expired[:]
+                    continue
+                self.cond.wait(None if deadline is None else deadline - now)
+
+    def _expired(self, now):
+        # called with the lock held; returns the connections to close, and
+        # when the next one expires. The factories are only referenced here,
+        # so that those no longer used are not kept alive while waiting.
+        expired = []
+        deadline = None
+        for factory in list(self.factories):
+            connection, expires = factory._reap(now)
+            if connection is not None:
+                expired.append(connection)
+            if expires is None:
+                self.factories.discard(factory)
+            elif deadline is None or expires < deadline:
+                deadline = expires
+        return expired, deadline
+
+    def stop(self):
+        # at exit, so that the thread is not left running while the
+        # interpreter shuts down
+        with self.cond:
+            self.stopped = True
+            thread = self.thread
+            self.cond.notify()
+        if thread is not None:
+            thread.join(1.0)
+
+    def _after_fork(self):
+        # the thread is gone, and the factories belong to the parent
+        self.cond = threading.Condition()
+        self.factories = weakref.WeakSet()
+        self.thread = None
+
+_idle_reaper = _IdleReaper()
+_fork_aware.add(_idle_reaper)
+atexit.register(_idle_reaper.stop)
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        exc = sys.exc_info()[1]
+        warnings.warn("An exception was raised while closing an idle "
+                      "connection: " + str(exc))
+
+def _thread_bound_pool(engine):
+    # a SingletonThreadPool (e.g. for SQLite in-memory databases) keeps one
+    # connection per thread, which only that thread may use or close, and
+    # cannot be starved by other threads
+    pool_module = sys.modules.get('sqlalchemy.pool')
+    return pool_module is not None and isinstance(
+        getattr(engine, 'pool', None), pool_module.SingletonThreadPool)
+
+class StickyTransactionFactory(TransactionFactory):
+    """
+    A :class:`TransactionFactory` that keeps its connection checked out
+    between transactions, so that a transaction only costs ``begin()`` and
+    ``commit()`` (or ``rollback()``), instead of also checking the connection
+    out of the pool and resetting it when it is returned.
+
+    Each opener has its own factory, so this must be used with an opener
+    cache (e.g. thread-local, as :func:`transactional_db_connection` does),
+    which closes the openers when their thread exits.
+
+    The connection is returned to the pool once it has been idle for more
+    than ``idle_timeout`` seconds (by a background thread, so that threads
+    that stop using the factory do not starve the pool, except for pools
+    that keep a connection per thread, where it is only checked when a
+    transaction starts), after
+    ``max_transactions`` transactions, after a failed ``begin()``,
+    ``commit()`` or ``rollback()``, once it is invalidated, and when the
+    factory is closed, which the :class:`.CountingOpener` wrapping it does
+    when it is closed itself.
+    """
+
+    # see CountingOpenerBase._close_session_opener
+    close_with_opener = True
+
+    def __init__(self, engine, idle_timeout=30.0, max_transactions=1000):
+        super(StickyTransactionFactory, self).__init__(engine)
+        self.idle_timeout = idle_timeout
+        self.max_transactions = max_transactions
+        self.connection = None
+        self.transactions = 0
+        # not None while the connection is idle, i.e. may be reaped
+        self.released_at = None
+        # whether the reaper is watching this factory, or must not
+        self.watched = _thread_bound_pool(engine)
+        # guards the above against the reaper
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            connection, released_at = self.connection, self.released_at
+            self.released_at = None
+            expired = connection is not None and (
+                getattr(connection, 'invalidated', False)
+                or (self.idle_timeout is not None and released_at is not None
+                    and _clock() - released_at > self.idle_timeout))
+            if expired:
+                self.connection = None
+        if expired:
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = self.connection = self.engine.connect()
+            self.transactions = 0
+        self.transactions += 1
+        try:
+            transaction = connection.begin()
+        except:
+            self.close()
+            raise
+        return TransactionWrapper(connection, transaction)
+
+    def commit(self, transaction_wrapper):
+        try:
+            transaction_wrapper._transaction.commit()
+        except:
+            self.close()
+            raise
+        self._release()
+
+    def abort(self, transaction_wrapper):
+        try:
+            transaction_wrapper._transaction.rollback()
+        except:
+            self.close()
+            raise
+        self._release()
+
+    def _release(self):
+        if self.max_transactions is not None and \
+                self.transactions >= self.max_transactions:
+            self.close()
+            return
+        with self.lock:
+            self.released_at = _clock()
+            watch = self.idle_timeout is not None and not self.watched
+            self.watched = True
+        if watch:
+            _idle_reaper.watch(self)
+
+    def _reap(self, now):
+        # called by the reaper; returns the connection to close if it has
+        # been idle for too long, and when it will have been otherwise
+        with self.lock:
+            if self.connection is None or self.released_at is None:
+                self.watched = False
+                return None, None
+            expires = self.released_at + self.idle_timeout
+            if expires > now:
+                return None, expires
+            connection, self.connection = self.connection, None
+            self.released_at = None
+            self.watched = False
+            return connection, None
+
+    def close(self):
+        """
+        Return the connection to the pool, if it is checked out.
+        """
+        with self.lock:
+            connection, self.connection = self.connection, None
+            self.released_at = None
+        if connection is not None:
+            connection.close()
+
 def transactional_db_connection(db_uri, engine_args=None,
                                 name=None, registry=None,
                                 noretry_exceptions=None,
                                 opener=openers.CountingOpener,
-                                connection_factory=create_engine):
+                                connection_factory=_create_engine,
+                                metrics=None,
+                                sticky_connections=False,
+                                idle_timeout=30.0,
+                                max_transactions=1000):
+    """
+    Return a component whose sessions are transactions on a connection of the
+    engine, with thread-local openers.
+
+    If ``sticky_connections`` is true, each thread keeps its connection
+    between transactions (see :class:`StickyTransactionFactory`, which is
+    passed ``idle_timeout`` and ``max_transactions``).
+    """
 
     args = _make_callable_engine_args(db_uri, engine_args)
 
+    if sticky_connections:
+        adapter_factory = functools.partial(
+            StickyTransactionFactory,
+            idle_timeout=idle_timeout,
+            max_transactions=max_transactions,
+        )
+    else:
+        adapter_factory = TransactionFactory
+
     component = session.SessionFactory(
         source_factory=source.GuardedFactorySource(
             connection_factory,
             noretry_exceptions,
-            args
+            args,
+            metrics=metrics,
+            fork_dispose=dispose_forked_engine,
+            dispose_instance=_dispose_engine,
         ),
-        adapter_factory=TransactionFactory,
+        adapter_factory=adapter_factory,
         opener_factory=opener,
+        metrics=metrics,
     )
 
     _maybe_register(component, name, registry)
@@ -113,6 +449,7 @@ def transactional_db_connection(db_uri, engine_args=None,
 class ORMSessionFactory(object):
 
     def __init__(self, connection, session_args=None):
+        from sqlalchemy.orm.session import sessionmaker
         session_args = session_args or {}
         session_args['bind'] = connection
         self.session_maker = sessionmaker(**session_args)
@@ -126,10 +463,20 @@ class ORMSessionFactory(object):
     def abort(self, session):
         session.rollback()
 
+    def savepoint(self, session):
+        return session.begin_nested()
+
+    def release_savepoint(self, session, savepoint):
+        savepoint.commit()
+
+    def rollback_savepoint(self, session, savepoint):
+        savepoint.rollback()
+
 def orm_session(db_uri, engine_args=None,
                 name=None, registry=None,
                 noretry_exceptions=None,
-                connection_factory=create_engine):
+                connection_factory=_create_engine,
+                metrics=None):
 
     args = _make_callable_engine_args(db_uri, engine_args)
 
@@ -137,9 +484,13 @@ def orm_session(db_uri, engine_args=None,
         source_factory=source.GuardedFactorySource(
             connection_factory,
             noretry_exceptions,
-            args
+            args,
+            metrics=metrics,
+            fork_dispose=dispose_forked_engine,
+            dispose_instance=_dispose_engine,
         ),
         adapter_factory=ORMSessionFactory,
+        metrics=metrics,
     )
 
     _maybe_register(component, name, registry)
@@ -150,7 +501,8 @@ def orm_counting_session(db_uri, engine_args=None,
                          name=None, registry=None,
                          noretry_exceptions=None,
                          counting_opener=openers.CountingOpener,
-                         connection_factory=create_engine):
+                         connection_factory=_create_engine,
+                         metrics=None):
 
     args = _make_callable_engine_args(db_uri, engine_args)
 
@@ -159,12 +511,44 @@ def orm_counting_session(db_uri, engine_args=None,
             connection_factory,
             noretry_exceptions,
             args,
+            metrics=metrics,
+            fork_dispose=dispose_forked_engine,
+            dispose_instance=_dispose_engine,
         ),
         adapter_factory=ORMSessionFactory,
         opener_factory=counting_opener,
+        metrics=metrics,
     )
 
     _maybe_register(component, name, registry)
 
     return component
 
+def tenant_components(db_uri_template, helper=orm_session, max_live=100,
+                      current_tenant=None, name=None, registry=None,
+                      **kwargs):
+    """
+    Return a :class:`.TenantComponent` building a component for each tenant
+    with ``helper`` (e.g. :func:`db_connection`), from the database URI
+    returned by ``db_uri_template.format(tenant=tenant)``, or by
+    ``db_uri_template(tenant)`` if it is callable.
+
+    Other keyword arguments are passed to ``helper``. The engines of evicted
+    tenants are disposed once their sessions have ended.
+    """
+    from .tenant import TenantComponent
+
+    if callable(db_uri_template):
+        db_uri = db_uri_template
+    else:
+        db_uri = lambda tenant: db_uri_template.format(tenant=tenant)
+
+    component = TenantComponent(
+        lambda tenant: helper(db_uri(tenant), **kwargs),
+        max_live=max_live,
+        current_tenant=current_tenant,
+    )
+
+    _maybe_register(component, name, registry)
+
+    return component
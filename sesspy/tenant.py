@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, with_statement
+
+import sys
+import warnings
+import functools
+import threading
+from collections import OrderedDict
+
+def _dispose_component(component):
+    dispose = getattr(component, 'dispose', None)
+    if dispose is not None:
+        dispose()
+
+class _TenantEntry(object):
+    __slots__ = 'tenant', 'component', 'active', 'evicted'
+
+    def __init__(self, tenant, component):
+        self.tenant = tenant
+        self.component = component
+        self.active = 0
+        self.evicted = False
+
+class TenantSession(object):
+    """
+    Session of a tenant's component, keeping track of the sessions in use so
+    that an evicted component is only disposed once they have ended.
+    """
+
+    __slots__ = 'tenants', 'entry', 'session', 'acquired'
+
+    def __init__(self, tenants, entry, session):
+        self.tenants = tenants
+        self.entry = entry
+        self.session = session
+        # whether this session holds the entry, which is only released once
+        self.acquired = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc, typ, tb):
+        if exc is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def open(self, raise_failure=True):
+        while not self.tenants._acquire(self.entry):
+            # evicted since this session was created, and possibly disposed
+            self.entry = self.tenants._entry(self.entry.tenant)
+            self.session = self.entry.component()
+        self.acquired = True
+        try:
+            return self.session.open(raise_failure)
+        except:
+            self._release()
+            raise
+
+    def commit(self, raise_failure=True):
+        try:
+            self.session.commit(raise_failure)
+        finally:
+            self._release()
+
+    def abort(self, raise_failure=True):
+        try:
+            self.session.abort(raise_failure)
+        finally:
+            self._release()
+
+    def _release(self):
+        if self.acquired:
+            self.acquired = False
+            self.tenants._release(self.entry)
+
+class TenantComponent(object):
+    """
+    A component for one database (or other resource) per tenant, building the
+    component of each tenant on demand, e.g.::
+
+        tenants = TenantComponent(
+            lambda tenant: db_connection('postgresql:///tenant_%s' % tenant),
+            max_live=50,
+            current_tenant=current_tenant.get,
+        )
+
+        with tenants['acme']() as conn:
+            ...
+
+    At most ``max_live`` components are kept. When another one is needed,
+    the least recently used one is evicted, and disposed (see
+    :meth:`.SessionFactory.dispose`) as soon as the sessions it has open have
+    ended. Until then it is still live, so the limit may be exceeded
+    temporarily. A tenant whose component was evicted gets a new one the next
+    time it is used.
+
+    Only sessions opened through the :class:`TenantComponent` are tracked,
+    so the components built by ``component_factory`` should not be used
+    directly.
+
+    :param component_factory: A callable that takes a tenant key and returns
+        a component, e.g. a :class:`.SessionFactory`.
+    :param max_live: The maximum number of components kept.
+    :param dispose: A callable that releases an evicted component. Defaults
+        to calling its ``dispose`` method, if any.
+    :param current_tenant: If not ``None``, a callable returning the key of
+        the current tenant, which makes the :class:`TenantComponent` itself
+        usable as a component, e.g. registered in a
+        :class:`.ComponentRegistry`.
+    """
+
+    session_class = TenantSession
+
+    def __init__(self, component_factory, max_live=100, dispose=None,
+                 current_tenant=None):
+        if max_live < 1:
+            raise ValueError("max_live must be positive: %r" % (max_live,))
+        self.component_factory = component_factory
+        self.max_live = max_live
+        self.dispose = dispose if dispose is not None else _dispose_component
+        self.current_tenant = current_tenant
+        self.lock = threading.Lock()
+        # tenant -> _TenantEntry, least recently used first
+        self.entries = OrderedDict()
+        self.draining = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disposals = 0
+
+    def _entry(self, tenant):
+        disposable = ()
+        with self.lock:
+            entry = self.entries.get(tenant)
+            if entry is not None:
+                self.hits += 1
+                # move to the most recently used end
+                del self.entries[tenant]
+                self.entries[tenant] = entry
+                return entry
+            self.misses += 1
+            # the factory is expected to be cheap, like the helpers building
+            # SessionFactory instances that only connect on first use
+            entry = _TenantEntry(tenant, self.component_factory(tenant))
+            self.entries[tenant] = entry
+            if len(self.entries) > self.max_live:
+                disposable = self._evict(
+                    [self.entries.popitem(last=False)[1]
+                     for _i in range(len(self.entries) - self.max_live)])
+        self._dispose_entries(disposable)
+        return entry
+
+    def _evict(self, entries):
+        # called with the lock held, for entries already removed from
+        # self.entries; returns those that can be disposed of right away
+        disposable = []
+        for entry in entries:
+            entry.evicted = True
+            self.evictions += 1
+            if entry.active:
+                self.draining.add(entry)
+            else:
+                disposable.append(entry)
+        return disposable
+
+    def _dispose_entries(self, entries):
+        for entry in entries:
+            try:
+                self.dispose(entry.component)
+            except Exception:
+                exc = sys.exc_info()[1]
+                warnings.warn("An exception was raised while disposing of "
+                              "the component of tenant %r: %s"
+                              % (entry.tenant, exc))
+            with self.lock:
+                self.disposals += 1
+
+    def _acquire(self, entry):
+        with self.lock:
+            if entry.evicted:
+                return False
+            entry.active += 1
+            return True
+
+    def _release(self, entry):
+        with self.lock:
+            entry.active -= 1
+            if entry.active or not entry.evicted:
+                return
+            self.draining.discard(entry)
+        self._dispose_entries((entry,))
+
+    def __getitem__(self, tenant):
+        """
+        Return a session factory for ``tenant``. Its component is looked up
+        (and created if needed) for each session.
+        """
+        return functools.partial(self.open_session, tenant)
+
+    def open_session(self, tenant=None):
+        """
+        Return a new session for ``tenant``, or for the current tenant if
+        ``tenant`` is ``None``.
+        """
+        if tenant is None:
+            if self.current_tenant is None:
+                raise TypeError("No tenant given, and no current_tenant "
+                                "callable configured")
+            tenant = self.current_tenant()
+        entry = self._entry(tenant)
+        return self.session_class(self, entry, entry.component())
+
+    __call__ = open_session
+
+    def evict(self, tenant):
+        """
+        Evict the component of ``tenant``, if there is one. It is disposed
+        once its sessions have ended.
+        """
+        with self.lock:
+            entry = self.entries.pop(tenant, None)
+            disposable = self._evict([entry] if entry is not None else [])
+        self._dispose_entries(disposable)
+
+    def clear(self):
+        """
+        Evict the components of all tenants.
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+            disposable = self._evict(entries)
+        self._dispose_entries(disposable)
+
+    def stats(self):
+        """
+        Return a dict with the number of component lookups that were
+        ``hits`` and ``misses``, the number of ``evictions`` and
+        ``disposals``, and the number of ``live`` components, including
+        evicted ones that are ``draining``, i.e. still have sessions open.
+        """
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                disposals=self.disposals,
+                draining=len(self.draining),
+                live=len(self.entries) + len(self.draining),
+            )
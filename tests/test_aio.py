@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+if __name__ == '__main__':
+    import sys
+    import os, os.path
+    sys.path.insert(
+        0,
+        os.path.dirname(
+            os.path.dirname(
+                os.path.realpath(
+                    os.path.abspath(__file__)
+                )
+            )
+        )
+    )
+
+import unittest
+import asyncio
+import mock
+from sesspy import aio, dec, local, openers, ref, session
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+class Test_AsyncSession(unittest.TestCase):
+    def setUp(self):
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.opener.open = mock.AsyncMock()
+        self.opener.commit = mock.AsyncMock()
+        self.opener.abort = mock.AsyncMock()
+
+    def test_opencommit(self):
+        inst = mock.Mock()
+        self.opener.open.return_value = inst
+        s = aio.AsyncSession(self.opener)
+
+        self.assertEqual(run(s.open()), inst)
+        self.assertEqual(self.opener.open.await_count, 1)
+        self.assertFalse(self.opener.commit.called)
+
+        run(s.commit())
+        self.assertEqual(self.opener.commit.await_args_list, [
+            ((inst,), {}),
+        ])
+        self.assertFalse(self.opener.abort.called)
+
+    def test_guard_exception(self):
+        class TestException(Exception):
+            pass
+        inst = mock.Mock()
+        self.opener.open.return_value = inst
+        s = aio.AsyncSession(self.opener)
+
+        async def body():
+            async with s as i:
+                self.assertEqual(i, inst)
+                raise TestException()
+        self.assertRaises(TestException, run, body())
+
+        self.assertFalse(self.opener.commit.called)
+        self.assertEqual(self.opener.abort.await_args_list, [
+            ((inst,), {}),
+        ])
+
+    def test_multiopen_fails(self):
+        s = aio.AsyncSession(self.opener)
+        run(s.open())
+        self.assertRaises(session.SessionStateException, run, s.open())
+
+    def test_commit_unopened(self):
+        s = aio.AsyncSession(self.opener)
+        self.assertRaises(session.SessionStateException, run, s.commit())
+        self.assertEqual(run(s.abort(raise_failure=False)), None)
+
+class Test_AsyncSessionFactory(unittest.TestCase):
+    def test_creates_async_sessions(self):
+        src = object()
+        events = []
+        async def open_fn(source):
+            events.append(('open', source))
+            return 'conn'
+        async def commit_fn(source, instance):
+            events.append(('commit', instance))
+
+        sf = aio.AsyncSessionFactory(
+            lambda: src,
+            aio.async_source_adapter_factory(open_fn, commit_fn),
+        )
+        self.assertEqual(sf.local_openers, None)
+
+        async def body():
+            async with sf() as conn:
+                self.assertEqual(conn, 'conn')
+        run(body())
+        self.assertEqual(events, [('open', src), ('commit', 'conn')])
+
+    def test_sessionless_adapter(self):
+        src = object()
+        sf = aio.AsyncSessionFactory(
+            lambda: src, aio.async_sessionless_source_adapter,
+        )
+        s = sf()
+        self.assertTrue(isinstance(s, aio.AsyncSession))
+        self.assertEqual(run(s.open()), src)
+        run(s.commit())
+
+class Test_TaskLocalOpeners(unittest.TestCase):
+    def test_child_tasks_get_own_openers(self):
+        adapter = mock.Mock(spec=['open', 'commit', 'abort'])
+        adapter.open.side_effect = lambda: mock.Mock(spec=[])
+        sf = session.SessionFactory(
+            mock.Mock(), mock.Mock(return_value=adapter),
+            openers.CountingOpener,
+            local_openers=session.LocalOpeners(local.ContextVarScope()),
+        )
+        async def handler():
+            with sf() as instance:
+                await asyncio.sleep(0)
+                return sf.local_openers.get(sf), instance
+        async def main():
+            # e.g. a check at startup
+            with sf():
+                pass
+            parent = sf.local_openers.get(sf)
+            return parent, await asyncio.gather(*[handler() for _i in range(5)])
+        parent, results = run(main())
+        self.assertTrue(parent is not None)
+        opener_ids = set(id(opener) for opener, instance in results)
+        self.assertEqual(len(opener_ids), 5)
+        self.assertFalse(id(parent) in opener_ids)
+        self.assertEqual(len(set(id(instance) for opener, instance in results)),
+                         5)
+        self.assertEqual(adapter.commit.call_count, 6)
+
+class Test_AsyncDec(unittest.TestCase):
+    def setUp(self):
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.opener.open = mock.AsyncMock(return_value='conn')
+        self.opener.commit = mock.AsyncMock()
+        self.opener.abort = mock.AsyncMock()
+        self.conf = mock.Mock(spec=[])
+        self.conf.side_effect = lambda: aio.AsyncSession(self.opener)
+
+    def test_with_component_detects_coroutine(self):
+        @dec.with_component(self.conf, arg='db')
+        async def func(x, db):
+            return x, db
+        self.assertTrue(isinstance(func, aio.AsyncComponentInjector))
+
+        self.assertEqual(run(func(1)), (1, 'conn'))
+        self.assertEqual(self.opener.commit.await_args_list, [
+            (('conn',), {}),
+        ])
+
+    def test_with_component_sync_unchanged(self):
+        @dec.with_component(self.conf, arg='db')
+        def func(db):
+            return db
+        self.assertEqual(type(func), dec.ComponentInjector)
+
+    def test_given_comp_not_opened(self):
+        @dec.with_component(self.conf, arg='db')
+        async def func(db):
+            return db
+        self.assertEqual(run(func(db='other')), 'other')
+        self.assertFalse(self.conf.called)
+
+    def test_abort_on_exception(self):
+        class TestException(Exception):
+            pass
+        @dec.with_component(self.conf, arg='db')
+        async def func(db):
+            raise TestException()
+        self.assertRaises(TestException, run, func())
+        self.assertFalse(self.opener.commit.called)
+        self.assertEqual(self.opener.abort.await_args_list, [
+            (('conn',), {}),
+        ])
+
+    def test_method(self):
+        conf = self.conf
+        class C(object):
+            @dec.with_component(conf, arg='db')
+            async def method(self, db):
+                return self, db
+        c = C()
+        m = c.method
+        self.assertTrue(isinstance(m, aio.AsyncComponentInjector))
+        self.assertEqual(run(m()), (c, 'conn'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,7 +35,11 @@ if __name__ == '__main__':
 import unittest
 import mock
 import os, os.path
-from sesspy import config
+import shutil
+import tempfile
+import warnings
+import threading
+from sesspy import config, openers, session, source
 
 try:
     import configparser
@@ -180,5 +184,318 @@ class Test_ConfigOption(unittest.TestCase):
             ((sec, opt), {})
         ])
 
+class Test_CachedValues(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = configparser.ConfigParser()
+        self.parser.add_section('general')
+        self.parser.set('general', 'pool_size', '10')
+        self.parser.set('general', 'debug', 'yes')
+        self.parser.set('general', 'hosts', 'a, b,\nc')
+        self.reader = config.LazyConfigReader(self.parser, [])
+
+    def test_converters(self):
+        self.assertEqual(config.ConfigOption(
+            self.reader, 'general', 'pool_size', int)(), 10)
+        self.assertEqual(config.ConfigOption(
+            self.reader, 'general', 'pool_size', float)(), 10.0)
+        self.assertEqual(config.ConfigOption(
+            self.reader, 'general', 'debug', bool)(), True)
+        self.assertEqual(config.ConfigOption(
+            self.reader, 'general', 'hosts', list)(), ['a', 'b', 'c'])
+        self.assertEqual(config.ConfigOption(
+            self.reader, 'general', 'debug', str.upper)(), 'YES')
+        self.assertRaises(ValueError, config.ConfigOption(
+            self.reader, 'general', 'hosts', bool))
+
+    def test_cached_until_generation_changes(self):
+        co = config.ConfigOption(self.reader, 'general', 'pool_size', int)
+        self.assertEqual(co(), 10)
+        self.parser.set('general', 'pool_size', '20')
+        self.assertEqual(co(), 10)
+        self.reader.invalidate()
+        self.assertEqual(co(), 20)
+
+    def test_unconfigured_is_cached(self):
+        co = config.ConfigOption(self.reader, 'general', 'missing')
+        self.assertRaises(config.FeatureUnconfigured, co)
+        self.parser.set('general', 'missing', 'x')
+        self.assertRaises(config.FeatureUnconfigured, co)
+        self.reader.invalidate()
+        self.assertEqual(co(), 'x')
+
+    def test_read_bumps_generation(self):
+        generation = self.reader.generation
+        self.reader()
+        self.assertEqual(self.reader.generation, generation + 1)
+        self.reader()
+        self.assertEqual(self.reader.generation, generation + 1)
+
+    def test_section(self):
+        section = config.ConfigSection(
+            self.reader, 'general', {'pool_size': int, 'debug': bool})
+        values = section()
+        self.assertEqual(values, {
+            'pool_size': 10, 'debug': True, 'hosts': 'a, b,\nc',
+        })
+        self.parser.set('general', 'pool_size', '20')
+        self.assertTrue(section() is values)
+        self.reader.invalidate()
+        self.assertEqual(section()['pool_size'], 20)
+        self.assertEqual(section.option('debug')(), True)
+        self.assertRaises(config.FeatureUnconfigured,
+                          config.ConfigSection(self.reader, 'missing'))
+
+class Test_Reload(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, 'base.conf'),
+                      os.path.join(self.dir, 'local.conf')]
+        self.write(0, '[db]\nuri = sqlite://\npool_size = 5\n')
+        self.reader = config.LazyConfigReader(
+            configparser.ConfigParser(), self.paths,
+            reload_interval=3600)
+        self.addCleanup(self.reader.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, index, text):
+        with open(self.paths[index], 'w') as conffile:
+            conffile.write(text)
+
+    def test_reload_changed_files(self):
+        pool_size = config.ConfigOption(self.reader, 'db', 'pool_size', int)
+        self.assertEqual(pool_size(), 5)
+        self.assertEqual(self.reader.read_paths, self.paths[:1])
+        self.assertEqual(self.reader.reload(), set())
+
+        self.write(1, '[db]\npool_size = 10\n')
+        self.assertEqual(self.reader.reload(), set([('db', 'pool_size')]))
+        self.assertEqual(pool_size(), 10)
+        self.assertEqual(self.reader.read_paths, self.paths)
+
+        # the earlier file does not override the later one
+        self.write(0, '[db]\nuri = sqlite:///x\npool_size = 7\n')
+        self.assertEqual(self.reader.reload(), set([('db', 'uri')]))
+        self.assertEqual(pool_size(), 10)
+
+        os.remove(self.paths[1])
+        self.assertEqual(self.reader.reload(), set([('db', 'pool_size')]))
+        self.assertEqual(pool_size(), 7)
+
+    def test_removed_options_and_sections(self):
+        self.write(1, '[extra]\nkey = value\n')
+        self.reader()
+        self.write(0, '[db]\nuri = sqlite://\n')
+        os.remove(self.paths[1])
+        self.assertEqual(self.reader.reload(), set([
+            ('db', 'pool_size'), ('extra', 'key'),
+        ]))
+        self.assertEqual(self.reader.config.sections(), ['db'])
+        self.assertRaises(config.FeatureUnconfigured, config.ConfigOption(
+            self.reader, 'db', 'pool_size'))
+
+    def test_defaults_changed(self):
+        self.reader()
+        self.write(1, '[DEFAULT]\npool_size = 1\n')
+        self.assertEqual(self.reader.reload(), set([
+            ('DEFAULT', 'pool_size'),
+        ]))
+        self.write(0, '[db]\nuri = sqlite://\n')
+        self.assertEqual(self.reader.reload(), set([('db', 'pool_size')]))
+        self.assertEqual(self.reader.config.get('db', 'pool_size'), '1')
+
+    def test_parse_error_keeps_values(self):
+        self.reader()
+        self.write(0, 'garbage')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(self.reader.reload(), set())
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(self.reader.config.get('db', 'pool_size'), '5')
+
+    def test_dependents_notified(self):
+        dependent = mock.Mock(spec=['config_changed'])
+        self.reader()
+        self.reader.add_dependent(dependent)
+        self.write(0, '[db]\nuri = sqlite://\npool_size = 50\n')
+        self.reader.reload()
+        dependent.config_changed.assert_called_once_with(
+            self.reader, set([('db', 'pool_size')]))
+
+    def test_watcher(self):
+        reader = config.LazyConfigReader(
+            configparser.ConfigParser(), self.paths, reload_interval=0.01)
+        self.addCleanup(reader.stop)
+        reloaded = threading.Event()
+        dependent = mock.Mock(spec=['config_changed'])
+        dependent.config_changed.side_effect = \
+            lambda *args: reloaded.set()
+        reader.add_dependent(dependent)
+        self.assertEqual(reader.config, reader())
+        self.write(1, '[db]\npool_size = 10\n')
+        self.assertTrue(reloaded.wait(5))
+        self.assertEqual(reader.config.get('db', 'pool_size'), '10')
+
+    def test_source_reloaded(self):
+        uri = config.ConfigOption(self.reader, 'db', 'uri')
+        size = config.ConfigOption(self.reader, 'db', 'pool_size', int)
+        dispose_instance = mock.Mock()
+        gfs = source.GuardedFactorySource(
+            lambda *args: args,
+            args=lambda: ((uri(), size()), {}),
+            dispose_instance=dispose_instance,
+        )
+        factory = session.SessionFactory(
+            gfs, source.sessionless_source_adapter,
+            openers.CountingOpener, local_openers=session.LocalOpeners())
+        with factory() as instance:
+            self.assertEqual(instance, ('sqlite://', 5))
+
+        self.write(1, '[db]\nunrelated = 1\n')
+        self.reader.reload()
+        self.assertEqual(gfs.generation, 0)
+
+        self.write(1, '[db]\npool_size = 10\n')
+        self.reader.reload()
+        self.assertEqual(gfs.generation, 1)
+        dispose_instance.assert_called_once_with(('sqlite://', 5))
+        with factory() as instance:
+            self.assertEqual(instance, ('sqlite://', 10))
+
+    def test_source_reloaded_through_section(self):
+        db = config.ConfigSection(self.reader, 'db', {'pool_size': int})
+        dispose_instance = mock.Mock()
+        gfs = source.GuardedFactorySource(
+            lambda **kwargs: kwargs,
+            args=lambda: ((), dict(db())),
+            dispose_instance=dispose_instance,
+        )
+        self.assertEqual(gfs(), {'uri': 'sqlite://', 'pool_size': 5})
+
+        self.write(1, '[other]\nkey = 1\n')
+        self.reader.reload()
+        self.assertEqual(gfs.generation, 0)
+
+        # a new option of the section counts as a change too
+        self.write(1, '[db]\necho = true\n')
+        self.reader.reload()
+        self.assertEqual(gfs.generation, 1)
+        self.assertEqual(gfs(), {'uri': 'sqlite://', 'pool_size': 5,
+                                 'echo': 'true'})
+        dispose_instance.assert_called_once_with(
+            {'uri': 'sqlite://', 'pool_size': 5})
+
+class Test_Snapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, 'base.conf'),
+                      os.path.join(self.dir, 'local.conf')]
+        self.snapshot_path = os.path.join(self.dir, 'snapshot')
+        self.write(0, '[DEFAULT]\ntimeout = 3\n'
+                      '[db]\nuri = sqlite://\npool_size = 5\n')
+        self.write(1, '[db]\npool_size = 10\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, index, text):
+        with open(self.paths[index], 'w') as conffile:
+            conffile.write(text)
+
+    def reader(self):
+        return config.LazyConfigReader(configparser.ConfigParser(),
+                                       self.paths,
+                                       snapshot_path=self.snapshot_path)
+
+    def check(self, conf, pool_size='10'):
+        self.assertEqual(conf.get('db', 'uri'), 'sqlite://')
+        self.assertEqual(conf.get('db', 'pool_size'), pool_size)
+        self.assertEqual(conf.get('db', 'timeout'), '3')
+
+    def test_snapshot_used(self):
+        reader = self.reader()
+        self.check(reader())
+        self.assertTrue(os.path.exists(self.snapshot_path))
+        self.assertEqual(reader.read_paths, self.paths)
+
+        reader = self.reader()
+        with mock.patch.object(config.LazyConfigReader, '_parse_file') as parse:
+            self.check(reader())
+        self.assertEqual(parse.called, False)
+        self.assertEqual(reader.read_paths, self.paths)
+        self.assertEqual(reader.generation, 1)
+
+    def test_stale_snapshot(self):
+        self.reader()()
+        self.write(1, '[db]\npool_size = 20\n')
+        self.check(self.reader()(), '20')
+        # the snapshot was replaced
+        with mock.patch.object(config.LazyConfigReader, '_parse_file') as parse:
+            self.check(self.reader()(), '20')
+        self.assertEqual(parse.called, False)
+
+    def test_other_paths(self):
+        self.reader()()
+        reader = config.LazyConfigReader(configparser.ConfigParser(),
+                                         self.paths[:1],
+                                         snapshot_path=self.snapshot_path)
+        self.check(reader(), '5')
+
+    def test_corrupt_snapshot(self):
+        for data in b'', b'garbage':
+            with open(self.snapshot_path, 'wb') as snapshot:
+                snapshot.write(data)
+            self.check(self.reader()())
+
+    def test_unwritable_snapshot(self):
+        reader = config.LazyConfigReader(
+            configparser.ConfigParser(), self.paths,
+            snapshot_path=os.path.join(self.dir, 'missing', 'snapshot'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.check(reader())
+        self.assertEqual(len(caught), 1)
+
+class Test_ReadModes(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.paths = [os.path.join(self.dir, 'a.ini'),
+                      os.path.join(self.dir, 'b.ini')]
+        with open(self.paths[0], 'w') as conffile:
+            conffile.write('[DEFAULT]\nx = 1\n[s]\nx = 1\ny = 2\n[empty]\n')
+        with open(self.paths[1], 'w') as conffile:
+            conffile.write('[DEFAULT]\nx = 2\n')
+
+    def read(self, **kwargs):
+        reader = config.LazyConfigReader(configparser.ConfigParser(),
+                                         self.paths, **kwargs)
+        self.addCleanup(reader.stop)
+        conf = reader()
+        return reader, dict(
+            (section, dict(conf.items(section, raw=True)))
+            for section in ['DEFAULT'] + conf.sections())
+
+    def test_same_config(self):
+        expected = {
+            'DEFAULT': {'x': '2'},
+            's': {'x': '1', 'y': '2'},
+            'empty': {'x': '2'},
+        }
+        snapshot_path = os.path.join(self.dir, 'snapshot')
+        for kwargs in ({}, {'reload_interval': 3600},
+                       {'snapshot_path': snapshot_path},
+                       {'snapshot_path': snapshot_path}):
+            reader, values = self.read(**kwargs)
+            self.assertEqual(values, expected)
+            self.assertEqual(config.ConfigSection(reader, 'empty')(),
+                             {'x': '2'})
+        self.assertTrue(os.path.exists(snapshot_path))
+
 if __name__ == '__main__':
     unittest.main()
@@ -198,6 +198,317 @@ class Test_MethodDec(unittest.TestCase):
             ((None, None, None), {}),
         ])
 
+class _Cached(object):
+    cref = ref.ComponentRef(mock.Mock(spec=[]))
+
+    def method(self, component):
+        return self, component
+    method = dec.ComponentInjector(cref, method, 'component')
+
+class Test_BoundInjector(unittest.TestCase):
+    def test_bound_to_instance(self):
+        c = _Cached()
+        m = c.method
+        self.assertTrue(m.func.__self__ is c)
+        self.assertTrue(m.ref is _Cached.cref)
+        self.assertTrue(_Cached().method.func.__self__ is not c)
+
+    def test_nothing_stored_on_instance(self):
+        import gc, weakref
+        c = _Cached()
+        c.method
+        self.assertEqual(vars(c), {})
+        c_ref = weakref.ref(c)
+        gc.disable()
+        try:
+            del c
+            # freed by reference counting, without a cycle
+            self.assertTrue(c_ref() is None)
+        finally:
+            gc.enable()
+
+    def test_ref_override(self):
+        c = _Cached()
+        conf = mock.Mock(spec=[])
+        c.cref = conf
+        self.assertEqual(c.method.ref.ref, conf)
+
+    def test_copied_instance_rebinds(self):
+        import copy, pickle
+        c = _Cached()
+        c.method
+        c2 = copy.copy(c)
+        self.assertTrue(c2.method.func.__self__ is c2)
+        self.assertTrue(c.method.func.__self__ is c)
+        c3 = copy.deepcopy(c)
+        self.assertTrue(c3.method.func.__self__ is c3)
+        c4 = pickle.loads(pickle.dumps(c))
+        self.assertTrue(c4.method.func.__self__ is c4)
+
+    def test_slotted_instance(self):
+        class S(object):
+            __slots__ = ()
+            method = _Cached.__dict__['method']
+        s = S()
+        self.assertTrue(s.method.func.__self__ is s)
+
+    def test_multi_injector_bound(self):
+        class M(object):
+            @dec.with_components(a=mock.Mock(spec=[]), b=mock.Mock(spec=[]),
+                                 executor=mock.Mock(spec=[]))
+            def method(self, a, b):
+                pass
+        m = M()
+        bound = m.method
+        self.assertTrue(bound.func.__self__ is m)
+        self.assertTrue(bound.executor is M.__dict__['method'].executor)
+        self.assertEqual(bound.arg_kw, M.__dict__['method'].arg_kw)
+
+class Test_CompiledInjector(unittest.TestCase):
+    def setUp(self):
+        self.comp = mock.Mock(spec=[])
+        self.sess = mock.Mock(spec=session.Session)
+        self.sess.open.return_value = self.comp
+        self.cref = mock.Mock(spec=[])
+        self.cref.return_value = self.sess
+
+    def test_injects_and_commits(self):
+        def func(a, b=2, component=None):
+            return a, b, component
+        decf = dec.compile_injector(self.cref, func, 'component')
+        self.assertEqual(decf(1), (1, 2, self.comp))
+        self.assertEqual(self.sess.method_calls, [
+            mock.call.open(), mock.call.commit(),
+        ])
+        self.assertEqual(decf(1, 3, 4), (1, 3, 4))
+        self.assertEqual(decf(1, component=5), (1, 2, 5))
+        self.assertEqual(self.cref.call_count, 1)
+
+    def test_aborts_on_error(self):
+        def func(component):
+            raise KeyError()
+        decf = dec.compile_injector(self.cref, func, 'component')
+        self.assertRaises(KeyError, decf)
+        self.assertEqual(self.sess.method_calls, [
+            mock.call.open(), mock.call.abort(),
+        ])
+
+    def test_signature_kept(self):
+        import inspect
+        def func(a, b=2, *args, **kwargs):
+            "doc"
+        decf = dec.compile_injector(self.cref, func, 'component')
+        self.assertEqual(str(inspect.signature(decf)),
+                         '(a, b=2, *args, **kwargs)')
+        self.assertEqual(decf.__name__, 'func')
+        self.assertEqual(decf.__doc__, 'doc')
+        self.assertRaises(TypeError, decf)
+        self.assertRaises(TypeError, decf, 1, c=3, b=3, a=1)
+        self.assertEqual(self.cref.call_count, 0)
+
+    def test_injects_into_kwargs(self):
+        def func(a, **kwargs):
+            return kwargs
+        decf = dec.compile_injector(self.cref, func, 'component')
+        self.assertEqual(decf(1, x=2), {'x': 2, 'component': self.comp})
+        self.assertEqual(decf(1, component=3), {'component': 3})
+
+    def test_keyword_only(self):
+        def func(a, *args, component, b):
+            return a, args, component, b
+        decf = dec.compile_injector(self.cref, func, 'component')
+        self.assertEqual(decf(1, 2, b=3), (1, (2,), self.comp, 3))
+
+    def test_rejects_unusable_argument(self):
+        self.assertRaises(ValueError, dec.compile_injector,
+                          self.cref, lambda a: None, 'component')
+        self.assertRaises(ValueError, dec.compile_injector,
+                          self.cref, lambda component, a: None, 'component')
+
+    def test_retry(self):
+        policy = mock.Mock(spec=['call'])
+        policy.call.side_effect = lambda f, *a, **kw: f(*a, **kw)
+        def func(a, component=None):
+            return a, component
+        decf = dec.compile_injector(self.cref, func, 'component', policy)
+        self.assertEqual(decf(1), (1, self.comp))
+        self.assertEqual(policy.call.call_count, 1)
+        self.assertEqual(decf(1, 2), (1, 2))
+        self.assertEqual(policy.call.call_count, 1)
+
+    def test_method(self):
+        class C(object):
+            @dec.with_component(self.cref, 'component', compiled=True)
+            def method(self, component):
+                return self, component
+        c = C()
+        self.assertEqual(c.method(), (c, self.comp))
+
+class Test_MultiComponentInjector(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.refs = {}
+        for name in ('db', 'cache'):
+            sess = mock.Mock(spec=session.Session)
+            sess.open.return_value = name + '-instance'
+            sess.open.side_effect = self._log(name, 'open')
+            sess.commit.side_effect = self._log(name, 'commit')
+            sess.abort.side_effect = self._log(name, 'abort')
+            sess.instance_opener = mock.Mock(spec=[])
+            cref = mock.Mock(spec=[])
+            cref.return_value = sess
+            self.refs[name] = cref
+
+    def _log(self, name, call):
+        def side_effect():
+            self.calls.append((name, call))
+            return mock.DEFAULT
+        return side_effect
+
+    def test_opens_and_commits_in_order(self):
+        @dec.with_components(db=self.refs['db'], cache=self.refs['cache'])
+        def func(db, cache):
+            self.calls.append(('func', db, cache))
+            return 5
+        self.assertTrue(isinstance(func, dec.MultiComponentInjector))
+        self.assertEqual(func(), 5)
+        self.assertEqual(self.calls, [
+            ('db', 'open'), ('cache', 'open'),
+            ('func', 'db-instance', 'cache-instance'),
+            ('cache', 'commit'), ('db', 'commit'),
+        ])
+
+    def test_aborts_on_error(self):
+        @dec.with_components(db=self.refs['db'], cache=self.refs['cache'])
+        def func(db, cache):
+            raise KeyError()
+        self.assertRaises(KeyError, func)
+        self.assertEqual(self.calls, [
+            ('db', 'open'), ('cache', 'open'),
+            ('cache', 'abort'), ('db', 'abort'),
+        ])
+
+    def test_failed_commit_aborts_rest(self):
+        self.refs['cache'].return_value.commit.side_effect = KeyError()
+        @dec.with_components(db=self.refs['db'], cache=self.refs['cache'])
+        def func(db, cache):
+            pass
+        self.assertRaises(KeyError, func)
+        self.assertEqual(self.calls, [
+            ('db', 'open'), ('cache', 'open'), ('db', 'abort'),
+        ])
+
+    def test_failed_open_aborts_opened(self):
+        self.refs['cache'].return_value.open.side_effect = KeyError()
+        func = mock.Mock()
+        decf = dec.with_components(db=self.refs['db'],
+                                   cache=self.refs['cache'])(func)
+        self.assertRaises(KeyError, decf)
+        self.assertEqual(self.calls, [('db', 'open'), ('db', 'abort')])
+        self.assertFalse(func.called)
+
+    def test_given_arguments_skipped(self):
+        func = mock.Mock()
+        decf = dec.with_components(db=self.refs['db'],
+                                   cache=self.refs['cache'])(func)
+        decf(cache=1)
+        self.assertEqual(func.call_args_list, [
+            ((), {'db': 'db-instance', 'cache': 1}),
+        ])
+        self.assertFalse(self.refs['cache'].called)
+        decf(db=2, cache=1)
+        self.assertEqual(self.refs['db'].call_count, 1)
+
+    def test_concurrent_open(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        func = mock.Mock()
+        decf = dec.with_components(db=self.refs['db'],
+                                   cache=self.refs['cache'],
+                                   executor=executor)(func)
+        decf()
+        self.assertEqual(func.call_args_list, [
+            ((), {'db': 'db-instance', 'cache': 'cache-instance'}),
+        ])
+        self.assertEqual(self.calls[-2:], [
+            ('cache', 'commit'), ('db', 'commit'),
+        ])
+
+        self.calls[:] = []
+        self.refs['db'].return_value.open.side_effect = KeyError()
+        self.assertRaises(KeyError, decf)
+        self.assertEqual(sorted(self.calls), [
+            ('cache', 'abort'), ('cache', 'open'),
+        ])
+
+    def test_components_as_mapping(self):
+        func = mock.Mock()
+        policy = mock.Mock(spec=['call'])
+        decf = dec.with_components({'retry': self.refs['db'],
+                                    'executor': self.refs['cache']},
+                                   retry=policy)(func)
+        self.assertEqual(decf.arg_kw, ('retry', 'executor'))
+        self.assertTrue(decf.retry is policy)
+        self.assertEqual(decf.executor, None)
+        decf = dec.with_components({'db': self.refs['db']},
+                                   cache=self.refs['cache'])(func)
+        decf()
+        self.assertEqual(func.call_args_list, [
+            ((), {'db': 'db-instance', 'cache': 'cache-instance'}),
+        ])
+        self.assertRaises(TypeError, dec.with_components,
+                          {'db': self.refs['db']}, db=self.refs['cache'])
+        self.assertRaises(TypeError, dec.with_components, {}, {})
+        self.assertRaises(ValueError, dec.with_components, {}, retry=policy)
+
+    def test_method_binds_refs(self):
+        conf = mock.Mock(spec=[])
+        conf.return_value = self.refs['cache'].return_value
+        class C(object):
+            cref = ref.ComponentRef(self.refs['db'])
+            @dec.with_components(db=cref, cache=self.refs['cache'])
+            def method(self, db, cache):
+                return self, db, cache
+        c = C()
+        c.cref = conf
+        self.assertTrue(c.method.func.__self__ is c)
+        self.assertEqual(c.method(), (c, 'cache-instance', 'cache-instance'))
+        self.assertFalse(self.refs['db'].called)
+
+class Test_FunctionAttributes(unittest.TestCase):
+    def test_forwards_function_attributes(self):
+        def func(component):
+            "doc"
+        func.extra = 5
+        decf = dec.ComponentInjector(mock.Mock(), func, 'component')
+        self.assertEqual(decf.__name__, 'func')
+        self.assertEqual(decf.__doc__, 'doc')
+        self.assertEqual(decf.__module__, __name__)
+        self.assertEqual(decf.extra, 5)
+        self.assertRaises(AttributeError, lambda: decf.missing)
+
+    def test_attributes_can_be_set(self):
+        def func(component):
+            pass
+        func.extra = 5
+        decf = dec.ComponentInjector(mock.Mock(), func, 'component')
+        decf.exposed = True
+        self.assertEqual(decf.exposed, True)
+        decf.extra = 6
+        self.assertEqual(decf.extra, 6)
+        self.assertEqual(func.extra, 5)
+        del decf.exposed
+        self.assertRaises(AttributeError, lambda: decf.exposed)
+        multi = dec.MultiComponentInjector([mock.Mock()], func, ['component'])
+        multi.exposed = True
+        self.assertEqual(multi.exposed, True)
+
+    def test_class_attributes_kept(self):
+        self.assertEqual(dec.ComponentInjector.__module__, 'sesspy.dec')
+        self.assertTrue(dec.ComponentInjector.__doc__.strip().startswith(
+            'Function decorator'))
+
 class Test_DecHelper(unittest.TestCase):
     def test_builds_injector(self):
         inj = mock.Mock()
@@ -34,6 +34,7 @@ import sys
 import unittest
 import mock
 import threading
+import asyncio
 from sesspy import local
 
 class Test_Local(unittest.TestCase):
@@ -85,5 +86,169 @@ class Test_Local(unittest.TestCase):
         l.q = o
         self.assertEqual(l.__dict__['q'], o)
 
+    def test_subclass_fails(self):
+        class L(local.Local):
+            __slots__ = ()
+        self.assertRaises(TypeError, L)
+
+class Test_LocalDict(unittest.TestCase):
+    def test_init_visible_everywhere(self):
+        d = local.LocalDict({'a': 1})
+        res = []
+        def run():
+            res.append(d['a'])
+            d['a'] = 2
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(res, [1])
+        self.assertEqual(d['a'], 1)
+
+    def test_delete(self):
+        d = local.LocalDict({'a': 1})
+        del d['a']
+        self.assertFalse('a' in d)
+        self.assertRaises(KeyError, d.__delitem__, 'a')
+
+    def test_init_copied_on_first_write(self):
+        init = {'a': 1}
+        d = local.LocalDict(init)
+        d['b'] = 2
+        self.assertEqual(init, {'a': 1})
+        self.assertEqual(d.copy(), {'a': 1, 'b': 2})
+        res = []
+        def run():
+            res.append(d.copy())
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(res, [{'a': 1}])
+
+    def test_dict_arguments(self):
+        self.assertEqual(local.LocalDict(a=1).copy(), {'a': 1})
+        self.assertEqual(local.LocalDict([('a', 1)], b=2).copy(),
+                         {'a': 1, 'b': 2})
+        d = local.LocalDict(a=1, scope=local.ContextVarScope())
+        self.assertEqual(d.copy(), {'a': 1})
+        self.assertTrue(isinstance(d._local__scope, local.ContextVarScope))
+
+    def test_thread_scope_subclass(self):
+        class Scope(local.ThreadScope):
+            pass
+        scope = Scope()
+        d = local.LocalDict(scope=scope)
+        d['a'] = 1
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(scope.get(d._local__key), {'a': 1})
+        res = []
+        def run():
+            res.append('a' in d)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(res, [False])
+
+class Test_ContextVarScope(unittest.TestCase):
+    def test_task_local(self):
+        l = local.Local(local.ContextVarScope())
+        l.a = 'outer'
+        seen = []
+        async def task(n):
+            seen.append(l.a)
+            l.a = n
+            await asyncio.sleep(0)
+            return l.a
+        async def main():
+            return await asyncio.gather(task(1), task(2))
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(main()), [1, 2])
+        finally:
+            loop.close()
+        self.assertEqual(seen, ['outer', 'outer'])
+        self.assertEqual(l.a, 'outer')
+
+    def test_unset_in_other_context(self):
+        import contextvars
+        l = local.Local(local.ContextVarScope())
+        ctx = contextvars.copy_context()
+        l.a = 1
+        self.assertRaises(AttributeError, ctx.run, lambda: l.a)
+
+    def test_not_inherited(self):
+        l = local.Local(local.ContextVarScope(inherit=False))
+        l.a = 'outer'
+        seen = []
+        async def task(n):
+            seen.append(hasattr(l, 'a'))
+            l.a = n
+            await asyncio.sleep(0)
+            return l.a
+        async def main():
+            return await asyncio.gather(task(1), task(2))
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(main()), [1, 2])
+        finally:
+            loop.close()
+        self.assertEqual(seen, [False, False])
+        self.assertEqual(l.a, 'outer')
+
+class Test_GreenletScope(unittest.TestCase):
+    def setUp(self):
+        try:
+            import greenlet
+        except ImportError:
+            self.skipTest("greenlet is not installed")
+
+    def test_greenlet_local(self):
+        import greenlet
+        l = local.Local(local.GreenletScope())
+        l.a = 1
+        res = []
+        def run():
+            res.append(hasattr(l, 'a'))
+            l.a = 2
+        greenlet.greenlet(run).switch()
+        self.assertEqual(res, [False])
+        self.assertEqual(l.a, 1)
+
+class Test_RequestScope(unittest.TestCase):
+    def test_push_pop(self):
+        scope = local.RequestScope()
+        l = local.Local(scope)
+        l.a = 0
+        with scope.scope() as storage:
+            self.assertFalse(hasattr(l, 'a'))
+            l.a = 1
+            scope.push()
+            l.a = 2
+            self.assertEqual(l.a, 2)
+            scope.pop()
+            self.assertEqual(l.a, 1)
+        self.assertEqual(len(storage), 1)
+        self.assertEqual(l.a, 0)
+
+    def test_pop_empty(self):
+        scope = local.RequestScope()
+        self.assertRaises(IndexError, scope.pop)
+
+    def test_stack_is_thread_local(self):
+        scope = local.RequestScope()
+        l = local.Local(scope)
+        scope.push()
+        l.a = 1
+        res = []
+        def run():
+            l.a = 2
+            res.append(l.a)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(res, [2])
+        self.assertEqual(l.a, 1)
+        scope.pop()
+        self.assertFalse(hasattr(l, 'a'))
+
 if __name__ == '__main__':
     unittest.main()
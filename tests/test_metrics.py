@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+if __name__ == '__main__':
+    import sys
+    import os, os.path
+    sys.path.insert(
+        0,
+        os.path.dirname(
+            os.path.dirname(
+                os.path.realpath(
+                    os.path.abspath(__file__)
+                )
+            )
+        )
+    )
+
+import unittest
+import asyncio
+import mock
+from sesspy import aio, metrics, session, source
+
+class Test_Histogram(unittest.TestCase):
+    def test_empty(self):
+        h = metrics.Histogram()
+        self.assertEqual(h.percentile(50), None)
+        self.assertEqual(h.snapshot()['mean'], None)
+
+    def test_percentiles(self):
+        h = metrics.Histogram()
+        for i in range(1, 1001):
+            h.record(i / 1000.0)
+        self.assertEqual(h.count, 1000)
+        self.assertEqual(h.min, 0.001)
+        self.assertEqual(h.max, 1.0)
+        for percent, expected in ((50, 0.5), (90, 0.9), (99, 0.99)):
+            value = h.percentile(percent)
+            self.assertTrue(abs(value - expected) <= expected / 64,
+                            (percent, value))
+        self.assertAlmostEqual(h.snapshot()['mean'], 0.5005)
+
+    def test_bounded_buckets(self):
+        h = metrics.Histogram(significant_bits=4)
+        for i in range(10000):
+            h.record(i / 1000000.0)
+        self.assertTrue(len(h.counts) < 200)
+
+class Test_Metrics(unittest.TestCase):
+    def test_component_snapshot(self):
+        m = metrics.Metrics()
+        c = m.component('db')
+        self.assertTrue(m.component('db') is c)
+        c.record('open', 0.25)
+        c.increment('opened')
+        snap = m.snapshot()
+        self.assertEqual(snap['db']['counters'], {'opened': 1})
+        self.assertEqual(snap['db']['histograms']['open']['count'], 1)
+        m.reset()
+        self.assertEqual(m.snapshot(), {'db': {'counters': {},
+                                               'histograms': {}}})
+
+class Test_Instrumentation(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.ComponentMetrics('db')
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+
+    def factory(self, **kwargs):
+        return session.SessionFactory(
+            mock.Mock(), mock.Mock(return_value=self.opener),
+            local_openers=False, **kwargs
+        )
+
+    def test_disabled_by_default(self):
+        s = self.factory()()
+        self.assertEqual(type(s), session.Session)
+
+    def test_records_session(self):
+        sf = self.factory(metrics=self.metrics)
+        s = sf()
+        self.assertTrue(isinstance(s, session.InstrumentedSession))
+        with s:
+            pass
+        s = sf()
+        s.open()
+        s.abort()
+        snap = self.metrics.snapshot()
+        self.assertEqual(snap['counters'], {
+            'openers': 2, 'opened': 2, 'committed': 1, 'aborted': 1,
+        })
+        self.assertEqual(sorted(snap['histograms']), [
+            'abort', 'commit', 'create_opener', 'held', 'open',
+        ])
+        self.assertEqual(snap['histograms']['held']['count'], 2)
+
+    def test_records_failures(self):
+        self.opener.commit.side_effect = ValueError
+        s = self.factory(metrics=self.metrics)()
+        s.open()
+        self.assertRaises(ValueError, s.commit)
+        snap = self.metrics.snapshot()
+        self.assertEqual(snap['counters']['commit_failed'], 1)
+        self.assertEqual(snap['histograms']['commit']['count'], 1)
+
+    def test_invalid_calls_not_recorded(self):
+        s = self.factory(metrics=self.metrics)()
+        self.assertRaises(session.SessionStateException, s.commit)
+        self.assertEqual(self.metrics.snapshot()['counters'], {'openers': 1})
+
+    def test_guarded_source(self):
+        src = source.GuardedFactorySource(mock.Mock(), metrics=self.metrics)
+        src()
+        src()
+        histograms = self.metrics.snapshot()['histograms']
+        self.assertEqual(histograms['source_create']['count'], 1)
+        self.assertEqual(histograms['source_lock_wait']['count'], 1)
+
+    def test_async_session(self):
+        opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        opener.open = mock.AsyncMock()
+        opener.commit = mock.AsyncMock()
+        sf = aio.AsyncSessionFactory(mock.Mock(), mock.Mock(return_value=opener),
+                                     metrics=self.metrics)
+        async def body():
+            async with sf():
+                pass
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(body())
+        finally:
+            loop.close()
+        self.assertEqual(self.metrics.snapshot()['counters'], {
+            'openers': 1, 'opened': 1, 'committed': 1,
+        })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,9 +32,11 @@ if __name__ == '__main__':
         )
     )
 
+import sys
 import unittest
 import mock
-from sesspy import openers
+import threading
+from sesspy import local, openers, session, source
 
 class Test_CountingOpener(unittest.TestCase):
 
@@ -160,6 +162,68 @@ class Test_CountingOpener(unittest.TestCase):
             ])
             self.assertEqual(warn.called, False)
 
+    def test_close_closes_owned_opener(self):
+        class Owned(object):
+            close_with_opener = True
+            close = mock.Mock()
+        owned = Owned()
+        openers.CountingOpener(owned).close()
+        Owned.close.assert_called_once_with(owned)
+        Owned.close.reset_mock()
+        openers.LazyCountingOpener(owned).close()
+        Owned.close.assert_called_once_with(owned)
+
+class Test_CountingOpener_savepoints(unittest.TestCase):
+
+    def setUp(self):
+        self.instance_opener = mock.Mock(spec=[
+            'open', 'commit', 'abort',
+            'savepoint', 'release_savepoint', 'rollback_savepoint',
+        ])
+        self.instance = mock.Mock(spec=[])
+        self.instance_opener.open.return_value = self.instance
+        self.savepoints = [mock.Mock(spec=[]), mock.Mock(spec=[])]
+        self.instance_opener.savepoint.side_effect = list(self.savepoints)
+
+    def test_nested_abort_rolls_back_savepoint(self):
+        opener = openers.CountingOpener(self.instance_opener, savepoints=True)
+        inst = opener.open()
+        opener.open()
+        opener.open()
+        opener.commit(inst)
+        opener.abort(inst)
+        opener.commit(inst)
+        sp1, sp2 = self.savepoints
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('savepoint', (inst,), {}),
+            ('savepoint', (inst,), {}),
+            ('release_savepoint', (inst, sp2), {}),
+            ('rollback_savepoint', (inst, sp1), {}),
+            ('commit', (inst,), {}),
+        ])
+
+    def test_no_savepoints_by_default(self):
+        opener = openers.CountingOpener(self.instance_opener)
+        inst = opener.open()
+        opener.open()
+        opener.abort(inst)
+        opener.commit(inst)
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('commit', (inst,), {}),
+        ])
+
+    def test_unsupported_opener(self):
+        instance_opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        opener = openers.CountingOpener(instance_opener, savepoints=True)
+        inst = opener.open()
+        opener.open()
+        opener.abort(inst)
+        opener.commit(inst)
+        self.assertEqual([m[0] for m in instance_opener.method_calls],
+                         ['open', 'commit'])
+
 class Test_LazyCountingOpener(unittest.TestCase):
 
     def test_reopen_keeps(self):
@@ -243,5 +307,322 @@ class Test_LazyCountingOpener(unittest.TestCase):
             ('commit', (instance,), {}),
         ])
 
+class Test_PoolingOpener(unittest.TestCase):
+
+    def setUp(self):
+        self.instance_opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.instance_opener.open.side_effect = lambda: mock.Mock(spec=[])
+
+    def test_reuses_instances(self):
+        opener = openers.PoolingOpener(self.instance_opener)
+        inst = opener.open()
+        opener.commit(inst)
+        self.assertEqual(opener.open(), inst)
+        opener.commit(inst)
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('commit', (inst,), {}),
+            ('commit', (inst,), {}),
+        ])
+
+    def test_aborted_instances_discarded(self):
+        close_instance = mock.Mock()
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       close_instance=close_instance)
+        inst = opener.open()
+        opener.abort(inst)
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('abort', (inst,), {}),
+        ])
+        close_instance.assert_called_once_with(inst)
+        self.assertEqual(len(opener.idle), 0)
+        self.assertEqual(opener.size, 0)
+        self.assertFalse(opener.open() is inst)
+
+    def test_aborted_instances_reset(self):
+        reset = mock.Mock()
+        opener = openers.PoolingOpener(self.instance_opener, reset=reset)
+        inst = opener.open()
+        opener.abort(inst)
+        self.assertEqual(self.instance_opener.abort.call_args_list, [
+            ((inst,), {}),
+        ])
+        reset.assert_called_once_with(inst)
+        self.assertEqual(opener.open(), inst)
+
+    def test_failed_commit_discards(self):
+        close_instance = mock.Mock()
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       close_instance=close_instance)
+        self.instance_opener.commit.side_effect = ValueError
+        inst = opener.open()
+        self.assertRaises(ValueError, opener.commit, inst)
+        close_instance.assert_called_once_with(inst)
+        self.assertEqual(opener.size, 0)
+
+    def test_lifo_fifo(self):
+        opener = openers.PoolingOpener(self.instance_opener)
+        a, b = opener.open(), opener.open()
+        opener.commit(a)
+        opener.commit(b)
+        self.assertEqual(opener.open(), b)
+
+        opener = openers.PoolingOpener(self.instance_opener, lifo=False)
+        a, b = opener.open(), opener.open()
+        opener.commit(a)
+        opener.commit(b)
+        self.assertEqual(opener.open(), a)
+
+    def test_overflow_discarded(self):
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       max_size=1, max_overflow=1)
+        a, b = opener.open(), opener.open()
+        opener.commit(a)
+        opener.commit(b)
+        self.assertEqual(list(opener.idle), [a])
+        self.assertEqual(opener.size, 1)
+        self.assertEqual(self.instance_opener.commit.call_args_list, [
+            ((a,), {}),
+            ((b,), {}),
+        ])
+
+    def test_timeout(self):
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       max_size=1, max_overflow=0,
+                                       timeout=0.01)
+        inst = opener.open()
+        self.assertRaises(openers.PoolTimeout, opener.open)
+        opener.commit(inst)
+        self.assertEqual(opener.open(), inst)
+
+    def test_waits_for_checkin(self):
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       max_size=1, max_overflow=0,
+                                       timeout=None)
+        inst = opener.open()
+        res = []
+        thread = threading.Thread(target=lambda: res.append(opener.open()))
+        thread.start()
+        opener.commit(inst)
+        thread.join()
+        self.assertEqual(res, [inst])
+
+    def test_failed_open_releases(self):
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       max_size=1, max_overflow=0)
+        self.instance_opener.open.side_effect = ValueError
+        self.assertRaises(ValueError, opener.open)
+        self.assertEqual(opener.size, 0)
+
+    def test_pre_ping_discards(self):
+        pre_ping = mock.Mock(return_value=False)
+        close_instance = mock.Mock()
+        opener = openers.PoolingOpener(self.instance_opener,
+                                       pre_ping=pre_ping,
+                                       close_instance=close_instance)
+        inst = opener.open()
+        opener.commit(inst)
+        inst2 = opener.open()
+        self.assertFalse(inst2 is inst)
+        self.assertEqual(pre_ping.call_args_list, [((inst,), {})])
+        close_instance.assert_called_once_with(inst)
+        self.assertEqual(opener.size, 1)
+
+    def test_not_closed_by_counting_opener(self):
+        factory = openers.combine_openers(
+            openers.pooling_opener(),
+            openers.CountingOpener,
+        )
+        first = factory(self.instance_opener)
+        second = factory(self.instance_opener)
+        first.commit(first.open())
+        # e.g. the first opener's thread exiting
+        first.close()
+        self.assertEqual(first.session_opener.closed, False)
+        second.commit(second.open())
+        self.assertEqual(self.instance_opener.open.call_count, 1)
+
+    def test_reset_failure_discards(self):
+        reset = mock.Mock(side_effect=ValueError)
+        opener = openers.PoolingOpener(self.instance_opener, reset=reset)
+        inst = opener.open()
+        opener.abort(inst)
+        self.assertEqual(len(opener.idle), 0)
+        self.assertEqual(self.instance_opener.abort.call_args_list, [
+            ((inst,), {}),
+        ])
+
+    def test_close(self):
+        opener = openers.PoolingOpener(self.instance_opener)
+        a, b = opener.open(), opener.open()
+        opener.commit(a)
+        opener.close()
+        opener.commit(b)
+        self.assertEqual(self.instance_opener.commit.call_args_list, [
+            ((a,), {}),
+            ((b,), {}),
+        ])
+        self.assertEqual(opener.size, 0)
+
+    def test_factory_shares_pool(self):
+        factory = openers.pooling_opener(max_size=2)
+        p1 = factory(self.instance_opener)
+        p2 = factory(mock.Mock())
+        self.assertTrue(p1 is p2)
+        self.assertEqual(p1.max_size, 2)
+        self.assertTrue(p1.session_opener is self.instance_opener)
+
+    def test_factory_recreates_pool_after_fork(self):
+        factory = openers.pooling_opener()
+        p1 = factory(self.instance_opener)
+        factory._after_fork()
+        other = mock.Mock()
+        p2 = factory(other)
+        self.assertFalse(p1 is p2)
+        self.assertTrue(p2.session_opener is other)
+        self.assertTrue(factory(mock.Mock()) is p2)
+        self.assertTrue(p1 in local._inherited_from_parent)
+        local._inherited_from_parent.remove(p1)
+
+class Test_GroupCommitOpener(unittest.TestCase):
+
+    def setUp(self):
+        self.instance_opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.instance_opener.open.side_effect = lambda: mock.Mock(spec=[])
+
+    def run_threads(self, opener, actions):
+        started = threading.Barrier(len(actions))
+        opened = threading.Barrier(len(actions))
+        errors = []
+        def run(action):
+            started.wait()
+            inst = opener.open()
+            opened.wait()
+            try:
+                getattr(opener, action)(inst)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+        threads = [threading.Thread(target=run, args=(action,))
+                   for action in actions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_single_session(self):
+        opener = openers.GroupCommitOpener(self.instance_opener, window=0)
+        inst = opener.open()
+        opener.commit(inst)
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('commit', (inst,), {}),
+        ])
+        self.assertFalse(opener.open() is inst)
+
+    def test_concurrent_commits_grouped(self):
+        opener = openers.GroupCommitOpener(self.instance_opener,
+                                           max_batch=4, window=60)
+        errors = self.run_threads(opener, ['commit'] * 4)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.instance_opener.open.call_count, 1)
+        self.assertEqual(self.instance_opener.commit.call_count, 1)
+        self.assertEqual(opener.groups, {})
+
+    def test_max_batch_seals(self):
+        opener = openers.GroupCommitOpener(self.instance_opener,
+                                           max_batch=2, window=60)
+        a = opener.open()
+        b = opener.open()
+        thread = threading.Thread(target=opener.commit, args=(a,))
+        thread.start()
+        opener.commit(b)
+        thread.join()
+        self.assertEqual(self.instance_opener.method_calls, [
+            ('open', (), {}),
+            ('commit', (a,), {}),
+        ])
+
+    def test_abort_aborts_group(self):
+        opener = openers.GroupCommitOpener(self.instance_opener, window=60)
+        errors = self.run_threads(opener, ['commit', 'commit', 'abort'])
+        self.assertEqual(len(errors), 2)
+        for error in errors:
+            self.assertTrue(isinstance(error, openers.GroupCommitAborted))
+        self.assertEqual(self.instance_opener.commit.call_count, 0)
+        self.assertEqual(self.instance_opener.abort.call_count, 1)
+
+    def test_commit_failure_raised(self):
+        opener = openers.GroupCommitOpener(self.instance_opener, window=0)
+        self.instance_opener.commit.side_effect = ValueError
+        inst = opener.open()
+        self.assertRaises(ValueError, opener.commit, inst)
+        self.assertEqual(opener.groups, {})
+
+    def test_nested_sessions_do_not_wait(self):
+        opener = openers.GroupCommitOpener(self.instance_opener,
+                                           window=0.01)
+        def run():
+            outer = opener.open()
+            inner = opener.open()
+            self.assertTrue(inner is outer)
+            opener.commit(inner)
+            self.assertEqual(self.instance_opener.commit.call_count, 0)
+            opener.commit(outer)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.instance_opener.commit.call_count, 1)
+        self.assertEqual(opener.groups, {})
+
+    def test_nested_session_factory_sessions(self):
+        sf = session.SessionFactory(
+            mock.Mock(), mock.Mock(return_value=self.instance_opener),
+            opener_factory=openers.group_commit_opener(window=0.01),
+            local_openers=session.LocalOpeners(),
+        )
+        def run():
+            with sf():
+                with sf():
+                    pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.instance_opener.commit.call_count, 1)
+
+    def test_same_instance_for_all_groups(self):
+        opener = openers.GroupCommitOpener(
+            source.sessionless_source_adapter(object()),
+            max_batch=1, window=60)
+        outer = opener.open()
+        errors = []
+        def run():
+            inst = opener.open()
+            try:
+                opener.commit(inst)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+        # the thread's commit seals the group, and waits for the outer session
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        while opener.group is not None:
+            thread.join(0.001)
+        inner = opener.open()
+        self.assertTrue(inner is outer)
+        self.assertEqual(len(opener.groups), 2)
+        opener.commit(inner)
+        opener.commit(outer)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+        self.assertEqual(opener.groups, {})
+        self.assertEqual(opener.threads, {})
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,7 +32,9 @@ if __name__ == '__main__':
         )
     )
 
+import sys
 import unittest
+import threading
 import mock
 from sesspy import registry, ref, session
 
@@ -53,5 +55,143 @@ class Test_Registry(unittest.TestCase):
                           "component", config2)
         self.assertEqual(reg["component"].ref, config)
 
+    def test_refs_are_cached(self):
+        config = mock.Mock(spec=[])
+        reg = registry.ComponentRegistry()
+        reg.register_component("component", config)
+        self.assertTrue(reg["component"] is reg["component"])
+        self.assertTrue(reg.get("component") is reg.get("component"))
+
+    def test_resolution_is_shared(self):
+        config = mock.Mock(spec=[])
+        reg = registry.ComponentRegistry()
+        reg.register_component("component", config)
+        self.assertEqual(ref.ComponentRef("component", reg=reg).resolve(),
+                         config)
+        self.assertEqual(reg.resolution_cache.entries["component"][0],
+                         config)
+        reg.components.clear()
+        self.assertEqual(ref.ComponentRef("component", reg=reg).resolve(),
+                         config)
+
+    def test_failure_cached_until_registered(self):
+        config = mock.Mock(spec=[])
+        lookups = []
+        class Components(dict):
+            def __getitem__(self, name):
+                lookups.append(name)
+                return dict.__getitem__(self, name)
+        reg = registry.ComponentRegistry()
+        reg.components = Components()
+        cref = ref.ComponentRef("component", reg=reg)
+        self.assertRaises(ref.ResolveError, cref.resolve)
+        self.assertRaises(ref.ResolveError, cref.resolve)
+        self.assertEqual(lookups, ["component"])
+
+        reg.register_component("component", config)
+        self.assertEqual(cref.resolve(), config)
+
+    def test_failure_expires(self):
+        reg = registry.ComponentRegistry(negative_ttl=0)
+        cref = ref.ComponentRef("component", reg=reg)
+        self.assertRaises(ref.ResolveError, cref.resolve)
+        reg.components["component"] = config = mock.Mock(spec=[])
+        self.assertEqual(cref.resolve(), config)
+
+    def test_import_failure_cached(self):
+        import sys
+        modname = '__test_registry_cache'
+        reg = registry.ComponentRegistry()
+        cref = ref.ComponentRef(modname + '.config', reg=reg)
+        with mock.patch('sesspy.ref.__import__', create=True,
+                        side_effect=ImportError) as imp:
+            self.assertRaises(ref.ResolveError, cref.resolve)
+            self.assertRaises(ref.ResolveError, cref.resolve)
+            self.assertEqual(imp.call_count, 1)
+
+        # a new module invalidates the failure
+        mod = mock.Mock(spec=['config'])
+        mod.config = config = mock.Mock(spec=[])
+        sys.modules[modname] = mod
+        try:
+            self.assertEqual(cref.resolve(), config)
+        finally:
+            del sys.modules[modname]
+
+class Test_Warmup(unittest.TestCase):
+    def setUp(self):
+        self.reg = registry.ComponentRegistry()
+        self.order = []
+        self.lock = threading.Lock()
+
+    def _component(self, name, fail=False):
+        component = mock.Mock(spec=['warmup', '__call__'])
+        def warmup():
+            with self.lock:
+                self.order.append(name)
+            if fail:
+                raise KeyError(name)
+        component.warmup.side_effect = warmup
+        self.reg.register_component(name, component)
+        return component
+
+    def test_dependencies(self):
+        db = self._component('db')
+        self.reg.register_component('alias', 'db')
+        self.reg.register_component('nested', ref.ComponentRef('alias'))
+        self.reg.register_component('same', ref.ComponentRef(db))
+        self.assertEqual(self.reg.dependencies('db'), set())
+        self.assertEqual(self.reg.dependencies('alias'), set(['db']))
+        self.assertEqual(self.reg.dependencies('nested'), set(['alias']))
+        self.assertEqual(self.reg.dependencies('same'), set(['db']))
+
+    def test_warms_up_in_order(self):
+        db = self._component('db')
+        self._component('cache')
+        self.reg.register_component('alias', 'db')
+        timings = self.reg.warmup(
+            dependencies={'cache': ['db']}, max_workers=4,
+        )
+        self.assertEqual(sorted(timings), ['alias', 'cache', 'db'])
+        self.assertEqual(self.order.count('db'), 2)
+        self.assertEqual(self.order[0], 'db')
+        self.assertTrue('cache' in self.order)
+        self.assertFalse(db.called)
+
+    def test_open_sessions(self):
+        db = self._component('db')
+        sess = mock.MagicMock()
+        db.return_value = sess
+        self.reg.warmup(open_sessions=True)
+        self.assertEqual(sess.__enter__.call_count, 1)
+        self.assertEqual(sess.__exit__.call_count, 1)
+
+    def test_failures_reported(self):
+        self._component('db', fail=True)
+        self._component('cache')
+        self.reg.register_component('alias', 'db')
+        try:
+            self.reg.warmup()
+        except registry.WarmupError:
+            exc = sys.exc_info()[1]
+        else:
+            self.fail("WarmupError not raised")
+        self.assertEqual(sorted(exc.errors), ['alias', 'db'])
+        self.assertTrue(isinstance(exc.errors['db'], KeyError))
+        self.assertTrue(isinstance(exc.errors['alias'], registry.WarmupError))
+        self.assertEqual(list(exc.timings), ['cache'])
+
+    def test_cycle(self):
+        self.reg.register_component('a', 'b')
+        self.reg.register_component('b', 'a')
+        self.assertRaises(ValueError, self.reg.warmup)
+
+    def test_session_factory_warmup(self):
+        src = mock.Mock(spec=['warmup'])
+        sf = session.SessionFactory(src, mock.Mock())
+        sf.warmup()
+        self.assertEqual(src.warmup.call_count, 1)
+        session.SessionFactory(mock.Mock(spec=[]), mock.Mock()).warmup()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+if __name__ == '__main__':
+    import sys
+    import os, os.path
+    sys.path.insert(
+        0,
+        os.path.dirname(
+            os.path.dirname(
+                os.path.realpath(
+                    os.path.abspath(__file__)
+                )
+            )
+        )
+    )
+
+import unittest
+import asyncio
+import threading
+import mock
+from sesspy import aio, dec, openers, retry, session
+
+class Transient(retry.TransientError):
+    pass
+
+class Test_RetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.sleep = mock.Mock()
+
+    def policy(self, **kwargs):
+        kwargs.setdefault('sleep', self.sleep)
+        kwargs.setdefault('jitter', False)
+        return retry.RetryPolicy(**kwargs)
+
+    def test_retries_transient(self):
+        func = mock.Mock(side_effect=[Transient(), Transient(), 'ok'])
+        self.assertEqual(self.policy().call(func, 1, a=2), 'ok')
+        self.assertEqual(func.call_args_list, [((1,), {'a': 2})] * 3)
+        self.assertEqual(self.sleep.call_args_list, [
+            ((0.01,), {}),
+            ((0.02,), {}),
+        ])
+
+    def test_does_not_retry_other(self):
+        func = mock.Mock(side_effect=ValueError)
+        self.assertRaises(ValueError, self.policy().call, func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_max_attempts(self):
+        func = mock.Mock(side_effect=Transient)
+        self.assertRaises(Transient, self.policy(max_attempts=3).call, func)
+        self.assertEqual(func.call_count, 3)
+
+    def test_max_delay(self):
+        policy = self.policy(base_delay=1, max_delay=3, max_attempts=4)
+        self.assertEqual([policy.next_delay(i, Transient(), 0)
+                          for i in range(1, 5)], [1, 2, 3, None])
+
+    def test_jitter(self):
+        policy = self.policy(jitter=True, base_delay=1)
+        for i in range(20):
+            delay = policy.next_delay(2, Transient(), retry._clock())
+            self.assertTrue(0 <= delay <= 2)
+
+    def test_deadline(self):
+        policy = self.policy(base_delay=1, deadline=0.5)
+        self.assertEqual(policy.next_delay(1, Transient(), retry._clock()),
+                         None)
+
+    def test_classifier(self):
+        policy = self.policy(retry_on=lambda exc: isinstance(exc, KeyError))
+        func = mock.Mock(side_effect=[KeyError(), 'ok'])
+        self.assertEqual(policy.call(func), 'ok')
+        policy = self.policy(retry_on=(KeyError, IndexError))
+        func = mock.Mock(side_effect=[IndexError(), 'ok'])
+        self.assertEqual(policy.call(func), 'ok')
+
+    def test_on_retry(self):
+        on_retry = mock.Mock()
+        exc = Transient()
+        func = mock.Mock(side_effect=[exc, 'ok'])
+        self.policy(on_retry=on_retry).call(func)
+        self.assertEqual(on_retry.call_args_list, [((1, exc, 0.01), {})])
+
+    def test_only_outermost_retries(self):
+        policy = self.policy()
+        inner = mock.Mock(side_effect=[Transient(), 'ok'])
+        outer = mock.Mock(side_effect=lambda: policy.call(inner))
+        self.assertEqual(policy.call(outer), 'ok')
+        self.assertEqual(outer.call_count, 2)
+        self.assertEqual(inner.call_count, 2)
+
+class Test_Injector(unittest.TestCase):
+    def setUp(self):
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.opener.open.side_effect = lambda: mock.Mock(spec=[])
+        self.policy = retry.RetryPolicy(sleep=mock.Mock())
+
+    def test_with_component_retries_session(self):
+        conf = lambda: session.Session(self.opener)
+        calls = []
+        @dec.with_component(conf, arg='db', retry=self.policy)
+        def func(x, db):
+            calls.append(db)
+            if len(calls) < 2:
+                raise Transient()
+            return x
+        self.assertEqual(func(5), 5)
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(calls[0] is calls[1])
+        self.assertEqual(self.opener.abort.call_args_list, [
+            ((calls[0],), {}),
+        ])
+        self.assertEqual(self.opener.commit.call_args_list, [
+            ((calls[1],), {}),
+        ])
+
+    def test_bound_method_keeps_policy(self):
+        policy = self.policy
+        class C(object):
+            @dec.with_component(mock.Mock(), arg='db', retry=policy)
+            def method(self, db):
+                pass
+        self.assertTrue(C().method.retry is policy)
+
+    def test_retrying(self):
+        conf = lambda: session.Session(self.opener)
+        func = mock.Mock(side_effect=[Transient(), 'ok'])
+        func.__name__ = 'func'
+        wrapped = retry.retrying(conf, self.policy)(func)
+        self.assertEqual(wrapped(1), 'ok')
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(func.call_args[0][1:], (1,))
+        self.assertEqual(wrapped.__name__, 'func')
+
+class Test_Async(unittest.TestCase):
+    def setUp(self):
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        self.opener.open = mock.AsyncMock(return_value='conn')
+        self.opener.commit = mock.AsyncMock()
+        self.opener.abort = mock.AsyncMock()
+        self.policy = retry.RetryPolicy(base_delay=0)
+
+    def run_coro(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_async_injector_retries(self):
+        conf = lambda: aio.AsyncSession(self.opener)
+        calls = []
+        @dec.with_component(conf, arg='db', retry=self.policy)
+        async def func(db):
+            calls.append(db)
+            if len(calls) < 3:
+                raise Transient()
+            return db
+        self.assertEqual(self.run_coro(func()), 'conn')
+        self.assertEqual(self.opener.abort.await_count, 2)
+        self.assertEqual(self.opener.commit.await_count, 1)
+
+    def test_async_retrying(self):
+        conf = lambda: aio.AsyncSession(self.opener)
+        calls = []
+        @retry.retrying(conf, self.policy)
+        async def func(db, x):
+            calls.append(x)
+            if len(calls) < 2:
+                raise Transient()
+            return db, x
+        self.assertEqual(self.run_coro(func(1)), ('conn', 1))
+
+class Test_NestedSession(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.opener = mock.Mock(spec=['open', 'commit', 'abort'])
+        def open():
+            self.log.append('BEGIN')
+            return 'conn'
+        self.opener.open.side_effect = open
+        self.opener.commit.side_effect = \
+            lambda instance: self.log.append('COMMIT')
+        self.opener.abort.side_effect = \
+            lambda instance: self.log.append('ROLLBACK')
+        self.sf = session.SessionFactory(
+            mock.Mock(), mock.Mock(return_value=self.opener),
+            opener_factory=openers.CountingOpener,
+            local_openers=session.LocalOpeners(),
+        )
+        self.policy = retry.RetryPolicy(sleep=mock.Mock())
+
+    def run_nested(self, func):
+        self.assertFalse(self.sf.in_session())
+        def outer():
+            with self.sf():
+                self.assertTrue(self.sf.in_session())
+                func()
+        self.assertRaises(Transient, outer)
+        self.assertEqual(self.log, ['BEGIN', 'INSERT', 'ROLLBACK'])
+
+    def failing(self, *args, **kwargs):
+        self.log.append('INSERT')
+        raise Transient()
+
+    def test_injector_not_retried(self):
+        self.run_nested(dec.with_component(
+            self.sf, arg='db', retry=self.policy)(self.failing))
+
+    def test_compiled_not_retried(self):
+        def func(db):
+            self.failing()
+        self.run_nested(dec.with_component(
+            self.sf, arg='db', retry=self.policy, compiled=True)(func))
+
+    def test_multi_not_retried(self):
+        other = lambda: session.Session(mock.Mock(spec=['open', 'commit',
+                                                        'abort']))
+        self.run_nested(dec.with_components(
+            db=self.sf, other=other, retry=self.policy)(self.failing))
+
+    def test_retrying_not_retried(self):
+        self.run_nested(retry.retrying(self.sf, self.policy)(self.failing))
+
+    def test_retried_outside_session(self):
+        func = dec.with_component(self.sf, arg='db', retry=self.policy)(
+            mock.Mock(side_effect=[Transient(), 'ok']))
+        self.assertEqual(func(), 'ok')
+        self.assertEqual(func.func.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
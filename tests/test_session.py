@@ -35,7 +35,7 @@ if __name__ == '__main__':
 import unittest
 import mock
 import threading
-from sesspy import session
+from sesspy import local, openers, session, source
 
 class Test_Session(unittest.TestCase):
     def setUp(self):
@@ -307,5 +307,192 @@ class Test_SessionFactory(unittest.TestCase):
         self.assertEqual(opener_factory.call_count, 2)
         self.assertEqual(s.instance_opener, new_opener)
 
+class Test_SourceReload(unittest.TestCase):
+    def setUp(self):
+        self.clients = []
+        def connect():
+            client = 'client-%d' % (len(self.clients) + 1)
+            self.clients.append(client)
+            return client
+        self.src = source.GuardedFactorySource(connect)
+
+    def factory(self, opener_factory=openers.CountingOpener):
+        return session.SessionFactory(
+            self.src, source.sessionless_source_adapter, opener_factory,
+            local_openers=session.LocalOpeners())
+
+    def test_shared_opener_rebuilt(self):
+        sf = self.factory(openers.combine_openers(
+            openers.pooling_opener(), openers.CountingOpener))
+        with sf() as instance:
+            self.assertEqual(instance, 'client-1')
+        pool = sf.local_openers.get(sf).session_opener
+        self.src.reload()
+        with sf() as instance:
+            self.assertEqual(instance, 'client-2')
+        self.assertTrue(pool.closed)
+
+    def test_nested_in_session_open_during_reload(self):
+        sf = self.factory()
+        with sf() as outer:
+            self.src.reload()
+            self.assertTrue(sf.in_session())
+            with sf() as inner:
+                self.assertTrue(inner is outer)
+        self.assertFalse(sf.in_session())
+        self.assertTrue(sf.local_openers.get(sf) is not None)
+        with sf() as instance:
+            self.assertEqual(instance, 'client-2')
+        # the old opener was dropped once no longer in use
+        self.assertEqual(sf.local_openers.get(sf), None)
+
+class Test_LocalOpeners(unittest.TestCase):
+    def test_keyed_by_identity(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        opener = mock.Mock(spec=[])
+        self.assertEqual(lo.get(config), None)
+        self.assertRaises(KeyError, lambda: lo[config])
+        lo[config] = opener
+        self.assertTrue(lo[config] is opener)
+        self.assertTrue(lo.get(config) is opener)
+        self.assertEqual(lo.get(mock.Mock(spec=[])), None)
+
+    def test_reused_id_not_matched(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        other = mock.Mock(spec=[])
+        lo[other] = mock.Mock(spec=[])
+        # simulate an entry left behind by a dead config with the same id
+        lo.openers[id(config)] = lo.openers[id(other)]
+        self.assertEqual(lo.get(config), None)
+        self.assertRaises(KeyError, lambda: lo[config])
+
+    def test_config_without_weakref(self):
+        lo = session.LocalOpeners()
+        config = object()
+        opener = mock.Mock(spec=[])
+        lo[config] = opener
+        self.assertTrue(lo[config] is opener)
+
+    def test_dead_configs_purged(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        lo[config] = mock.Mock(spec=[])
+        dead_id = id(config)
+        del config
+        other = mock.Mock(spec=[])
+        lo[other] = mock.Mock(spec=[])
+        self.assertEqual(list(lo.openers.keys()), [id(other)])
+        self.assertEqual(list(lo._reclaimer_openers().keys()), [id(other)])
+
+    def test_dead_configs_idle_openers_closed(self):
+        lo = session.LocalOpeners()
+        idle = mock.Mock(spec=['close', 'count'])
+        idle.count = 0
+        in_use = mock.Mock(spec=['close', 'count'])
+        in_use.count = 1
+        for opener in idle, in_use:
+            config = mock.Mock(spec=[])
+            lo[config] = opener
+            del config
+        lo[mock.Mock(spec=[])] = mock.Mock(spec=[])
+        idle.close.assert_called_once_with()
+        self.assertEqual(in_use.close.called, False)
+
+    def test_is_thread_local(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        lo[config] = mock.Mock(spec=[])
+        res = []
+        thread = threading.Thread(target=lambda: res.append(lo.get(config)))
+        thread.start()
+        thread.join()
+        self.assertEqual(res, [None])
+
+    def test_close_remaining(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        opener = mock.Mock(spec=['close'])
+        lo[config] = opener
+        lo.close_remaining()
+        self.assertEqual(opener.close.call_count, 1)
+        self.assertEqual(lo.get(config), None)
+
+    def _run_thread(self, lo, config, opener):
+        def run():
+            lo[config] = opener
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+    def test_reclaimed_at_thread_exit(self):
+        session.reclaimed_openers.reset()
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=['metrics'])
+        opener = mock.Mock(spec=['close', 'count'])
+        opener.count = 1
+        self._run_thread(lo, config, opener)
+        self.assertEqual(opener.close.call_count, 1)
+        self.assertEqual(config.metrics.increment.call_args_list, [
+            (('openers_reclaimed',), {}),
+        ])
+        counters = session.reclaimed_openers.snapshot()['counters']
+        self.assertEqual(counters['reclaimed'], 1)
+        self.assertEqual(counters['in_use'], 1)
+        self.assertEqual(counters['Mock'], 1)
+
+    def test_reclaim_failure_counted(self):
+        session.reclaimed_openers.reset()
+        opener = mock.Mock(spec=['close'])
+        opener.close.side_effect = ValueError()
+        import warnings
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self._run_thread(session.LocalOpeners(), object(), opener)
+        counters = session.reclaimed_openers.snapshot()['counters']
+        self.assertEqual(counters['close_failed'], 1)
+
+    def test_reclaim_disabled(self):
+        opener = mock.Mock(spec=['close'])
+        self._run_thread(session.LocalOpeners(reclaim=False), object(), opener)
+        self.assertFalse(opener.close.called)
+
+    def test_closed_openers_not_reclaimed(self):
+        lo = session.LocalOpeners()
+        opener = mock.Mock(spec=['close'])
+        def run():
+            lo[object()] = opener
+            lo.close_remaining()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(opener.close.call_count, 1)
+
+    def test_openers_dropped_after_fork(self):
+        lo = session.LocalOpeners()
+        config = mock.Mock(spec=[])
+        opener = mock.Mock(spec=['close'])
+        lo[config] = opener
+        inherited = len(local._inherited_from_parent)
+        lo._after_fork()
+        self.assertEqual(lo.get(config), None)
+        self.assertFalse(opener.close.called)
+        del local._inherited_from_parent[inherited:]
+
+        # a thread exiting in the child does not close the parent's openers
+        other = mock.Mock(spec=['close'])
+        reclaimer = session._ThreadReclaimer()
+        reclaimer.openers[1] = (lambda: None, other)
+        reclaimer.pid = -1
+        del reclaimer
+        self.assertFalse(other.close.called)
+        del local._inherited_from_parent[inherited:]
+
+    def test_session_factory_weakref(self):
+        import weakref
+        sf = session.SessionFactory(mock.Mock(), mock.Mock())
+        self.assertTrue(weakref.ref(sf)() is sf)
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,9 +32,10 @@ if __name__ == '__main__':
         )
     )
 
+import os
 import unittest
 import mock
-from sesspy import source
+from sesspy import local, source
 
 class Test_GuardedFactorySource(unittest.TestCase):
 
@@ -74,5 +75,80 @@ class Test_GuardedFactorySource(unittest.TestCase):
                 ((), {}),
             ])
 
+    def test_dispose(self):
+        instances = [mock.Mock(spec=[]), mock.Mock(spec=[])]
+        dispose_instance = mock.Mock()
+        gfs = source.GuardedFactorySource(
+            mock.Mock(side_effect=instances),
+            dispose_instance=dispose_instance)
+        gfs.dispose()
+        self.assertEqual(dispose_instance.called, False)
+        self.assertTrue(gfs() is instances[0])
+        gfs.dispose()
+        dispose_instance.assert_called_once_with(instances[0])
+        self.assertTrue(gfs() is instances[1])
+
+    def test_reload(self):
+        instances = [mock.Mock(spec=[]), mock.Mock(spec=[])]
+        dispose_instance = mock.Mock()
+        listener = mock.Mock()
+        gfs = source.GuardedFactorySource(
+            mock.Mock(side_effect=instances),
+            dispose_instance=dispose_instance)
+        gfs.reload_listeners.append(listener)
+        gfs.reload()
+        self.assertEqual(gfs.generation, 0)
+        self.assertTrue(gfs() is instances[0])
+        gfs.reload()
+        self.assertEqual(gfs.generation, 1)
+        self.assertTrue(gfs() is instances[1])
+        dispose_instance.assert_called_once_with(instances[0])
+        listener.assert_called_once_with()
+
+
+        factory = mock.Mock(spec=[])
+        first, second = mock.Mock(spec=[]), mock.Mock(spec=[])
+        factory.side_effect = [first, second]
+        dispose = mock.Mock(spec=[])
+
+        gfs = source.GuardedFactorySource(factory, fork_dispose=dispose)
+        self.assertEqual(gfs(), first)
+        gfs._after_fork()
+        self.assertEqual(dispose.call_args_list, [((first,), {})])
+        self.assertEqual(gfs(), second)
+        self.assertEqual(gfs(), second)
+
+    def test_inherited_instance_kept_after_fork(self):
+        factory = mock.Mock(spec=[])
+        instance = mock.Mock(spec=[])
+        factory.return_value = instance
+
+        gfs = source.GuardedFactorySource(factory)
+        gfs()
+        gfs._after_fork()
+        self.assertTrue(instance in local._inherited_from_parent)
+        local._inherited_from_parent.remove(instance)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), "requires fork hooks")
+    def test_fork(self):
+        factory = mock.Mock(spec=[])
+        factory.side_effect = lambda: os.getpid()
+        gfs = source.GuardedFactorySource(factory)
+        self.assertEqual(gfs(), os.getpid())
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(wfd, str(gfs() == os.getpid()).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        result = os.read(rfd, 16)
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'True')
+        self.assertEqual(gfs(), os.getpid())
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,9 +32,15 @@ if __name__ == '__main__':
         )
     )
 
+import os
+import sys
+import shutil
+import tempfile
+import threading
 import unittest
 import mock
-from sesspy import sqlalchemy
+import functools
+from sesspy import sqlalchemy, openers
 
 class Test_DbConnection(unittest.TestCase):
 
@@ -210,5 +216,356 @@ class Test_Transactions(unittest.TestCase):
         self.assertEqual(self.transaction.commit.call_count, 1)
         self.assertEqual(self.transaction.rollback.called, False)
 
+class Test_ForkedEngine(unittest.TestCase):
+    def test_dispose_without_close(self):
+        engine = mock.Mock(spec=['dispose'])
+        sqlalchemy.dispose_forked_engine(engine)
+        self.assertEqual(engine.dispose.call_args_list, [
+            ((), {'close': False}),
+        ])
+
+    def test_old_engine_kept(self):
+        from sesspy import local
+        engine = mock.Mock(spec=['dispose'])
+        engine.dispose.side_effect = TypeError()
+        sqlalchemy.dispose_forked_engine(engine)
+        self.assertTrue(engine in local._inherited_from_parent)
+        local._inherited_from_parent.remove(engine)
+
+    def test_helpers_use_hook(self):
+        component = sqlalchemy.db_connection('sqlite://')
+        self.assertEqual(component.source_factory.fork_dispose,
+                         sqlalchemy.dispose_forked_engine)
+
+class Test_LazyImport(unittest.TestCase):
+    def test_sqlalchemy_not_imported(self):
+        import os, sys, subprocess
+        script = (
+            "import sys, sesspy\n"
+            "component = sesspy.sqlalchemy.db_connection('sqlite://')\n"
+            "print('sqlalchemy' in sys.modules)\n"
+        )
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        self.assertEqual(output.strip(), b'False')
+
+class Test_TransientErrors(unittest.TestCase):
+
+    def make_error(self, orig, invalidated=False):
+        from sqlalchemy.exc import DBAPIError
+        return DBAPIError('stmt', {}, orig,
+                          connection_invalidated=invalidated)
+
+    def test_disconnect(self):
+        self.assertTrue(sqlalchemy.is_transient_error(
+            self.make_error(Exception(), invalidated=True)))
+
+    def test_sqlstate(self):
+        orig = Exception()
+        orig.pgcode = '40P01'
+        self.assertTrue(sqlalchemy.is_transient_error(self.make_error(orig)))
+        orig.pgcode = '23505'
+        self.assertFalse(sqlalchemy.is_transient_error(self.make_error(orig)))
+
+    def test_mysql_deadlock(self):
+        orig = Exception(1213, 'Deadlock found')
+        self.assertTrue(sqlalchemy.is_transient_error(self.make_error(orig)))
+
+    def test_other_errors(self):
+        self.assertFalse(sqlalchemy.is_transient_error(ValueError()))
+        self.assertFalse(sqlalchemy.is_transient_error(
+            self.make_error(Exception('other'))))
+
+class Test_Savepoints(unittest.TestCase):
+
+    def setUp(self):
+        self.transaction = mock.Mock(spec=['commit', 'rollback'])
+        self.savepoint = mock.Mock(spec=['commit', 'rollback'])
+        self.connection = mock.Mock(spec=['begin', 'begin_nested', 'close'])
+        self.connection.begin.return_value = self.transaction
+        self.connection.begin_nested.return_value = self.savepoint
+        self.engine = mock.Mock(spec=['connect'])
+        self.engine.connect.return_value = self.connection
+        self.component = sqlalchemy.transactional_db_connection(
+            '__test_uri',
+            connection_factory=mock.Mock(return_value=self.engine),
+            opener=functools.partial(openers.CountingOpener, savepoints=True),
+        )
+
+    def test_nested_abort_rolls_back_savepoint(self):
+        sess1 = self.component()
+        sess1.open()
+        sess2 = self.component()
+        sess2.open()
+        self.assertEqual(self.connection.begin_nested.call_count, 1)
+
+        sess2.abort()
+        self.assertEqual(self.savepoint.rollback.call_count, 1)
+        self.assertEqual(self.transaction.rollback.called, False)
+
+        sess1.commit()
+        self.assertEqual(self.transaction.commit.call_count, 1)
+        self.assertEqual(self.connection.close.call_count, 1)
+
+    def test_nested_commit_releases_savepoint(self):
+        sess1 = self.component()
+        sess1.open()
+        sess2 = self.component()
+        sess2.open()
+        sess2.commit()
+        self.assertEqual(self.savepoint.commit.call_count, 1)
+        self.assertEqual(self.transaction.commit.called, False)
+        sess1.commit()
+        self.assertEqual(self.transaction.commit.call_count, 1)
+
+    def test_orm_savepoints(self):
+        session = mock.Mock(spec=['begin_nested', 'commit', 'rollback'])
+        factory = sqlalchemy.ORMSessionFactory(mock.Mock())
+        self.assertEqual(factory.savepoint(session),
+                         session.begin_nested.return_value)
+        factory.rollback_savepoint(session, self.savepoint)
+        self.assertEqual(self.savepoint.rollback.call_count, 1)
+
+class Test_TenantComponents(unittest.TestCase):
+
+    def test_engine_per_tenant(self):
+        engines = {}
+        def connection_factory(db_uri, **kwargs):
+            engine = engines[db_uri] = mock.Mock(spec=['dispose'])
+            return engine
+        component = sqlalchemy.tenant_components(
+            '__test_uri/{tenant}',
+            helper=sqlalchemy.db_connection,
+            max_live=1,
+            connection_factory=connection_factory,
+        )
+        with component['a']() as conn:
+            self.assertTrue(conn is engines['__test_uri/a'])
+        with component['b']() as conn:
+            self.assertTrue(conn is engines['__test_uri/b'])
+        engines['__test_uri/a'].dispose.assert_called_once_with()
+        self.assertEqual(engines['__test_uri/b'].dispose.called, False)
+
+    def test_callable_template(self):
+        connection_factory = mock.Mock()
+        component = sqlalchemy.tenant_components(
+            lambda tenant: '__test_uri_%s' % tenant,
+            helper=sqlalchemy.db_connection,
+            connection_factory=connection_factory,
+            current_tenant=lambda: 'x',
+        )
+        with component():
+            pass
+        connection_factory.assert_called_once_with('__test_uri_x')
+
+class Test_StickyConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+        def connect():
+            connection = mock.Mock(spec=['begin', 'close', 'invalidated'])
+            connection.invalidated = False
+            self.connections.append(connection)
+            return connection
+        self.engine = mock.Mock(spec=['connect'])
+        self.engine.connect.side_effect = connect
+        self.clock = mock.patch.object(sqlalchemy, '_clock',
+                                       return_value=100.0)
+        self.clock.start()
+        self.addCleanup(self.clock.stop)
+
+    def test_connection_kept(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine)
+        for _i in range(3):
+            factory.commit(factory.open())
+        factory.abort(factory.open())
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].begin.call_count, 4)
+        self.assertEqual(self.connections[0].close.called, False)
+        factory.close()
+        self.connections[0].close.assert_called_once_with()
+
+    def test_max_transactions(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine,
+                                                      max_transactions=2)
+        for _i in range(3):
+            factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 2)
+        self.connections[0].close.assert_called_once_with()
+        self.assertEqual(self.connections[1].close.called, False)
+
+    def test_idle_timeout(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine,
+                                                      idle_timeout=10)
+        factory.commit(factory.open())
+        sqlalchemy._clock.return_value = 105.0
+        factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 1)
+        sqlalchemy._clock.return_value = 120.0
+        factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 2)
+        self.connections[0].close.assert_called_once_with()
+
+    def test_reap(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine,
+                                                      idle_timeout=10)
+        self.assertEqual(factory._reap(100.0), (None, None))
+        wrapper = factory.open()
+        self.assertEqual(factory._reap(200.0), (None, None))
+        factory.commit(wrapper)
+        self.assertEqual(factory._reap(105.0), (None, 110.0))
+        self.assertEqual(factory._reap(111.0), (self.connections[0], None))
+        self.assertTrue(factory.connection is None)
+        factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 2)
+
+    def test_thread_bound_pool_not_reaped(self):
+        try:
+            from sqlalchemy import pool
+        except ImportError:
+            self.skipTest("sqlalchemy is not installed")
+        with mock.patch.object(sqlalchemy._idle_reaper, 'watch') as watch:
+            factory = sqlalchemy.StickyTransactionFactory(self.engine)
+            factory.commit(factory.open())
+            factory.commit(factory.open())
+            watch.assert_called_once_with(factory)
+            watch.reset_mock()
+            self.engine.pool = mock.Mock(spec=pool.SingletonThreadPool)
+            factory = sqlalchemy.StickyTransactionFactory(self.engine)
+            factory.commit(factory.open())
+            self.assertEqual(watch.called, False)
+
+    def test_invalidated(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine)
+        factory.commit(factory.open())
+        self.connections[0].invalidated = True
+        factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 2)
+        self.connections[0].close.assert_called_once_with()
+
+    def test_failed_commit_closes(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine)
+        wrapper = factory.open()
+        wrapper._transaction.commit.side_effect = ValueError()
+        self.assertRaises(ValueError, factory.commit, wrapper)
+        self.connections[0].close.assert_called_once_with()
+        factory.commit(factory.open())
+        self.assertEqual(len(self.connections), 2)
+
+    def test_failed_begin_closes(self):
+        factory = sqlalchemy.StickyTransactionFactory(self.engine)
+        factory.commit(factory.open())
+        self.connections[0].begin.side_effect = ValueError()
+        self.assertRaises(ValueError, factory.open)
+        self.connections[0].close.assert_called_once_with()
+        self.assertTrue(factory.connection is None)
+
+    def test_component(self):
+        component = sqlalchemy.transactional_db_connection(
+            '__test_uri',
+            connection_factory=mock.Mock(return_value=self.engine),
+            sticky_connections=True,
+            max_transactions=10,
+        )
+        for _i in range(3):
+            with component():
+                pass
+        self.assertEqual(len(self.connections), 1)
+        opener = component.local_openers.get(component)
+        self.assertEqual(opener.session_opener.max_transactions, 10)
+        # closing the opener, e.g. when its thread exits, releases the
+        # connection
+        opener.close()
+        self.connections[0].close.assert_called_once_with()
+        component.local_openers.clear()
+
+class Test_StickyConnectionsPool(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from sqlalchemy import pool
+        except ImportError:
+            self.skipTest("sqlalchemy is not installed")
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.component = sqlalchemy.transactional_db_connection(
+            'sqlite:///' + os.path.join(tmpdir, 'test.db'),
+            engine_args=dict(pool_size=1, max_overflow=0, pool_timeout=5),
+            sticky_connections=True,
+            idle_timeout=0.1,
+        )
+        self.addCleanup(self.component.source_factory.dispose)
+
+    def test_more_threads_than_connections(self):
+        # each thread stays alive after its transaction, so its connection
+        # is only returned to the pool by the reaper
+        done = threading.Semaphore(0)
+        finish = threading.Event()
+        errors = []
+        def run():
+            try:
+                with self.component() as conn:
+                    conn.exec_driver_sql('select 1')
+            except Exception:
+                errors.append(sys.exc_info()[1])
+            done.release()
+            finish.wait(10)
+        threads = [threading.Thread(target=run) for _i in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                self.assertTrue(done.acquire(timeout=10))
+        finally:
+            finish.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+class Test_TransactionWrapper(unittest.TestCase):
+
+    def test_bound_methods(self):
+        connection = mock.Mock(spec=['execute', 'exec_driver_sql', 'scalar',
+                                     'scalars', 'info'])
+        transaction = mock.Mock(spec=[])
+        wrapper = sqlalchemy.TransactionWrapper(connection, transaction)
+        self.assertTrue(wrapper.connection is connection)
+        for name in 'execute', 'exec_driver_sql', 'scalar', 'scalars':
+            self.assertTrue(getattr(wrapper, name) is getattr(connection, name))
+        wrapper.execute('statement')
+        connection.execute.assert_called_once_with('statement')
+        self.assertTrue(wrapper.info is connection.info)
+        self.assertRaises(AttributeError, lambda: wrapper.missing)
+
+    def test_missing_methods(self):
+        connection = mock.Mock(spec=['execute', 'scalar'])
+        wrapper = sqlalchemy.TransactionWrapper(connection, mock.Mock())
+        self.assertTrue(wrapper.execute is connection.execute)
+        self.assertTrue(wrapper.scalar is connection.scalar)
+        self.assertRaises(AttributeError, lambda: wrapper.scalars)
+        self.assertRaises(AttributeError, lambda: wrapper.exec_driver_sql)
+
+    def test_sqlite(self):
+        try:
+            from sqlalchemy import text
+        except ImportError:
+            self.skipTest("sqlalchemy is not installed")
+        component = sqlalchemy.transactional_db_connection('sqlite://')
+        try:
+            with component() as conn:
+                conn.exec_driver_sql('create table t (x integer)')
+                conn.execute(text('insert into t values (1), (2)'))
+                self.assertEqual(conn.scalar(text('select count(*) from t')),
+                                 2)
+                self.assertEqual(
+                    list(conn.scalars(text('select x from t order by x'))),
+                    [1, 2])
+                self.assertEqual(conn.connection.closed, False)
+        finally:
+            component.local_openers.clear()
+            component.source_factory.dispose()
+
 if __name__ == '__main__':
     unittest.main()
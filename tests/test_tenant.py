@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Mark Nevill
+# This file is part of sesspy.
+# 
+# sesspy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# sesspy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with sesspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+if __name__ == '__main__':
+    import sys
+    import os, os.path
+    sys.path.insert(
+        0,
+        os.path.dirname(
+            os.path.dirname(
+                os.path.realpath(
+                    os.path.abspath(__file__)
+                )
+            )
+        )
+    )
+
+import unittest
+import warnings
+import mock
+from sesspy import tenant, session, source
+
+def _component(tenant_key):
+    component = mock.Mock(name='component_%s' % (tenant_key,))
+    component.tenant = tenant_key
+    return component
+
+class Test_TenantComponent(unittest.TestCase):
+
+    def test_builds_component_per_tenant(self):
+        factory = mock.Mock(side_effect=_component)
+        tenants = tenant.TenantComponent(factory)
+        with tenants['a']() as instance:
+            inner = tenants.entries['a'].component.return_value
+            self.assertTrue(instance is inner.open.return_value)
+        with tenants['a']():
+            pass
+        with tenants['b']():
+            pass
+        self.assertEqual(factory.call_args_list,
+                         [mock.call('a'), mock.call('b')])
+        stats = tenants.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['live'], 2)
+
+    def test_commit_and_abort(self):
+        tenants = tenant.TenantComponent(_component)
+        with tenants['a']():
+            pass
+        inner = tenants.entries['a'].component.return_value
+        inner.commit.assert_called_once_with(True)
+        try:
+            with tenants['a']():
+                raise ValueError()
+        except ValueError:
+            pass
+        inner.abort.assert_called_once_with(True)
+        self.assertEqual(tenants.entries['a'].active, 0)
+
+    def test_failed_open_is_not_counted(self):
+        tenants = tenant.TenantComponent(_component)
+        sess = tenants.open_session('a')
+        sess.session.open.side_effect = ValueError()
+        self.assertRaises(ValueError, sess.open)
+        self.assertEqual(tenants.entries['a'].active, 0)
+
+    def test_unopened_session_is_not_released(self):
+        dispose = mock.Mock()
+        tenants = tenant.TenantComponent(_component, dispose=dispose)
+        s1 = tenants.open_session('a')
+        s1.session = mock.Mock()
+        s1.session.commit.side_effect = session.SessionStateException()
+        s2 = tenants.open_session('a')
+        s2.open()
+        # never opened, e.g. with raise_failure=False, or committed twice
+        self.assertRaises(session.SessionStateException, s1.commit)
+        s1.abort(False)
+        self.assertEqual(tenants.entries['a'].active, 1)
+        tenants.evict('a')
+        self.assertFalse(dispose.called)
+        s2.commit()
+        self.assertRaises(session.SessionStateException, s1.commit)
+        self.assertEqual(dispose.call_count, 1)
+
+    def test_evicts_least_recently_used(self):
+        dispose = mock.Mock()
+        tenants = tenant.TenantComponent(_component, max_live=2,
+                                         dispose=dispose)
+        for key in 'a', 'b', 'a', 'c':
+            with tenants[key]():
+                pass
+        self.assertEqual(list(tenants.entries), ['a', 'c'])
+        self.assertEqual(dispose.call_count, 1)
+        self.assertEqual(dispose.call_args[0][0].tenant, 'b')
+        stats = tenants.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['disposals'], 1)
+        self.assertEqual(stats['live'], 2)
+
+    def test_disposes_after_sessions_drain(self):
+        dispose = mock.Mock()
+        tenants = tenant.TenantComponent(_component, max_live=1,
+                                         dispose=dispose)
+        sess = tenants.open_session('a')
+        sess.open()
+        with tenants['b']():
+            pass
+        self.assertFalse(dispose.called)
+        stats = tenants.stats()
+        self.assertEqual(stats['draining'], 1)
+        self.assertEqual(stats['live'], 2)
+        sess.commit()
+        self.assertEqual(dispose.call_count, 1)
+        self.assertEqual(dispose.call_args[0][0].tenant, 'a')
+        self.assertEqual(tenants.stats()['draining'], 0)
+
+    def test_evicted_before_open(self):
+        dispose = mock.Mock()
+        tenants = tenant.TenantComponent(_component, dispose=dispose)
+        sess = tenants.open_session('a')
+        tenants.evict('a')
+        self.assertEqual(dispose.call_count, 1)
+        sess.open()
+        self.assertFalse(sess.entry.evicted)
+        self.assertTrue(tenants.entries['a'] is sess.entry)
+        sess.commit()
+        self.assertEqual(dispose.call_count, 1)
+
+    def test_clear(self):
+        dispose = mock.Mock()
+        tenants = tenant.TenantComponent(_component, dispose=dispose)
+        for key in 'a', 'b':
+            with tenants[key]():
+                pass
+        tenants.clear()
+        self.assertEqual(dispose.call_count, 2)
+        self.assertEqual(tenants.stats()['live'], 0)
+
+    def test_dispose_failure_warns(self):
+        tenants = tenant.TenantComponent(
+            _component, dispose=mock.Mock(side_effect=ValueError()))
+        with tenants['a']():
+            pass
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            tenants.evict('a')
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(tenants.stats()['disposals'], 1)
+
+    def test_current_tenant(self):
+        factory = mock.Mock(side_effect=_component)
+        tenants = tenant.TenantComponent(factory,
+                                         current_tenant=lambda: 'x')
+        with tenants():
+            pass
+        factory.assert_called_once_with('x')
+        self.assertRaises(TypeError,
+                          tenant.TenantComponent(_component).open_session)
+
+    def test_disposes_session_factory_source(self):
+        dispose_instance = mock.Mock()
+        def component_factory(tenant_key):
+            return session.SessionFactory(
+                source.GuardedFactorySource(
+                    mock.Mock, dispose_instance=dispose_instance),
+                source.sessionless_source_adapter,
+                local_openers=False,
+            )
+        tenants = tenant.TenantComponent(component_factory)
+        with tenants['a']() as instance:
+            pass
+        tenants.evict('a')
+        dispose_instance.assert_called_once_with(instance)
+
+if __name__ == '__main__':
+    unittest.main()